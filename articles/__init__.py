@@ -12,12 +12,3 @@ def get_version():
     return version
 
 __version__ = get_version()
-
-
-from articles.directives import *
-try:
-    import listeners
-except ImportError:
-    # this happens when setup.py is grabbing __version__; nothing to worry
-    # about
-    pass
@@ -5,6 +5,7 @@ from django.contrib.auth.models import User
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from articles.forms import ArticleAdminForm
+from articles.listeners import articles_updated
 from articles.models import Article, ArticleStatus, Attachment, Tag
 
 log = logging.getLogger('articles.admin')
@@ -74,10 +75,12 @@ class ArticleAdmin(admin.ModelAdmin):
 
     def mark_active(self, request, queryset):
         queryset.update(is_active=True)
+        articles_updated(queryset)
     mark_active.short_description = _('Mark select articles as active')
 
     def mark_inactive(self, request, queryset):
         queryset.update(is_active=False)
+        articles_updated(queryset)
     mark_inactive.short_description = _('Mark select articles as inactive')
 
     def get_actions(self, request):
@@ -85,7 +88,8 @@ class ArticleAdmin(admin.ModelAdmin):
 
         def dynamic_status(name, status):
             def status_func(self, request, queryset):
-                queryset.update(status=status)
+                queryset.update(status=status, is_live=status.is_live)
+                articles_updated(queryset)
 
             status_func.__name__ = name
             status_func.short_description = _('Set status of selected to "%s"' % status)
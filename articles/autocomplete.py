@@ -0,0 +1,104 @@
+"""
+In-memory prefix index used to auto-complete tag names in the admin.
+"""
+
+import logging
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+
+from articles.caching import get_version
+from articles.models import Tag, annotate_tag_usage
+
+# how often, in seconds, to ask the cache whether another process changed tags
+CHECK_INTERVAL = getattr(settings, 'ARTICLES_AUTOCOMPLETE_CHECK_INTERVAL', 1)
+
+# marks the list of best matches stored in each trie node
+MATCHES = None
+
+log = logging.getLogger('articles.autocomplete')
+
+def normalize(name):
+    """Folds case and accents so that "cau" also matches accented names"""
+
+    decomposed = unicodedata.normalize('NFKD', unicode(name))
+    return u''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+class TagIndex(object):
+    """
+    A trie over normalized tag names.  Every node keeps the ``limit`` most
+    used tags that start with its prefix, so a lookup is a walk down the trie
+    and never has to rank anything.
+    """
+
+    def __init__(self, limit=10):
+        self.limit = limit
+        self._root = None
+        self._version = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def build(self, tags):
+        """Indexes an iterable of ``(name, usage_count)`` pairs"""
+
+        root = {MATCHES: []}
+        ranked = sorted(tags, key=lambda t: (-t[1], normalize(t[0])))
+        for name, count in ranked:
+            node = root
+            self._add_match(node, name)
+            for char in normalize(name):
+                node = node.setdefault(char, {MATCHES: []})
+                self._add_match(node, name)
+
+        self._root = root
+        return root
+
+    def _add_match(self, node, name):
+        # tags arrive best first, so the first ``limit`` are the ones to keep
+        if len(node[MATCHES]) < self.limit:
+            node[MATCHES].append(name)
+
+    def rebuild(self):
+        """Loads every tag and its usage count from the database"""
+
+        log.debug('Rebuilding the tag auto-complete index')
+        version = get_version('tags')
+        tags = annotate_tag_usage(Tag.objects.all()).values_list('name', 'count')
+        root = self.build(tags)
+        self._version = version
+        self._checked = time.time()
+        return root
+
+    def invalidate(self):
+        """Forces the index to be rebuilt on the next search"""
+
+        self._root = None
+        self._version = None
+
+    def version_changed(self):
+        """Checks, at most every CHECK_INTERVAL seconds, if tags have changed"""
+
+        if self._version is None or time.time() - self._checked < CHECK_INTERVAL:
+            return False
+
+        self._checked = time.time()
+        return self._version != get_version('tags')
+
+    def search(self, query):
+        """Returns the names of the most used tags starting with ``query``"""
+
+        node = self._root
+        if node is None or self.version_changed():
+            with self._lock:
+                node = self.rebuild()
+
+        for char in normalize(query):
+            node = node.get(char)
+            if node is None:
+                return []
+
+        return list(node[MATCHES])
+
+tag_index = TagIndex()
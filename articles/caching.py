@@ -0,0 +1,89 @@
+"""
+Cache key helpers shared by the views, feeds and template tags.
+
+Rather than deleting cached values when articles change, most of the cached
+data in ``django-articles`` is stored under keys that include a *version
+stamp*.  Bumping a version stamp makes every key built from it unreachable,
+so stale entries simply age out of the cache on their own.
+"""
+
+import logging
+import re
+import time
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = logging.getLogger('articles.caching')
+
+# how long cached querysets and fragments live; articles scheduled to go live
+# in the future don't bump any version, so don't hold on for too long
+CACHE_TIMEOUT = getattr(settings, 'ARTICLES_CACHE_TIMEOUT', 3600)
+
+# how long version stamps live; they are cheap, so keep them around
+VERSION_TIMEOUT = getattr(settings, 'ARTICLES_VERSION_TIMEOUT', 86400 * 30)
+
+# memcached refuses keys with whitespace/control characters or more than 250
+# characters
+UNSAFE_KEY_RE = re.compile(r'[\x00-\x20\x7f]')
+MAX_KEY_LENGTH = 200
+
+def _build_key(parts):
+    key = 'articles:' + ':'.join(unicode(p) for p in parts)
+    key = key.encode('utf-8')
+    if len(key) > MAX_KEY_LENGTH or UNSAFE_KEY_RE.search(key):
+        key = 'articles:%s' % sha1(key).hexdigest()
+
+    return key
+
+def make_key(*parts):
+    """
+    Builds a cache key that is safe to use with any cache backend.  Keys are
+    namespaced by the current site, so that sites sharing a cache never see
+    each other's listings.
+    """
+
+    return _build_key(('site_%s' % getattr(settings, 'SITE_ID', None),) + parts)
+
+def _version_key(name):
+    # articles are shared by every site, and so are the version stamps
+    return _build_key(('version', name))
+
+def get_version(name):
+    """Returns the current version stamp for ``name``"""
+
+    key = _version_key(name)
+    version = cache.get(key)
+    if version is None:
+        # start from the clock so a lost stamp never reuses an old value
+        version = int(time.time() * 1000)
+        cache.add(key, version, VERSION_TIMEOUT)
+        version = cache.get(key, version)
+
+    return version
+
+def bump_version(*names):
+    """Invalidates everything cached under the given version stamps"""
+
+    for name in names:
+        key = _version_key(name)
+        log.debug('Bumping cache version "%s"' % (name,))
+        try:
+            cache.incr(key)
+        except ValueError:
+            # the stamp expired or was never set
+            cache.set(key, int(time.time() * 1000), VERSION_TIMEOUT)
+
+def article_version_name(pk):
+    """Names the version stamp of the cached HTML for a single article"""
+
+    return 'article_%s' % (pk,)
+
+def listing_version_name(kind, value=''):
+    """
+    Names the version stamp of a cached listing page.  ``kind`` is one of
+    ``tag``, ``author``, ``month`` or ``archive``.
+    """
+
+    return 'listing_%s_%s' % (kind, value)
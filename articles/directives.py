@@ -34,41 +34,101 @@ Look at the `directive documentation`_ to get all the gory details.
 :license: BSD, see LICENSE for more details.
 """
 
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.cache import cache
+
+from articles.caching import make_key
+
 # Options
 # ~~~~~~~
 
 # Set to True if you want inline CSS styles instead of classes
 INLINESTYLES = False
 
-try:
-    from pygments.formatters import HtmlFormatter
+# The default formatter and name -> formatter pairs for every variant you want
+# to use; both are filled in by register()
+DEFAULT = None
+VARIANTS = {}
 
-    # The default formatter
-    DEFAULT = HtmlFormatter(noclasses=INLINESTYLES)
+# How long, in seconds, highlighted code blocks are cached
+HIGHLIGHT_TIMEOUT = getattr(settings, 'ARTICLES_HIGHLIGHT_CACHE_TIMEOUT', 86400 * 7)
 
-    # Add name -> formatter pairs for every variant you want to use
-    VARIANTS = {
-        'linenos': HtmlFormatter(noclasses=INLINESTYLES, linenos=True),
-    }
+_registered = False
 
-    from docutils import nodes
-    from docutils.parsers.rst import directives
+# lexer name -> lexer instance
+_lexers = {}
 
-    from pygments import highlight
-    from pygments.lexers import get_lexer_by_name, TextLexer
+# how often highlighted code was found in the cache, for instrumentation
+stats = {'hits': 0, 'misses': 0}
+
+def get_lexer(name):
+    """Returns a shared lexer for ``name``, falling back to plain text"""
+
+    lexer = _lexers.get(name)
+    if lexer is None:
+        from pygments.lexers import get_lexer_by_name, TextLexer
 
-    def pygments_directive(name, arguments, options, content, lineno,
-                        content_offset, block_text, state, state_machine):
         try:
-            lexer = get_lexer_by_name(arguments[0])
+            lexer = get_lexer_by_name(name)
         except ValueError:
             # no lexer found - use the text one instead of an exception
             lexer = TextLexer()
-        # take an arbitrary option if more than one is given
-        formatter = options and VARIANTS[options.keys()[0]] or DEFAULT
-        parsed = highlight(u'\n'.join(content), lexer, formatter)
-        parsed = '<div class="codeblock">%s</div>' % parsed
-        return [nodes.raw('', parsed, format='html')]
+        _lexers[name] = lexer
+
+    return lexer
+
+def highlight(code, lexer_name, variant):
+    """Highlights ``code``, reusing the result for code seen before"""
+
+    from pygments import __version__
+
+    key = make_key('highlight', __version__, INLINESTYLES, lexer_name, variant,
+                   sha1(code.encode('utf-8')).hexdigest())
+    parsed = cache.get(key)
+    if parsed is not None:
+        stats['hits'] += 1
+        return parsed
+
+    from pygments import highlight
+
+    stats['misses'] += 1
+    formatter = VARIANTS.get(variant, DEFAULT)
+    parsed = highlight(code, get_lexer(lexer_name), formatter)
+    cache.set(key, parsed, HIGHLIGHT_TIMEOUT)
+    return parsed
+
+def pygments_directive(name, arguments, options, content, lineno,
+                    content_offset, block_text, state, state_machine):
+    from docutils import nodes
+
+    # take an arbitrary option if more than one is given
+    variant = options and options.keys()[0] or None
+    parsed = highlight(u'\n'.join(content), arguments[0], variant)
+    parsed = '<div class="codeblock">%s</div>' % parsed
+    return [nodes.raw('', parsed, format='html')]
+
+def register():
+    """
+    Registers the directive with docutils.  Pygments and docutils are only
+    imported here, the first time reStructuredText is rendered.
+    """
+
+    global DEFAULT, _registered
+    if _registered:
+        return
+    _registered = True
+
+    try:
+        from pygments.formatters import HtmlFormatter
+        from docutils.parsers.rst import directives
+    except ImportError:
+        # the user probably doesn't have pygments installed
+        return
+
+    DEFAULT = HtmlFormatter(noclasses=INLINESTYLES)
+    VARIANTS['linenos'] = HtmlFormatter(noclasses=INLINESTYLES, linenos=True)
 
     pygments_directive.arguments = (1, 0, 1)
     pygments_directive.content = 1
@@ -79,8 +139,3 @@ try:
     # create an alias, so we can use it with rst2pdf... leave the other for
     # backwards compatibility
     directives.register_directive('code-block', pygments_directive)
-except:
-    # the user probably doesn't have pygments installed
-    pass
-
-
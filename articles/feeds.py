@@ -1,26 +1,100 @@
+from calendar import timegm
+import logging
+import re
+
 from django.conf import settings
 from django.contrib.syndication.views import Feed, FeedDoesNotExist
 from django.contrib.sites.models import Site
 from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse
+from django.utils.cache import patch_vary_headers
 from django.utils.feedgenerator import Atom1Feed
+from django.utils.http import http_date
+from django.utils.text import compress_string
 from django.utils.translation import ugettext_lazy as _
 
+from articles.caching import get_version, make_key
 from articles.models import Article, Tag
 
 # default to 24 hours for feed caching
 FEED_TIMEOUT = getattr(settings, 'ARTICLE_FEED_TIMEOUT', 86400)
 
+ACCEPTS_GZIP_RE = re.compile(r'\bgzip\b')
+
+log = logging.getLogger('articles.feeds')
+
 class SiteMixin(object):
 
     @property
     def site(self):
-        if not hasattr(self, '_site'):
-            self._site = Site.objects.get_current()
+        # the feeds are shared by every site served by this process; Django
+        # caches the current site anyway
+        return Site.objects.get_current()
+
+class PrebuiltFeedMixin(object):
+    """
+    Stores the finished feed document, both plain and gzip-compressed, in the
+    cache.  The document is only rebuilt when the set of articles changes, so
+    serving a feed is a cache lookup and a write.
+    """
+
+    def __call__(self, request, *args, **kwargs):
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404('Feed object does not exist.')
+
+        body = cache.get(self.body_key(request, obj))
+        if body is None:
+            body = self.build(request, obj)
+
+        gzipped = ACCEPTS_GZIP_RE.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if gzipped:
+            response = HttpResponse(body['gzip'], content_type=body['mime_type'])
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(body['plain'], content_type=body['mime_type'])
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if body['last_modified']:
+            response['Last-Modified'] = body['last_modified']
+
+        return response
+
+    def body_key(self, request, obj):
+        """Determines where the feed document for ``obj`` is cached"""
+
+        return make_key('feed', self.__class__.__name__, request.path,
+                        request.is_secure() and 'https' or 'http',
+                        get_version('articles'), get_version('tags'))
+
+    def build(self, request, obj):
+        """Renders the feed document for ``obj`` and caches it"""
+
+        log.debug('Building %s for %s' % (self.__class__.__name__, request.path))
+        feedgen = self.get_feed(obj, request)
+        plain = feedgen.writeString('utf-8')
+        if isinstance(plain, unicode):
+            plain = plain.encode('utf-8')
+
+        last_modified = None
+        if hasattr(self, 'item_pubdate'):
+            latest = feedgen.latest_post_date()
+            last_modified = http_date(timegm(latest.utctimetuple()))
+
+        body = {
+            'mime_type': feedgen.mime_type,
+            'plain': plain,
+            'gzip': compress_string(plain),
+            'last_modified': last_modified,
+        }
+        cache.set(self.body_key(request, obj), body, FEED_TIMEOUT)
 
-        return self._site
+        return body
 
-class LatestEntries(Feed, SiteMixin):
+class LatestEntries(PrebuiltFeedMixin, Feed, SiteMixin):
 
     description_template = 'feeds/latest_description.html'
 
@@ -34,7 +108,7 @@ class LatestEntries(Feed, SiteMixin):
         return _(u"Last articles in site %(site)s" % {'site' : self.site.name} )
 
     def items(self):
-        key = 'latest_articles'
+        key = make_key('latest_articles', get_version('articles'))
         articles = cache.get(key)
 
         if articles is None:
@@ -49,7 +123,7 @@ class LatestEntries(Feed, SiteMixin):
     def item_pubdate(self, item):
         return item.publish_date
 
-class TagFeed(Feed, SiteMixin):
+class TagFeed(PrebuiltFeedMixin, Feed, SiteMixin):
 
     description_template = 'feeds/tags_description.html'
 
@@ -72,11 +146,11 @@ class TagFeed(Feed, SiteMixin):
         return self.item_set(obj)[:10]
 
     def item_set(self, obj):
-        key = 'articles_for_%s' % obj.name
+        key = make_key('articles_for', obj.slug, get_version('articles'))
         articles = cache.get(key)
 
         if articles is None:
-            articles = list(Article.objects.filter(tags__slug__in=[obj.slug]).distinct().order_by('-publish_date'))
+            articles = list(Article.objects.live().filter(tags__slug=obj.slug).distinct().order_by('-publish_date'))
             cache.set(key, articles, FEED_TIMEOUT)
 
         return articles
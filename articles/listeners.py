@@ -1,9 +1,12 @@
 import logging
 
 from django.db.models import signals, Q
+from django.utils.timezone import is_aware, localtime
 
 from decorators import logtime
-from articles.models import Article, Tag
+from articles.autocomplete import tag_index
+from articles.caching import article_version_name, bump_version, listing_version_name
+from articles.models import Article, ArticleStatus, Attachment, Tag, USE_TAGGIT
 
 log = logging.getLogger('articles.listeners')
 
@@ -32,3 +35,215 @@ def apply_new_tag(sender, instance, created, using='default', **kwargs):
         article.save()
 
 signals.post_save.connect(apply_new_tag, sender=Tag)
+
+def is_done(kwargs):
+    # m2m_changed fires before and after each change; only act once
+    return kwargs.get('action', 'post_').startswith('post_')
+
+def articles_changed(sender, **kwargs):
+    """Invalidates cached data that depends on the set of live articles"""
+
+    if is_done(kwargs):
+        bump_version('articles')
+
+def bump_articles(ids):
+    """Invalidates the cached HTML of the specified articles"""
+
+    bump_version(*[article_version_name(pk) for pk in ids if pk])
+
+def get_neighbor_ids(article, publish_date=None):
+    """
+    Finds the articles whose pages link to ``article``, as if it were
+    published on ``publish_date`` when that's given
+    """
+
+    if publish_date is None:
+        publish_date = article.publish_date
+
+    ids = set()
+    for related in (article.followups, article.followup_for, article.related_articles):
+        ids.update(related.values_list('pk', flat=True))
+
+    live = Article.objects.live().exclude(pk=article.pk)
+    for nearest in (live.filter(publish_date__gte=publish_date).order_by('publish_date'),
+                    live.filter(publish_date__lte=publish_date).order_by('-publish_date')):
+        ids.update(nearest.values_list('pk', flat=True)[:1])
+
+    return ids
+
+def get_publish_state(article):
+    return (article.publish_date, article.expiration_date, article.is_active, article.status_id)
+
+def remember_publish_state(sender, instance, **kwargs):
+    instance._publish_state = get_publish_state(instance)
+    instance._listing_state = (instance.author_id, instance.publish_date)
+
+def remember_neighbors(sender, instance, **kwargs):
+    """
+    Finds the articles linking to an article before it moves or goes
+    offline, while they can still be found
+    """
+
+    original = getattr(instance, '_publish_state', None)
+    if instance.pk and original and original != get_publish_state(instance):
+        instance._neighbor_ids = get_neighbor_ids(instance, original[0])
+
+def article_removed(sender, instance, **kwargs):
+    """Invalidates the cached HTML of the articles linking to a deleted article"""
+
+    bump_articles(get_neighbor_ids(instance) | set([instance.pk]))
+
+def get_listing_names(author_id, publish_date):
+    names = [listing_version_name('archive'), listing_version_name('author', author_id)]
+    if publish_date:
+        if is_aware(publish_date):
+            # the month pages are split in local time, like get_date_range
+            publish_date = localtime(publish_date)
+        names.append(listing_version_name('month', '%s_%s' % (publish_date.year, publish_date.month)))
+
+    return names
+
+def purge_listings(sender, instance, **kwargs):
+    """
+    Invalidates the cached listing pages that show an article: the main
+    archive and the pages for its author, month and tags, both before and
+    after the change.
+    """
+
+    names = set(get_listing_names(instance.author_id, instance.publish_date))
+    original = getattr(instance, '_listing_state', None)
+    if original:
+        names.update(get_listing_names(*original))
+
+    if instance.pk:
+        names.update(listing_version_name('tag', pk) for pk in instance.tags.values_list('pk', flat=True))
+
+    bump_version(*names)
+    instance._listing_state = (instance.author_id, instance.publish_date)
+
+def purge_tag_listings(sender, instance, **kwargs):
+    """Invalidates the cached listing pages of tags applied or removed"""
+
+    action = kwargs.get('action', 'post_')
+    if USE_TAGGIT:
+        # the instance is taggit's TaggedItem
+        ids = [instance.tag_id]
+    elif isinstance(instance, Tag):
+        ids = [instance.pk]
+    elif action == 'pre_clear':
+        ids = instance.tags.values_list('pk', flat=True)
+    else:
+        ids = kwargs['pk_set'] or []
+
+    if action.startswith('post_') or action == 'pre_clear':
+        bump_version(*[listing_version_name('tag', pk) for pk in ids])
+
+def article_saved(sender, instance, created, **kwargs):
+    """
+    Invalidates cached data that depends on the articles, and on when and
+    whether they are published
+    """
+
+    articles_changed(sender, **kwargs)
+    bump_articles(set([instance.pk]) | get_neighbor_ids(instance) | getattr(instance, '_neighbor_ids', set()))
+    instance._neighbor_ids = set()
+
+    state = get_publish_state(instance)
+    if created or getattr(instance, '_publish_state', None) != state:
+        bump_version('publishing')
+    instance._publish_state = state
+
+def publishing_changed(sender, **kwargs):
+    articles_changed(sender, **kwargs)
+    bump_version('publishing')
+
+def articles_updated(queryset):
+    """Invalidates cached data after a bulk update, which sends no signals"""
+
+    publishing_changed(Article)
+    for article in queryset:
+        purge_listings(Article, article)
+        bump_articles(get_neighbor_ids(article) | set([article.pk]))
+
+def tags_changed(sender, **kwargs):
+    """Invalidates cached data that depends on tags and how often they're used"""
+
+    if is_done(kwargs):
+        bump_version('tags')
+        tag_index.invalidate()
+
+def tag_renamed(sender, instance, **kwargs):
+    """Invalidates the cached HTML of the articles showing a tag"""
+
+    if instance.pk:
+        bump_articles(Article.objects.filter(tags__in=[instance]).values_list('pk', flat=True))
+
+def article_tags_changed(sender, instance, **kwargs):
+    articles_changed(sender, **kwargs)
+    tags_changed(sender, **kwargs)
+
+    if USE_TAGGIT:
+        # the instance is taggit's TaggedItem
+        bump_articles([instance.object_id])
+    else:
+        article_relations_changed(sender, instance, **kwargs)
+
+def article_relations_changed(sender, instance, action, model, pk_set, **kwargs):
+    """Invalidates the cached HTML of articles on either end of an M2M change"""
+
+    if model is Article and action == 'pre_clear' and isinstance(instance, Article):
+        # this is the last chance to find out what was on the other end
+        bump_articles(get_neighbor_ids(instance))
+
+    if not action.startswith('post_'):
+        return
+
+    if isinstance(instance, Article):
+        bump_articles([instance.pk])
+
+    if model is Article and pk_set:
+        bump_articles(pk_set)
+
+def article_sites_changed(sender, instance, **kwargs):
+    """Site changes move articles in and out of each site's listings"""
+
+    article_relations_changed(sender, instance, **kwargs)
+    if is_done(kwargs):
+        publishing_changed(sender)
+        if isinstance(instance, Article):
+            purge_listings(Article, instance)
+        elif kwargs.get('pk_set'):
+            for article in Article.objects.filter(pk__in=kwargs['pk_set']):
+                purge_listings(Article, article)
+
+def attachment_changed(sender, instance, **kwargs):
+    bump_articles([instance.article_id])
+
+signals.post_init.connect(remember_publish_state, sender=Article)
+signals.pre_save.connect(remember_neighbors, sender=Article)
+signals.post_save.connect(article_saved, sender=Article)
+signals.pre_delete.connect(article_removed, sender=Article)
+signals.post_delete.connect(publishing_changed, sender=Article)
+signals.post_save.connect(purge_listings, sender=Article)
+signals.pre_delete.connect(purge_listings, sender=Article)
+signals.post_save.connect(publishing_changed, sender=ArticleStatus)
+signals.post_delete.connect(publishing_changed, sender=ArticleStatus)
+signals.post_save.connect(tags_changed, sender=Tag)
+signals.post_delete.connect(tags_changed, sender=Tag)
+signals.post_save.connect(tag_renamed, sender=Tag)
+signals.pre_delete.connect(tag_renamed, sender=Tag)
+signals.post_save.connect(attachment_changed, sender=Attachment)
+signals.post_delete.connect(attachment_changed, sender=Attachment)
+signals.m2m_changed.connect(article_relations_changed, sender=Article.followup_for.through)
+signals.m2m_changed.connect(article_relations_changed, sender=Article.related_articles.through)
+signals.m2m_changed.connect(article_sites_changed, sender=Article.sites.through)
+
+if USE_TAGGIT:
+    # taggit doesn't send m2m_changed, so watch its through model instead
+    signals.post_save.connect(article_tags_changed, sender=Article.tags.through)
+    signals.post_delete.connect(article_tags_changed, sender=Article.tags.through)
+    signals.post_save.connect(purge_tag_listings, sender=Article.tags.through)
+    signals.post_delete.connect(purge_tag_listings, sender=Article.tags.through)
+else:
+    signals.m2m_changed.connect(article_tags_changed, sender=Article.tags.through)
+    signals.m2m_changed.connect(purge_tag_listings, sender=Article.tags.through)
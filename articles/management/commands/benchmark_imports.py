@@ -0,0 +1,55 @@
+from optparse import make_option
+import os
+import subprocess
+import sys
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+# each snippet runs in a fresh interpreter and prints how long it took
+SNIPPETS = (
+    ('articles.models',
+     'import articles.models'),
+    ('articles.models, markup loaded up front',
+     'import articles.models\n'
+     'from articles import directives, renderers\n'
+     'directives.register()\n'
+     'for markup in renderers.RENDERERS:\n'
+     '    renderers.get_renderer(markup)'),
+)
+
+TEMPLATE = """import time
+started = time.time()
+%s
+print time.time() - started
+"""
+
+class Command(NoArgsCommand):
+    help = """Measures how long it takes to import the articles app, with and without loading the markup libraries"""
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--repeat', dest='repeat', type='int', default=10, help='Number of fresh interpreters to time each import in'),
+    )
+
+    def handle_noargs(self, **opts):
+        repeat = opts['repeat']
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        if 'DJANGO_SETTINGS_MODULE' not in env:
+            raise CommandError('DJANGO_SETTINGS_MODULE must be set')
+
+        results = []
+        for label, snippet in SNIPPETS:
+            timings = sorted(self.time_import(snippet, env) for i in range(repeat))
+            median = timings[len(timings) // 2]
+            results.append(median)
+            self.stdout.write('%s: median %.1fms, best %.1fms' % (label, median * 1000, timings[0] * 1000))
+
+        self.stdout.write('Loading markup lazily saves %.1fms at startup' % ((results[1] - results[0]) * 1000,))
+
+    def time_import(self, snippet, env):
+        process = subprocess.Popen([sys.executable, '-c', TEMPLATE % snippet], env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if process.returncode:
+            raise CommandError(err)
+
+        return float(out.strip().splitlines()[-1])
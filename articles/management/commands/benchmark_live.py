@@ -0,0 +1,185 @@
+from datetime import timedelta
+from optparse import make_option
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connections
+from django.utils.timezone import now
+
+from articles.models import Article, ArticleStatus, get_date_range
+
+ALIAS = 'articles_benchmark'
+BATCH_SIZE = 10000
+
+class Command(NoArgsCommand):
+    help = """Prints the query plans and timings of the live() queries on a synthetic SQLite corpus"""
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rows', dest='rows', type='int', default=1000000, help='Number of articles to generate'),
+        make_option('--repeat', dest='repeat', type='int', default=5, help='Number of times to run each query'),
+        make_option('--database', dest='path', default=None, help='SQLite file to use; it is filled only if it has no articles yet'),
+    )
+
+    def handle_noargs(self, **opts):
+        path = opts['path']
+        remove = path is None
+        if remove:
+            handle, path = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(handle)
+
+        connections.databases[ALIAS] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': path,
+        }
+        connection = connections[ALIAS]
+
+        try:
+            existing = self.create_tables(connection)
+            if not existing:
+                self.populate(connection, opts['rows'])
+
+            self.stdout.write('Benchmarking against %s articles in %s' % (Article.objects.using(ALIAS).count(), path))
+            for label, queryset in self.get_querysets():
+                self.benchmark(connection, label, queryset.using(ALIAS), opts['repeat'])
+        finally:
+            connection.close()
+            del connections.databases[ALIAS]
+            # connections keeps the wrapper too, separately for each thread
+            if hasattr(connections._connections, ALIAS):
+                delattr(connections._connections, ALIAS)
+            if remove:
+                os.remove(path)
+
+    def create_tables(self, connection):
+        """Creates the article tables and indexes, unless they already exist"""
+
+        cursor = connection.cursor()
+        if Article._meta.db_table in connection.introspection.table_names(cursor):
+            return Article.objects.using(ALIAS).exists()
+
+        style = no_style()
+        known = set()
+        for model in (ArticleStatus, Article):
+            statements, pending = connection.creation.sql_create_model(model, style, known)
+            statements.extend(connection.creation.sql_indexes_for_model(model, style))
+            for sql in statements:
+                cursor.execute(sql)
+            known.add(model)
+
+        return False
+
+    def populate(self, connection, rows):
+        """
+        Fills the database with articles spread over the last ten years.  Most
+        are live, some are inactive, in draft, expired or scheduled.
+        """
+
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+        status = ArticleStatus._meta.db_table
+        cursor.execute('INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % (
+            qn(status), qn('name'), qn('ordering'), qn('is_live')), ['Draft', 0, False])
+        cursor.execute('INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % (
+            qn(status), qn('name'), qn('ordering'), qn('is_live')), ['Finished', 1, True])
+        cursor.execute('SELECT id FROM %s ORDER BY id' % qn(status))
+        draft, finished = [pk for pk, in cursor.fetchall()]
+
+        fields = [f for f in Article._meta.local_fields if f is not Article._meta.pk]
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(Article._meta.db_table),
+            ', '.join(qn(f.column) for f in fields),
+            ', '.join(['%s'] * len(fields)))
+
+        # everything not generated below keeps the field's default
+        generated = ('title', 'slug', 'status_id', 'author_id', 'content', 'rendered_content',
+                     'publish_date', 'publish_year', 'expiration_date', 'is_active', 'is_live')
+        defaults = {}
+        for f in fields:
+            if f.attname not in generated:
+                value = f.get_db_prep_save(f.get_default(), connection)
+                if value is None and not f.null:
+                    value = ''
+                defaults[f.attname] = value
+
+        started = time.time()
+        today = now().replace(tzinfo=None)
+        random.seed(rows)
+        batch = []
+        for i in xrange(rows):
+            publish_date = today - timedelta(minutes=random.randint(-30 * 1440, 3650 * 1440))
+            expiration_date = None
+            if random.random() < 0.1:
+                expiration_date = publish_date + timedelta(days=random.randint(1, 365))
+
+            is_live = random.random() < 0.9
+            values = {
+                'title': 'Article %s' % i,
+                'slug': 'article-%s' % i,
+                'status_id': is_live and finished or draft,
+                'author_id': 1,
+                'content': 'Content for article %s' % i,
+                'rendered_content': 'Content for article %s' % i,
+                'publish_date': connection.ops.value_to_db_datetime(publish_date),
+                'publish_year': publish_date.year,
+                'expiration_date': connection.ops.value_to_db_datetime(expiration_date),
+                'is_active': random.random() < 0.95,
+                'is_live': is_live,
+            }
+            values.update(defaults)
+            batch.append([values[f.attname] for f in fields])
+
+            if len(batch) == BATCH_SIZE:
+                cursor.executemany(sql, batch)
+                batch = []
+
+        if batch:
+            cursor.executemany(sql, batch)
+
+        cursor.execute('ANALYZE')
+        connection.commit_unless_managed()
+        self.stdout.write('Generated %s articles in %.1fs' % (rows, time.time() - started))
+
+    def get_querysets(self):
+        start, end = get_date_range(now().year - 1, 6)
+        joined = Article.objects.active().filter(status__is_live=True)
+        live = Article.objects.live()
+
+        return (
+            ('live(), joining the status', joined),
+            ('live(), using is_live', live),
+            ('month, joining the status', joined.filter(publish_date__gte=start, publish_date__lt=end)),
+            ('month, using is_live', live.filter(publish_date__gte=start, publish_date__lt=end)),
+        )
+
+    def benchmark(self, connection, label, queryset, repeat):
+        """Prints the plan and timings of a page of the listing and its count"""
+
+        self.stdout.write('')
+        self.stdout.write(label)
+        cursor = connection.cursor()
+        page = queryset[:20]
+        for name, query in (('page', page.query), ('count', page.query.clone())):
+            if name == 'count':
+                query.clear_limits()
+                query.clear_ordering(force_empty=True)
+                query.add_count_column()
+
+            sql, params = query.get_compiler(ALIAS).as_sql()
+            self.stdout.write('  %s plan:' % (name,))
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            for row in cursor.fetchall():
+                self.stdout.write('    %s' % (row[-1],))
+
+            timings = []
+            for i in range(repeat):
+                started = time.time()
+                cursor.execute(sql, params)
+                cursor.fetchall()
+                timings.append(time.time() - started)
+
+            self.stdout.write('  %s: best %.2fms, mean %.2fms' % (
+                name, min(timings) * 1000, sum(timings) / len(timings) * 1000))
@@ -0,0 +1,103 @@
+from optparse import make_option
+from timeit import default_timer
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from articles import renderers
+from articles.models import Article
+
+# used for markup types that no article in the database uses yet
+SAMPLES = {
+    renderers.MARKUP_HTML: """<h1>A header</h1>
+<p>Now is the time for all good men to come to the aid of their
+<a href="http://example.com/">country</a>.</p>
+<ul><li>one</li><li>two</li></ul>
+""",
+    renderers.MARKUP_MARKDOWN: """A header
+========
+
+Now is the time for *all* good men to come to the aid of their
+[country](http://example.com/).
+
+* one
+* two
+
+    print 'some code'
+""",
+    renderers.MARKUP_REST: """A header
+========
+
+Now is the time for *all* good men to come to the aid of their
+`country <http://example.com/>`_.
+
+* one
+* two
+
+.. sourcecode:: python
+
+    print 'some code'
+""",
+    renderers.MARKUP_TEXTILE: """h1. A header
+
+Now is the time for _all_ good men to come to the aid of their
+"country":http://example.com/.
+
+* one
+* two
+
+bc. print 'some code'
+""",
+}
+
+class Command(NoArgsCommand):
+    help = """Renders a sample corpus with each markup renderer and reports throughput and latency"""
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--count', dest='count', type='int', default=1000, help='Number of documents to render with each renderer'),
+        make_option('--markup', dest='markup', default=None, help='Comma-separated markup codes to benchmark; defaults to all of them'),
+    )
+
+    def handle_noargs(self, **opts):
+        count = opts['count']
+        if count < 1:
+            raise CommandError('--count must be at least 1')
+
+        codes = sorted(renderers.RENDERERS)
+        if opts['markup']:
+            codes = [c.strip() for c in opts['markup'].split(',') if c.strip()]
+
+        for code in codes:
+            corpus = self.get_corpus(code, count)
+            if not corpus:
+                self.stdout.write('%s: no articles or sample to render; skipped' % (code,))
+                continue
+
+            renderer = renderers.get_renderer(code)
+            # the first render may import the markup library
+            renderer.render(corpus[0])
+
+            timings = []
+            for text in corpus:
+                started = default_timer()
+                renderer.render(text)
+                timings.append(default_timer() - started)
+
+            total = sum(timings)
+            size = sum(len(text) for text in corpus)
+            timings.sort()
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            self.stdout.write('%s (%s): %s docs, %.0f docs/s, %.1f KB/s, mean %.2fms, p99 %.2fms' % (
+                code, renderer.__class__.__name__, len(corpus), len(corpus) / total,
+                size / 1024.0 / total, total / len(corpus) * 1000, p99 * 1000))
+
+    def get_corpus(self, code, count):
+        """Takes up to ``count`` articles using the markup, padded with samples"""
+
+        corpus = list(Article.objects.filter(markup=code).values_list('content', flat=True)[:count])
+        if not corpus and code in SAMPLES:
+            corpus = [SAMPLES[code]]
+
+        while corpus and len(corpus) < count:
+            corpus.extend(corpus[:count - len(corpus)])
+
+        return corpus
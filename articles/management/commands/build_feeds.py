@@ -0,0 +1,76 @@
+from multiprocessing.dummy import Pool
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import RequestFactory
+
+from articles.feeds import TagFeed, LatestEntries, TagFeedAtom, LatestEntriesAtom
+from articles.models import Tag
+
+class Command(NoArgsCommand):
+    help = """Pre-renders the RSS and Atom feeds so they can be served straight from the cache"""
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=4, help='Number of feeds to build at the same time'),
+        make_option('--secure', action='store_true', dest='secure', default=False, help='Build the feeds as they are served over HTTPS'),
+    )
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            self.stdout.write(message)
+
+    def handle_noargs(self, **opts):
+        self.verbosity = int(opts.get('verbosity', 1))
+        self.secure = opts['secure']
+
+        jobs = [
+            (LatestEntries(), reverse('articles_rss_feed_latest'), None),
+            (LatestEntriesAtom(), reverse('articles_atom_feed_latest'), None),
+        ]
+        for slug in Tag.objects.values_list('slug', flat=True):
+            if not slug:
+                continue
+
+            jobs.append((TagFeed(), reverse('articles_rss_feed_tag', args=[slug]), slug))
+            jobs.append((TagFeedAtom(), reverse('articles_atom_feed_tag', args=[slug]), slug))
+
+        workers = opts['workers']
+        if workers > 1:
+            pool = Pool(workers)
+            try:
+                built = sum(pool.map(self.build_feed_in_thread, jobs))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            built = sum(map(self.build_feed, jobs))
+
+        self.log('Built %s of %s feeds' % (built, len(jobs)), 1)
+
+    def build_feed(self, job):
+        """Renders and caches a single feed"""
+
+        feed, path, slug = job
+        extra = {}
+        if self.secure:
+            extra['wsgi.url_scheme'] = 'https'
+
+        try:
+            request = RequestFactory().get(path, **extra)
+            args = slug and [slug] or []
+            feed.build(request, feed.get_object(request, *args))
+        except Exception, err:
+            self.log('Failed to build %s: %s' % (path, err), 0)
+            return 0
+
+        self.log('Built %s' % (path,))
+        return 1
+
+    def build_feed_in_thread(self, job):
+        try:
+            return self.build_feed(job)
+        finally:
+            # each worker thread opens its own database connection
+            connection.close()
@@ -1,27 +1,64 @@
-from base64 import b64decode
+from binascii import a2b_base64, Error as Base64Error
+from bisect import bisect_left, insort
+from cStringIO import StringIO
 from datetime import datetime
-from email.parser import FeedParser
+from email.parser import HeaderParser
 from email.utils import parseaddr, parsedate
+from hashlib import sha1
+import imaplib
 from optparse import make_option
+import poplib
+import quopri
+import re
+import signal
 import socket
 import sys
+from tempfile import SpooledTemporaryFile
+import threading
 import time
+import traceback
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.files import File
 from django.core.management.base import BaseCommand
+from django.db import IntegrityError, connection, transaction
+from django.utils.encoding import force_bytes
 from django.utils.translation import ugettext_lazy as _
 
-from articles.models import Article, Attachment, MARKUP_HTML, MARKUP_MARKDOWN, MARKUP_REST, MARKUP_TEXTILE
+from articles.caching import make_key
+from articles.models import Article, Attachment, IngestedEmail, MailboxState, MARKUP_HTML, MARKUP_MARKDOWN, MARKUP_REST, MARKUP_TEXTILE
 
 MB_IMAP4 = 'IMAP4'
 MB_POP3 = 'POP3'
 ACCEPTABLE_TYPES = ('text/plain', 'text/html')
 
+# finds the UID and size of a message in an IMAP FETCH response
+UID_RE = re.compile(r'\bUID (\d+)')
+SIZE_RE = re.compile(r'\bRFC822\.SIZE (\d+)')
+
+# how many bytes of messages to download with each IMAP FETCH
+MAX_FETCH_SIZE = 10 * 1024 * 1024
+
+# how much of an attachment to decode at a time
+DECODE_BUFFER_SIZE = 1024 * 1024
+
+# what goes wrong when talking to a mail server
+MAIL_ERRORS = (socket.error, imaplib.IMAP4.error, poplib.error_proto)
+
+# seconds to wait before reconnecting after the first failure; doubles with
+# each failure after that
+RETRY_DELAY = 5
+
 class MailboxHandler(object):
 
-    def __init__(self, host, port, username, password, keyfile, certfile, ssl):
+    # whether new mail shows up without reconnecting
+    persistent = False
+
+    def __init__(self, host, port, username, password, keyfile, certfile, ssl, batch_size=50,
+                 max_fetch_size=MAX_FETCH_SIZE, max_attachment_size=None, attachment_spool_size=DECODE_BUFFER_SIZE):
         self.host = host
         self.port = port
         self.username = username
@@ -29,6 +66,10 @@ class MailboxHandler(object):
         self.keyfile = keyfile
         self.certfile = certfile
         self.ssl = ssl
+        self.batch_size = batch_size
+        self.max_fetch_size = max_fetch_size
+        self.max_attachment_size = max_attachment_size
+        self.attachment_spool_size = attachment_spool_size
         self._handle = None
 
         if self.port is None:
@@ -64,16 +105,20 @@ class MailboxHandler(object):
         return self._handle
 
     def parse_email(self, message):
-        """Parses each email message"""
+        """Parses an email message, from a string or a file"""
 
-        fp = FeedParser()
-        fp.feed(message)
-        return fp.close()
+        if isinstance(message, basestring):
+            message = StringIO(message)
+
+        parser = MessageParser(self.max_attachment_size, self.attachment_spool_size)
+        return parser.parse(message)
 
     def connect(self):
         raise NotImplemented
 
     def fetch(self):
+        """Yields an ``(id, message)`` pair for each message, one at a time"""
+
         raise NotImplemented
 
     def delete_messages(self, id_list):
@@ -85,11 +130,31 @@ class MailboxHandler(object):
     def delete_message(self, msg_id):
         raise NotImplemented
 
+    def checkpoint(self):
+        """Remembers that the fetched messages have been processed"""
+
+        pass
+
+    def idle(self, timeout):
+        """
+        Waits up to ``timeout`` seconds for new mail to arrive.  Returns False
+        straight away if the server can't tell.
+        """
+
+        return False
+
+    def interrupt(self):
+        """Wakes up an ``idle`` in another thread"""
+
+        pass
+
     def disconnect(self):
         raise NotImplemented
 
 class IMAPHandler(MailboxHandler):
 
+    persistent = True
+
     @property
     def secure_port(self):
         return 993
@@ -112,27 +177,218 @@ class IMAPHandler(MailboxHandler):
 
             M.login(self.username, self.password)
             M.select()
+
+            # UIDs can only be compared while the mailbox keeps this value
+            validity = M.response('UIDVALIDITY')[1][0]
+            self.uid_validity = validity and int(validity) or None
         except socket.error, err:
             raise
         else:
             return M
 
+    @property
+    def state(self):
+        """The last UID seen in this mailbox, as of the previous run"""
+
+        if not hasattr(self, '_state'):
+            name = '%s@%s:%s/INBOX' % (self.username, self.host, self.port)
+            self._state, created = MailboxState.objects.get_or_create(mailbox=name)
+
+        return self._state
+
     def fetch(self):
-        """Fetches email messages from an IMAP4 server"""
+        """
+        Fetches the email messages that arrived on an IMAP4 server since the
+        last run, with their UIDs
+        """
+
+        M = self.handle
+        state = self.state
+        if self.uid_validity != state.uid_validity:
+            # the server renumbered the mailbox, so start over
+            state.uid_validity = self.uid_validity
+            state.last_uid = 0
+
+        # "n:*" always matches the newest message, even if it's older than n
+        typ, data = M.uid('SEARCH', None, 'UID %s:*' % (state.last_uid + 1,))
+        uids = [uid for uid in data[0].split() if int(uid) > state.last_uid]
+
+        self._last_uid = state.last_uid
+        missed = False
+        for i in range(0, len(uids), self.batch_size):
+            batch = uids[i:i + self.batch_size]
+            sizes = self.get_sizes(batch)
+            fetched = set()
+            for group in self.group_by_size(batch, sizes):
+                if sizes[group[0]] > self.max_fetch_size:
+                    message = self.fetch_in_pieces(group[0], sizes[group[0]])
+                    if message is not None:
+                        fetched.add(group[0])
+                        yield group[0], message
+                    continue
+
+                typ, data = M.uid('FETCH', ','.join(group), '(UID RFC822)')
+                for uid, message in self.parse_fetch(data):
+                    fetched.add(uid)
+                    yield uid, message
+
+            # only move past the messages that came back with their UID, so
+            # one the server left out, or labelled in a way we couldn't
+            # read, is fetched again next time instead of skipped for good
+            for uid in batch:
+                missed = missed or uid not in fetched
+                if not missed:
+                    self._last_uid = int(uid)
+
+    def get_sizes(self, uids):
+        """Finds out how big each message is, in bytes, by UID"""
+
+        typ, data = self.handle.uid('FETCH', ','.join(uids), '(UID RFC822.SIZE)')
+        sizes = {}
+        for part in data:
+            if isinstance(part, tuple):
+                part = part[0]
+            uid, size = part and UID_RE.search(part), part and SIZE_RE.search(part)
+            if uid and size:
+                sizes[uid.group(1)] = int(size.group(1))
+
+        return sizes
+
+    def group_by_size(self, uids, sizes):
+        """
+        Splits a batch of UIDs into groups of messages that add up to no more
+        than ``max_fetch_size`` bytes.  A message bigger than that is fetched
+        on its own, and one the server doesn't know the size of is left out.
+        """
+
+        group, total = [], 0
+        for uid in uids:
+            if uid not in sizes:
+                continue
+
+            if group and total + sizes[uid] > self.max_fetch_size:
+                yield group
+                group, total = [], 0
+
+            group.append(uid)
+            total += sizes[uid]
+
+        if group:
+            yield group
+
+    def fetch_in_pieces(self, uid, size):
+        """
+        Downloads a message too big to fetch at once ``max_fetch_size`` bytes
+        at a time, into a temporary file, and parses it from there.  Returns
+        None if the message is gone.
+        """
+
+        raw = SpooledTemporaryFile(max_size=self.max_fetch_size)
+        try:
+            for offset in range(0, size, self.max_fetch_size):
+                typ, data = self.handle.uid('FETCH', uid, '(UID BODY.PEEK[]<%s.%s>)' % (offset, self.max_fetch_size))
+                pieces = [part[1] for part in data if isinstance(part, tuple)]
+                if not pieces:
+                    return None
+
+                raw.write(pieces[0])
+                data = pieces = None
+
+            raw.seek(0)
+            return self.parse_email(raw)
+        finally:
+            raw.close()
+
+    def parse_fetch(self, data):
+        """
+        Parses the messages in the response to a UID FETCH command, one at a
+        time, letting go of each raw message once it's parsed
+        """
+
+        pending = None
+        for i, part in enumerate(data):
+            data[i] = None
+            if isinstance(part, tuple):
+                header, body = part
+                # nothing but the parsed message may outlive this iteration
+                part = None
+                pending = self.parse_email(body)
+                body = None
+                # servers may send the UID before or after the message
+                match = UID_RE.search(header)
+            elif pending is not None and part:
+                match = UID_RE.search(part)
+            else:
+                continue
 
-        messages = {}
+            if match:
+                message, pending = pending, None
+                yield match.group(1), message
 
-        typ, data = self.handle.search(None, 'ALL')
-        for num in data[0].split():
-            typ, data = self.handle.fetch(num, '(RFC822)')
-            messages[num] = self.parse_email(data[0][1])
+    def delete_messages(self, id_list):
+        """Deletes a list of messages from the server with a single command"""
 
-        return messages
+        self.handle.uid('STORE', ','.join(id_list), '+FLAGS', '(\\Deleted)')
+        self.handle.expunge()
 
     def delete_message(self, msg_id):
         """Deletes a message from the server"""
 
-        self.handle.store(msg_id, '+FLAGS', '\\Deleted')
+        self.handle.uid('STORE', msg_id, '+FLAGS', '(\\Deleted)')
+
+    def checkpoint(self):
+        """Skips the fetched messages on the next run, whether used or not"""
+
+        last_uid = getattr(self, '_last_uid', None)
+        if last_uid is not None and last_uid != self.state.last_uid:
+            self.state.last_uid = last_uid
+            self.state.save()
+
+    def idle(self, timeout):
+        """Waits for new mail with the IDLE command, if the server supports it"""
+
+        M = self.handle
+        if 'IDLE' not in M.capabilities:
+            return False
+
+        # imaplib doesn't know about IDLE, so talk to the server directly
+        tag = M._new_tag()
+        M.send('%s IDLE\r\n' % (tag,))
+        if not M.readline().startswith('+'):
+            raise M.error('The server refused to IDLE')
+
+        sock = getattr(M, 'sslobj', None) or M.sock
+        sock.settimeout(timeout)
+        try:
+            # whatever the server says, the mailbox changed
+            M.readline()
+        except socket.timeout:
+            pass
+        finally:
+            sock.settimeout(None)
+
+        M.send('DONE\r\n')
+        while True:
+            line = M.readline()
+            if not line:
+                raise M.abort('The connection closed while idle')
+            elif line.startswith(tag):
+                break
+
+        return True
+
+    def interrupt(self):
+        """Wakes up an ``idle`` in another thread by shutting the connection down"""
+
+        sock = getattr(self._handle, 'sock', None)
+        if sock is None:
+            return
+
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # it's closed already
+            pass
 
     def disconnect(self):
         """Closes the IMAP4 handle"""
@@ -171,27 +427,219 @@ class POPHandler(MailboxHandler):
             return M
 
     def fetch(self):
-        """Fetches email messages from a POP3 server"""
-
-        messages = {}
-
+        """
+        Fetches email messages from a POP3 server, with their numbers in the
+        first session.  Each checkpoint starts a new session, where the
+        messages left are numbered from 1 again, so the numbers are only
+        translated when a message is retrieved or deleted.
+        """
+
+        self._removed = []
+        self._marked = []
         num = len(self.handle.list()[1])
-        for i in range(num):
-            message = '\n'.join([msg for msg in self.handle.retr(i + 1)[1]])
-            messages[num] = self.parse_email(message)
-
-        return messages
+        for i in range(1, num + 1):
+            raw = self.retrieve(self.session_number(i))
+            try:
+                email = self.parse_email(raw)
+            finally:
+                raw.close()
+            yield i, email
+
+    def session_number(self, msg_id):
+        """
+        Turns the number a message had in the first session into its number
+        in the current one, leaving out the messages removed since
+        """
+
+        return msg_id - bisect_left(getattr(self, '_removed', []), msg_id)
+
+    def retrieve(self, msg_num):
+        """
+        Downloads a message into a temporary file a line at a time, instead
+        of into a list of lines like ``poplib.POP3.retr``
+        """
+
+        M = self.handle
+        raw = SpooledTemporaryFile(max_size=self.max_fetch_size)
+        M._putcmd('RETR %s' % (msg_num,))
+        M._getresp()
+        line, length = M._getline()
+        while line != '.':
+            # lines starting with a dot have it doubled
+            if line.startswith('..'):
+                line = line[1:]
+            raw.write(line + '\n')
+            line, length = M._getline()
+
+        raw.seek(0)
+        return raw
 
     def delete_message(self, msg_id):
-        """Deletes a message from the server"""
-
-        self.handle.dele(msg_id)
+        """Marks a message for deletion when the session ends"""
+
+        self.handle.dele(self.session_number(msg_id))
+        self._marked = getattr(self, '_marked', [])
+        self._marked.append(msg_id)
+
+    def checkpoint(self):
+        """
+        Ends the session, which is when a POP3 server actually deletes the
+        messages marked so far.  The next command starts a new session.
+        """
+
+        if getattr(self, '_marked', None) and self._handle is not None:
+            handle, self._handle = self._handle, None
+            handle.quit()
+            self._removed = getattr(self, '_removed', [])
+            for msg_id in self._marked:
+                insort(self._removed, msg_id)
+            self._marked = []
 
     def disconnect(self):
         """Closes the POP3 handle"""
 
         self.handle.quit()
 
+class MailboxPoller(threading.Thread):
+    """
+    Checks one mailbox for articles.  In daemon mode each mailbox gets a
+    thread of its own, which keeps its connection open, waits for new mail
+    with IDLE where the server supports it, and backs off when the server
+    can't be reached.
+    """
+
+    def __init__(self, command, config):
+        super(MailboxPoller, self).__init__(name='%s@%s' % (config['user'], config['host']))
+        self.daemon = True
+        self.command = command
+        self.config = config
+        self.handle = None
+        self.failures = 0
+        self.stopping = threading.Event()
+        self.stats = {
+            'started': time.time(),
+            'checks': 0,
+            'failures': 0,
+            'fetched': 0,
+            'created': 0,
+            'latency': 0.0,
+            'last_latency': None,
+        }
+
+    def get_handle(self):
+        if self.handle is None:
+            c = self.config
+            self.handle = MailboxHandler.get_handle(c['protocol'], c['host'], c['port'], c['user'], c['password'],
+                                                    c['keyfile'], c['certfile'], c['ssl'], c['batch_size'],
+                                                    max_fetch_size=c.get('max_fetch_size', MAX_FETCH_SIZE),
+                                                    max_attachment_size=c.get('max_attachment_size', None),
+                                                    attachment_spool_size=c.get('attachment_spool_size', DECODE_BUFFER_SIZE))
+
+        return self.handle
+
+    def poll(self):
+        """Checks the mailbox once, returning whether that worked"""
+
+        started = time.time()
+        try:
+            self.command.log('Checking %s' % (self.name,))
+            self.command.check_mailbox(self.get_handle(), self.config, self.stats)
+        except MAIL_ERRORS, err:
+            self.command.log('Failed to communicate with mail server %s (%s).  Please verify your settings.' % (self.name, err), 0)
+            self.fail()
+            return False
+        finally:
+            latency = time.time() - started
+            self.stats['checks'] += 1
+            self.stats['latency'] += latency
+            self.stats['last_latency'] = latency
+            cache.set(make_key('mailbox_stats', self.name), self.stats)
+
+        self.failures = 0
+        if not self.handle.persistent:
+            self.disconnect()
+
+        return True
+
+    def fail(self):
+        """Counts a failure, and starts over with a new connection"""
+
+        self.failures += 1
+        self.stats['failures'] += 1
+        self.disconnect()
+
+    def backoff(self):
+        """Seconds to wait after the latest run of failures"""
+
+        return min(RETRY_DELAY * 2 ** (self.failures - 1), self.config.get('max_backoff', 900))
+
+    def wait(self):
+        """Waits until the mailbox should be checked again"""
+
+        if self.failures:
+            delay = self.backoff()
+            self.command.log('Retrying %s in %s seconds' % (self.name, delay), 1)
+            self.stopping.wait(delay)
+            return
+
+        try:
+            if self.handle is not None and self.handle.idle(self.config.get('idle_timeout', 600)):
+                return
+        except MAIL_ERRORS, err:
+            self.command.log('Lost the connection to %s (%s)' % (self.name, err), 1)
+            self.disconnect()
+            return
+
+        self.stopping.wait(self.config['poll_interval'])
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.poll()
+                self.command.log(self.summary())
+                # don't hold on to a database connection between checks
+                connection.close()
+                if not self.stopping.is_set():
+                    self.wait()
+            except Exception, err:
+                # anything else would end the thread for good, so log it and
+                # back off as if the server had failed
+                self.command.log('Error checking %s (%s)' % (self.name, err), 0)
+                self.command.log(traceback.format_exc(), 2)
+                connection.close()
+                self.fail()
+                if not self.stopping.is_set():
+                    self.wait()
+
+        self.disconnect()
+
+    def stop(self):
+        self.stopping.set()
+        handle = self.handle
+        if handle is not None:
+            handle.interrupt()
+
+    def disconnect(self):
+        handle, self.handle = self.handle, None
+        if handle is None or handle._handle is None:
+            return
+
+        try:
+            handle.disconnect()
+            self.command.log('Disconnected.')
+        except MAIL_ERRORS:
+            # the connection is probably gone already
+            pass
+
+    def summary(self):
+        """Describes the latency and throughput of this mailbox so far"""
+
+        stats = self.stats
+        minutes = max(time.time() - stats['started'], 1) / 60.0
+        return '%s: %s checks, %s failures, %s messages fetched, %s articles created (%.2f/min), mean check %.2fs' % (
+            self.name, stats['checks'], stats['failures'], stats['fetched'], stats['created'],
+            stats['created'] / minutes, stats['latency'] / max(stats['checks'], 1))
+
 class Command(BaseCommand):
     help = "Checks special e-mail inboxes for emails that should be posted as articles"
 
@@ -204,6 +652,8 @@ class Command(BaseCommand):
         make_option('--username', dest='username', default=None, help='Username to authenticate with mail server'),
         make_option('--password', dest='password', default=None, help='Password to authenticate with mail server'),
         make_option('--ssl', action='store_true', dest='ssl', default=False, help='Use to specify that the connection must be made using SSL'),
+        make_option('--daemon', action='store_true', dest='daemon', default=False, help='Keep checking every configured mailbox until stopped'),
+        make_option('--interval', dest='interval', type='int', default=None, help='Seconds between checks of a mailbox that does not support IDLE, in daemon mode'),
     )
 
     def log(self, message, level=2):
@@ -215,48 +665,101 @@ class Command(BaseCommand):
 
         # retrieve configuration options--give precedence to CLI parameters
         self.config = getattr(settings, 'ARTICLES_FROM_EMAIL', {})
-        s = lambda k, d: self.config.get(k, d)
-
-        protocol = options['protocol'] or s('protocol', MB_IMAP4)
-        host = options['host'] or s('host', 'mail.yourhost.com')
-        port = options['port'] or s('port', None)
-        keyfile = options['keyfile'] or s('keyfile', None)
-        certfile = options['certfile'] or s('certfile', None)
-        username = options['username'] or s('user', None)
-        password = options['password'] or s('password', None)
-        ssl = options['ssl'] or s('ssl', False)
-
         self.verbosity = int(options.get('verbosity', 1))
 
-        handle = None
-        try:
-            self.log('Creating mailbox handle')
-            handle = MailboxHandler.get_handle(protocol, host, port, username, password, keyfile, certfile, ssl)
+        pollers = [MailboxPoller(self, config) for config in self.get_mailboxes(options)]
+        if not options.get('daemon'):
+            for poller in pollers:
+                poller.poll()
+                poller.disconnect()
+            return
 
-            self.log('Fetching messages')
-            messages = handle.fetch()
+        self.log('Polling %s mailboxes' % (len(pollers),), 1)
+        for poller in pollers:
+            poller.start()
 
-            if len(messages):
-                self.log('Creating articles')
-                created = self.create_articles(messages)
+        def stop(signum, frame):
+            for poller in pollers:
+                poller.stop()
+        signal.signal(signal.SIGTERM, stop)
 
-                if len(created):
-                    self.log('Deleting consumed messages')
-                    handle.delete_messages(created)
-                else:
-                    self.log('No articles created')
-            else:
-                self.log('No messages fetched')
-        except socket.error:
-            self.log('Failed to communicate with mail server.  Please verify your settings.', 0)
-        finally:
-            if handle:
-                try:
-                    handle.disconnect()
-                    self.log('Disconnected.')
-                except socket.error:
-                    # probably means we couldn't connect to begin with
-                    pass
+        try:
+            while any(poller.is_alive() for poller in pollers):
+                for poller in pollers:
+                    poller.join(1)
+        except KeyboardInterrupt:
+            stop(None, None)
+            for poller in pollers:
+                # a poller waiting on IDLE won't notice for a while, and its
+                # thread dies with the process anyway
+                poller.join(5)
+
+        for poller in pollers:
+            self.log(poller.summary(), 1)
+
+    def get_mailboxes(self, options):
+        """
+        Returns the settings of each mailbox to check.  Entries in the
+        ``mailboxes`` list override the rest of ``ARTICLES_FROM_EMAIL``.
+        """
+
+        s = lambda k, d: self.config.get(k, d)
+        default = dict(self.config,
+            protocol=options['protocol'] or s('protocol', MB_IMAP4),
+            host=options['host'] or s('host', 'mail.yourhost.com'),
+            port=options['port'] or s('port', None),
+            keyfile=options['keyfile'] or s('keyfile', None),
+            certfile=options['certfile'] or s('certfile', None),
+            user=options['username'] or s('user', None),
+            password=options['password'] or s('password', None),
+            ssl=options['ssl'] or s('ssl', False),
+            batch_size=int(s('batch_size', 50)),
+            poll_interval=options.get('interval') or s('poll_interval', 60),
+        )
+        default.pop('mailboxes', None)
+
+        mailboxes = self.config.get('mailboxes', None)
+        if not mailboxes:
+            return [default]
+
+        return [dict(default, **mailbox) for mailbox in mailboxes]
+
+    def check_mailbox(self, handle, config, stats):
+        """Turns the new messages in a mailbox into articles"""
+
+        batch_size = config['batch_size']
+        fetched = stats['fetched']
+        created = 0
+        consumed = []
+
+        def count(emails):
+            for pair in emails:
+                stats['fetched'] += 1
+                yield pair
+
+        for msg_id in self.create_articles(count(handle.fetch()), config):
+            created += 1
+            stats['created'] += 1
+            consumed.append(msg_id)
+            if len(consumed) == batch_size:
+                self.delete_messages(handle, consumed)
+                consumed = []
+
+        if consumed:
+            self.delete_messages(handle, consumed)
+        handle.checkpoint()
+
+        if stats['fetched'] == fetched:
+            self.log('No messages fetched')
+        elif not created:
+            self.log('No articles created')
+
+    def delete_messages(self, handle, id_list):
+        """Deletes a batch of messages that were turned into articles"""
+
+        self.log('Deleting %s consumed messages' % (len(id_list),))
+        handle.delete_messages(id_list)
+        handle.checkpoint()
 
     def get_email_content(self, email):
         """Attempts to extract an email's content"""
@@ -285,102 +788,393 @@ class Command(BaseCommand):
 
         return None
 
-    def create_articles(self, emails):
-        """Attempts to post new articles based on parsed email messages"""
+    def create_articles(self, emails, config=None):
+        """
+        Attempts to post new articles based on ``(id, parsed email)`` pairs,
+        yielding the ids of the messages that were posted.  Messages are
+        handled in batches of ``batch_size``, each in a transaction of its
+        own, and those that were posted before are skipped.  While a message
+        waits for the rest of its batch, only its headers and text stay in
+        memory; its attachments are moved to temporary files.
+        """
+
+        if config is None:
+            config = self.config
+        batch_size = config.get('batch_size', 50)
+
+        batch = []
+        for num, email in emails:
+            spool_attachments(email)
+            batch.append((num, email))
+            if len(batch) == batch_size:
+                for num in self.create_batch(batch, config):
+                    yield num
+                batch = []
+
+        if batch:
+            for num in self.create_batch(batch, config):
+                yield num
+
+    def posted_digests(self, digests):
+        """Returns which of the given digests belong to messages posted before"""
+
+        return set(IngestedEmail.objects.filter(digest__in=digests).values_list('digest', flat=True))
+
+    def create_batch(self, batch, config):
+        """
+        Posts a batch of ``(id, parsed email)`` pairs in a single transaction,
+        yielding the ids of the messages that were posted
+        """
 
-        created = []
         site = Site.objects.get_current()
+        ack = config.get('acknowledge', False)
+
+        digests = [get_email_digest(email, self.get_email_content(email)) for num, email in batch]
+        seen = self.posted_digests(digests)
+
+        consumed = []
+        with transaction.commit_on_success():
+            for (num, email), digest in zip(batch, digests):
+                if digest in seen:
+                    self.log('Skipping message that was already posted.')
+                    consumed.append((num, None, None))
+                    continue
+
+                # a message that fails leaves the rest of the batch alone
+                sid = transaction.savepoint()
+                article = self.create_article(email, config)
+                if article is None:
+                    transaction.savepoint_rollback(sid)
+                    continue
+
+                try:
+                    IngestedEmail.objects.create(
+                        message_id=email.get('Message-ID', '')[:255],
+                        digest=digest,
+                        article=article,
+                    )
+                except IntegrityError:
+                    # another run posted it in the meantime
+                    transaction.savepoint_rollback(sid)
+                    self.log('Skipping message that was already posted.')
+                    consumed.append((num, None, None))
+                    continue
+
+                transaction.savepoint_commit(sid)
+                seen.add(digest)
+                consumed.append((num, email, article))
+
+        for num, email, article in consumed:
+            if article is not None:
+                # files can't be rolled back, so they wait for the commit
+                self.save_attachments(article, email, config)
+                if ack:
+                    self.acknowledge(article, site)
+
+            yield num
+
+    def create_article(self, email, config):
+        """Posts an article based on a parsed email, returning it if that worked"""
 
-        ack = self.config.get('acknowledge', False)
-        autopost = self.config.get('autopost', False)
+        autopost = config.get('autopost', False)
 
         # make sure we have a valid default markup
-        markup = self.config.get('markup', MARKUP_HTML)
+        markup = config.get('markup', MARKUP_HTML)
         if markup not in (MARKUP_HTML, MARKUP_MARKDOWN, MARKUP_REST, MARKUP_TEXTILE):
             markup = MARKUP_HTML
 
-        for num, email in emails.iteritems():
+        name, sender = parseaddr(email['From'])
 
-            name, sender = parseaddr(email['From'])
-
-            try:
-                author = User.objects.get(email=sender, is_active=True)
-            except User.DoesNotExist:
-                # unauthorized sender
-                self.log('Not processing message from unauthorized sender.', 0)
-                continue
-
-            # get the attributes for the article
-            title = email.get('Subject', '--- article from email ---')
+        try:
+            author = User.objects.get(email=sender, is_active=True)
+        except User.DoesNotExist:
+            # unauthorized sender
+            self.log('Not processing message from unauthorized sender.', 0)
+            return None
 
-            content = self.get_email_content(email)
-            try:
-                # try to grab the timestamp from the email message
-                publish_date = datetime.fromtimestamp(time.mktime(parsedate(email['Date'])))
-            except StandardError, err:
-                self.log("An error occurred when I tried to convert the email's timestamp into a datetime object: %s" % (err,))
-                publish_date = datetime.now()
-
-            # post the article
-            article = Article(
-                author=author,
-                title=title,
-                content=content,
-                markup=markup,
-                publish_date=publish_date,
-                is_active=autopost,
-            )
+        # get the attributes for the article
+        title = email.get('Subject', '--- article from email ---')
 
-            try:
-                article.save()
-                self.log('Article created.')
-            except StandardError, err:
-                # log it and move on to the next message
-                self.log('Error creating article: %s' % (err,), 0)
-                continue
-            else:
+        content = self.get_email_content(email)
+        try:
+            # try to grab the timestamp from the email message
+            publish_date = datetime.fromtimestamp(time.mktime(parsedate(email['Date'])))
+        except StandardError, err:
+            self.log("An error occurred when I tried to convert the email's timestamp into a datetime object: %s" % (err,))
+            publish_date = datetime.now()
+
+        # post the article
+        article = Article(
+            author=author,
+            title=title,
+            content=content,
+            markup=markup,
+            publish_date=publish_date,
+            is_active=autopost,
+        )
+
+        # don't let a failed article spoil the batch
+        sid = transaction.savepoint()
+        try:
+            article.save()
+            self.log('Article created.')
+        except StandardError, err:
+            # log it and move on to the next message
+            transaction.savepoint_rollback(sid)
+            self.log('Error creating article: %s' % (err,), 0)
+            return None
+        else:
+            transaction.savepoint_commit(sid)
 
-                # handle attachments
-                if email.is_multipart():
-                    files = [pl for pl in email.get_payload() if pl.get_filename() is not None]
-                    for att in files:
-                        obj = Attachment(
-                            article=article,
-                            caption=att.get_filename(),
-                        )
-                        obj.attachment.save(obj.caption, ChunkyString(att.get_payload()))
-                        obj.save()
+        return article
 
-                created.append(num)
+    def save_attachments(self, article, email, config):
+        """Attaches the files attached to an email to its article"""
 
-            if ack:
-                # notify the user when the article is posted
-                subject = u'%s: %s' % (_("Article Posted"), title)
-                message = _("""Your email (%(title)s) has been posted as an article on %(site_name)s.
+        max_attachment_size = config.get('max_attachment_size', None)
+        spool_size = config.get('attachment_spool_size', DECODE_BUFFER_SIZE)
 
-    http://%(domain)s%(article_url)s""") % {
-                    'title': title,
-                    'site_name': site.name,
-                    'domain': site.domain,
-                    'article_url': article.get_absolute_url(),
-                }
+        if email.is_multipart():
+            files = [pl for pl in email.get_payload() if pl.get_filename() is not None]
+            for att in files:
+                try:
+                    content = get_attachment(att, max_attachment_size, spool_size)
+                except AttachmentTooLarge, err:
+                    self.log('Skipping attachment %s: %s' % (att.get_filename(), err), 0)
+                    continue
 
-                self.log('Sending acknowledgment email to %s' % (author.email,))
-                author.email_user(subject, message)
+                obj = Attachment(
+                    article=article,
+                    caption=att.get_filename(),
+                )
+                try:
+                    obj.attachment.save(obj.caption, content)
+                finally:
+                    content.close()
+                obj.save()
 
-        return created
+    def acknowledge(self, article, site):
+        """Notifies the author that their article was posted"""
 
-class ChunkyString(str):
-    """Makes is possible to easily chunk attachments"""
+        subject = u'%s: %s' % (_("Article Posted"), article.title)
+        message = _("""Your email (%(title)s) has been posted as an article on %(site_name)s.
 
-    def chunks(self):
-        i = 0
-        decoded = b64decode(self)
-        while True:
-            l = i
-            i += 1024
-            yield decoded[l:i]
+    http://%(domain)s%(article_url)s""") % {
+            'title': article.title,
+            'site_name': site.name,
+            'domain': site.domain,
+            'article_url': article.get_absolute_url(),
+        }
+
+        self.log('Sending acknowledgment email to %s' % (article.author.email,))
+        article.author.email_user(subject, message)
+
+def get_email_digest(email, content):
+    """
+    Identifies a message by its Message-ID and what would be posted from it,
+    so a message seen again is recognized, even when it has no Message-ID
+    """
+
+    digest = sha1()
+    for value in (email.get('Message-ID'), email.get('From'), email.get('Subject'), email.get('Date'), content):
+        digest.update(force_bytes(value or ''))
+        digest.update('\0')
+
+    return digest.hexdigest()
+
+class AttachmentTooLarge(Exception):
+    pass
+
+class DecodedAttachment(File):
+    """An attachment decoded into a temporary file, copied out in large chunks"""
+
+    DEFAULT_CHUNK_SIZE = DECODE_BUFFER_SIZE
+
+def get_attachment(part, max_size=None, spool_size=DECODE_BUFFER_SIZE):
+    """
+    The decoded contents of an attachment, as decoded by MessageParser, or
+    decoded now for a part that was parsed some other way
+    """
+
+    decoded = getattr(part, 'decoded', None)
+    if decoded is None:
+        return decode_attachment(part, max_size, spool_size)
+    elif isinstance(decoded, AttachmentTooLarge):
+        raise decoded
+
+    return decoded
+
+def decode_attachment(part, max_size=None, spool_size=DECODE_BUFFER_SIZE):
+    """
+    Decodes an attachment a buffer at a time.  The result stays in memory
+    while it's smaller than ``spool_size`` bytes, and goes to a temporary file
+    after that.  Raises AttachmentTooLarge when it's over ``max_size`` bytes.
+    """
+
+    payload = part.get_payload()
+    encoding = part.get('Content-Transfer-Encoding', '').strip().lower()
+    if max_size and encoding == 'base64' and len(payload) * 3 / 4 > max_size * 1.05:
+        # don't bother decoding what's clearly too big; base64 takes 4 bytes
+        # for every 3, plus line breaks
+        raise AttachmentTooLarge('about %s bytes' % (len(payload) * 3 / 4,))
+
+    return decode_lines(StringIO(payload), encoding, max_size, spool_size)
+
+def decode_lines(lines, encoding, max_size=None, spool_size=DECODE_BUFFER_SIZE):
+    """
+    Decodes the lines of an attachment as they come, a buffer at a time.  The
+    result stays in memory while it's smaller than ``spool_size`` bytes, and
+    goes to a temporary file after that.  Raises AttachmentTooLarge as soon as
+    it's over ``max_size`` bytes.
+    """
+
+    decoded = SpooledTemporaryFile(max_size=spool_size)
+    leftover = ''
+    try:
+        for chunk in buffer_lines(lines):
+            if encoding == 'base64':
+                # only decode whole groups of 4 characters; keep the rest for
+                # the next round
+                data = leftover + ''.join(chunk.split())
+                usable = len(data) - len(data) % 4
+                decoded.write(a2b_base64(data[:usable]))
+                leftover = data[usable:]
+            elif encoding == 'quoted-printable':
+                # soft line breaks never span buffers, which end with a line
+                decoded.write(quopri.decodestring(chunk))
+            else:
+                decoded.write(chunk)
 
-            if i > len(decoded):
-                raise StopIteration
+            if max_size and decoded.tell() > max_size:
+                raise AttachmentTooLarge('over %s bytes' % (max_size,))
 
+        if leftover:
+            # a truncated attachment; decode what we can
+            try:
+                decoded.write(a2b_base64(leftover + '=' * (-len(leftover) % 4)))
+            except Base64Error:
+                pass
+    except:
+        decoded.close()
+        raise
+
+    decoded.seek(0)
+    return DecodedAttachment(decoded)
+
+def spool_attachments(email):
+    """Moves the decoded attachments of a parsed message out of memory"""
+
+    for part in email.walk():
+        decoded = getattr(part, 'decoded', None)
+        if isinstance(decoded, DecodedAttachment):
+            decoded.file.rollover()
+
+def buffer_lines(lines, size=DECODE_BUFFER_SIZE):
+    """Joins lines into chunks of about ``size`` bytes, never splitting a line"""
+
+    chunk, length = [], 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+
+    if chunk:
+        yield ''.join(chunk)
+
+class MessageParser(object):
+    """
+    Parses a message from a file a line at a time.  Attachments are decoded
+    into files of their own as they go by, so neither the encoded nor the
+    decoded attachment has to fit in memory.  Each attachment's part gets a
+    ``decoded`` attribute with its DecodedAttachment, or the
+    AttachmentTooLarge error that stopped it.
+    """
+
+    def __init__(self, max_size=None, spool_size=DECODE_BUFFER_SIZE):
+        self.max_size = max_size
+        self.spool_size = spool_size
+
+    def parse(self, fp):
+        part, end = self.parse_part(iter(fp.readline, ''), frozenset())
+        return part
+
+    def parse_part(self, lines, boundaries):
+        """
+        Reads the headers and body of a part, up to one of the ``boundaries``
+        of the multiparts it's in.  Returns the part, and the boundary that
+        ended it, or None at the end of the message.
+        """
+
+        headers = []
+        for line in lines:
+            headers.append(line)
+            if not line.strip():
+                break
+
+        part = HeaderParser().parsestr(''.join(headers), headersonly=True)
+        if part.get_content_maintype() == 'multipart' and part.get_boundary():
+            return self.parse_multipart(part, lines, boundaries)
+
+        end = []
+        body = self.read_body(lines, boundaries, end)
+        if part.get_filename() is None:
+            part.set_payload(''.join(body))
+        else:
+            encoding = part.get('Content-Transfer-Encoding', '').strip().lower()
+            try:
+                part.decoded = decode_lines(body, encoding, self.max_size, self.spool_size)
+            except AttachmentTooLarge, err:
+                part.decoded = err
+                # skip the rest of it
+                for line in body:
+                    pass
+            part.set_payload('')
+
+        return part, end and end[0] or None
+
+    def parse_multipart(self, part, lines, boundaries):
+        boundary = '--' + part.get_boundary()
+        inner = boundaries | frozenset([boundary, boundary + '--'])
+        part.set_payload(None)
+
+        # skip the preamble
+        end = []
+        for line in self.read_body(lines, inner, end):
+            pass
+
+        while end and end[0] == boundary:
+            subpart, line = self.parse_part(lines, inner)
+            part.attach(subpart)
+            end = line and [line] or []
+
+        if end and end[0] == boundary + '--':
+            # skip the epilogue, up to the end of an enclosing multipart
+            end = []
+            for line in self.read_body(lines, boundaries, end):
+                pass
+
+        return part, end and end[0] or None
+
+    def read_body(self, lines, boundaries, end):
+        """
+        Yields the lines of a body up to the next of the ``boundaries``, which
+        goes in ``end``.  The line break before a boundary belongs to the
+        boundary, so it's left off.
+        """
+
+        previous = None
+        for line in lines:
+            if line.startswith('--') and line.rstrip() in boundaries:
+                end.append(line.rstrip())
+                break
+
+            if previous is not None:
+                yield previous
+            previous = line
+
+        if previous is not None and end:
+            previous = previous.rstrip('\r\n')
+        if previous is not None:
+            yield previous
@@ -1,23 +1,110 @@
+from optparse import make_option
+import time
+
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import NoArgsCommand
-from articles.models import Article, Tag
+from django.db import connection, transaction
+from articles.caching import bump_version, listing_version_name
+from articles.listeners import articles_changed, bump_articles, tags_changed
+from articles.models import Article, Tag, USE_TAGGIT
 
-class Command(NoArgsCommand):    
+class Command(NoArgsCommand):
     help = """Converts our old categories into tags"""
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False, help='Report what would be converted without changing anything'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000, help='Number of rows to insert at a time'),
+    )
+
+    def log(self, message, level=1):
+        if self.verbosity >= level:
+            print message
+
     def handle_noargs(self, **opts):
-        from django.db import connection
+        self.verbosity = int(opts.get('verbosity', 1))
+        dry_run = opts.get('dry_run', False)
+        batch_size = opts.get('batch_size') or 1000
+        started = time.time()
 
         c = connection.cursor()
-
-        for article in Article.objects.all():
-            c.execute("""SELECT c.slug
+        c.execute("""SELECT DISTINCT aac.article_id, c.slug
 FROM articles_article_categories aac
 JOIN articles_category c
-ON aac.category_id = c.id
-WHERE aac.article_id=%s""", (article.id,))
+ON aac.category_id = c.id""")
+        pairs = c.fetchall()
+        names = set(name for article_id, name in pairs)
+        self.log('Found %s categories on %s articles' % (len(names), len(set(a for a, n in pairs))))
+
+        tag_ids, missing = self.match_tags(names)
+        self.log('%s categories match existing tags, %s new tags needed' % (len(names) - len(missing), len(missing)))
+
+        through = Article.tags.through
+        if USE_TAGGIT:
+            content_type = ContentType.objects.get_for_model(Article)
+            existing = through.objects.filter(content_type=content_type).values_list('object_id', 'tag_id')
+            make_row = lambda article_id, tag_id: through(content_type=content_type, object_id=article_id, tag_id=tag_id)
+        else:
+            existing = through.objects.values_list('article_id', 'tag_id')
+            make_row = lambda article_id, tag_id: through(article_id=article_id, tag_id=tag_id)
+
+        existing = set(existing)
+        if dry_run:
+            # names that share a tag, new or not, count once, like they're applied
+            tags = dict((name, tag_ids.get(name, self.slugify(name))) for name in names)
+            new = set((article_id, tags[name]) for article_id, name in pairs) - existing
+            self.log('Would create %s tags and apply %s tags to articles' % (len(missing), len(new)))
+            return
+
+        with transaction.commit_on_success():
+            if missing:
+                Tag.objects.bulk_create([Tag(name=name, slug=slug) for name, slug in sorted(missing.items())],
+                                        batch_size=batch_size)
+                tag_ids, missing = self.match_tags(names)
+
+            new = sorted(set((article_id, tag_ids[name]) for article_id, name in pairs) - existing)
+            for i in range(0, len(new), batch_size):
+                through.objects.bulk_create([make_row(*pair) for pair in new[i:i + batch_size]])
+                self.log('Applied %s of %s tags' % (min(i + batch_size, len(new)), len(new)), 2)
+
+        # bulk inserts send no signals, so clear out what the listeners would
+        if new:
+            tags_changed(Article)
+            articles_changed(Article)
+            bump_articles(set(article_id for article_id, tag_id in new))
+            bump_version(*[listing_version_name('tag', pk) for pk in set(tag_id for article_id, tag_id in new)])
+
+        self.log('Applied %s tags to articles in %.1fs' % (len(new), time.time() - started))
+
+    def match_tags(self, names):
+        """
+        Finds the tag for each category name, by name or by slug.  Returns a
+        dict of tag ids by name, and a dict of the slugs to give new tags by
+        name.
+        """
+
+        by_name, by_slug = {}, {}
+        for pk, name, slug in Tag.objects.values_list('pk', 'name', 'slug'):
+            by_name[name] = pk
+            if slug:
+                by_slug[slug] = pk
+
+        tag_ids, missing, new_slugs = {}, {}, set()
+        for name in sorted(names):
+            slug = self.slugify(name)
+            if name in by_name:
+                tag_ids[name] = by_name[name]
+            elif slug in by_slug:
+                # a tag that only differs in case or punctuation
+                tag_ids[name] = by_slug[slug]
+            elif slug not in new_slugs:
+                # names that share a slug share the new tag, once it's created
+                missing[name] = slug
+                new_slugs.add(slug)
+
+        return tag_ids, missing
 
-            names = [row[0] for row in c.fetchall()]
-            tags = [Tag.objects.get_or_create(name=t)[0] for t in names]
-            article.tags = tags
-            article.save()
+    def slugify(self, name):
+        if USE_TAGGIT:
+            return Tag().slugify(name)
 
+        return Tag.clean_tag(name)
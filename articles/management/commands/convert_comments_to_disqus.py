@@ -1,31 +1,235 @@
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
 from django.conf import settings
 from django.contrib.comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db.models import Count
+from django.utils.timezone import get_current_timezone, is_naive, make_aware, utc
+from django.utils.xmlutils import SimplerXMLGenerator
 from articles.models import Article
 import simplejson as json
+import errno
+import httplib
+import os
 import re
+import socket
 import string
 import sys
+import threading
+import time
 import urllib
 import urllib2
 
 NONPRINTABLE_RE = re.compile('[^%s]' % string.printable)
 
+API_URL = getattr(settings, 'DISQUS_API_URL', 'http://disqus.com/api/')
+
+class DisqusError(Exception):
+    pass
+
+class Checkpoint(object):
+    """
+    Remembers which threads were created and which comments were posted, so
+    an interrupted import can pick up where it left off.  Each one is added
+    to the end of the file, as a line of JSON, as soon as it happens.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.forum_id = None
+        self.threads = {}
+        self.posted = set()
+        self.cut_short = False
+
+        if path and os.path.exists(path):
+            line = ''
+            with open(path) as fp:
+                for line in fp:
+                    self.replay(line)
+            # an interrupted write leaves half a line behind
+            self.cut_short = bool(line) and not line.endswith('\n')
+
+    def replay(self, line):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return
+
+        if 'forum_id' in entry:
+            self.forum_id = entry['forum_id']
+        if 'thread' in entry:
+            article_id, thread_id = entry['thread']
+            self.threads[int(article_id)] = thread_id
+        if 'posted' in entry:
+            self.posted.add(entry['posted'])
+
+    def record_forum(self, forum_id):
+        self.forum_id = forum_id
+        self.append({'forum_id': forum_id})
+
+    def record_thread(self, article_id, thread_id):
+        with self.lock:
+            self.threads[article_id] = thread_id
+            self.append({'thread': [article_id, thread_id]})
+
+    def record_post(self, comment_id):
+        with self.lock:
+            self.posted.add(comment_id)
+            self.append({'posted': comment_id})
+
+    def append(self, entry):
+        if not self.path:
+            return
+
+        line = json.dumps(entry) + '\n'
+        if self.cut_short:
+            line = '\n' + line
+            self.cut_short = False
+
+        with open(self.path, 'a') as fp:
+            fp.write(line)
+
+def connection_refused(err):
+    """Whether a request failed before it reached the server"""
+
+    reason = getattr(err, 'reason', err)
+    return getattr(reason, 'errno', None) == errno.ECONNREFUSED
+
+def format_gmt(value):
+    if is_naive(value):
+        value = make_aware(value, get_current_timezone())
+    return value.astimezone(utc).strftime('%Y-%m-%d %H:%M:%S')
+
+class WXRWriter(object):
+    """
+    Writes threads and their comments in the WordPress eXtended RSS format
+    that Disqus imports
+    """
+
+    # Disqus state -> wp:comment_approved
+    APPROVED = {
+        'approved': '1',
+        'unapproved': '0',
+        'killed': 'trash',
+        'spam': 'spam',
+    }
+
+    def __init__(self, fp):
+        self.xml = SimplerXMLGenerator(fp, 'utf-8')
+
+    def start(self):
+        self.xml.startDocument()
+        self.xml.startElement('rss', {
+            'version': '2.0',
+            'xmlns:content': 'http://purl.org/rss/1.0/modules/content/',
+            'xmlns:dsq': 'http://www.disqus.com/',
+            'xmlns:dc': 'http://purl.org/dc/elements/1.1/',
+            'xmlns:wp': 'http://wordpress.org/export/1.0/',
+        })
+        self.xml.startElement('channel', {})
+
+    def write_thread(self, thread, comments):
+        xml = self.xml
+        xml.startElement('item', {})
+        xml.addQuickElement('title', thread['title'])
+        xml.addQuickElement('link', thread['url'])
+        xml.addQuickElement('content:encoded', thread['content'])
+        xml.addQuickElement('dsq:thread_identifier', unicode(thread['id']))
+        xml.addQuickElement('wp:post_date_gmt', thread['date'])
+        xml.addQuickElement('wp:comment_status', 'open')
+
+        for comment in comments:
+            xml.startElement('wp:comment', {})
+            xml.addQuickElement('wp:comment_id', unicode(comment['id']))
+            xml.addQuickElement('wp:comment_author', comment['author_name'])
+            xml.addQuickElement('wp:comment_author_email', comment['author_email'])
+            xml.addQuickElement('wp:comment_author_url', comment['author_url'])
+            xml.addQuickElement('wp:comment_author_IP', comment['ip_address'] or '')
+            xml.addQuickElement('wp:comment_date_gmt', comment['date'])
+            xml.addQuickElement('wp:comment_content', comment['message'])
+            xml.addQuickElement('wp:comment_approved', self.APPROVED[comment['state']])
+            xml.addQuickElement('wp:comment_parent', '0')
+            xml.endElement('wp:comment')
+
+        xml.endElement('item')
+
+    def end(self):
+        self.xml.endElement('channel')
+        self.xml.endElement('rss')
+        self.xml.endDocument()
+
+class JSONLinesWriter(object):
+    """Writes each comment as a line of JSON, along with its thread"""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def start(self):
+        pass
+
+    def write_thread(self, thread, comments):
+        for comment in comments:
+            line = dict(comment, thread_identifier=thread['id'], thread_title=thread['title'], thread_url=thread['url'])
+            self.fp.write(json.dumps(line) + '\n')
+
+    def end(self):
+        pass
+
+FORMATS = {
+    'wxr': WXRWriter,
+    'jsonl': JSONLinesWriter,
+}
+
 class Command(NoArgsCommand):
     help = """Imports any comments from django.contrib.comments into Disqus."""
     _forum_api_key = {}
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--forum', dest='forum', default=None, help='ID of the Disqus forum to import into'),
+        make_option('--workers', dest='workers', type='int', default=4, help='Number of articles to import at the same time'),
+        make_option('--retries', dest='retries', type='int', default=3, help='Number of times to retry a failed API call'),
+        make_option('--timeout', dest='timeout', type='int', default=30, help='Seconds to wait for the Disqus API to answer'),
+        make_option('--checkpoint', dest='checkpoint', default=None, help='File that records progress, to resume an interrupted import'),
+        make_option('--api-url', dest='api_url', default=None, help='Base URL of the Disqus API'),
+        make_option('--output', dest='output', default=None, help='Write the comments to this file for a bulk import, instead of using the API'),
+        make_option('--format', dest='format', default=None, help='Format of the --output file: wxr or jsonl.  Defaults to jsonl for .jsonl files and wxr for anything else'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000, help='Number of comments to load at a time for --output'),
+    )
+
+    retry_delay = 2
+    timeout = 30
+
     def handle_noargs(self, **opts):
-        if hasattr(settings, 'DISQUS_USER_API_KEY'):
-            self.forum_id = self.determine_forum()
-            #print self.get_value_from_api('get_thread_list', {'forum_id': self.forum_id, 'limit': 1000})
-            self.import_comments(self.forum_id)
+        if opts.get('output'):
+            self.export_file(opts['output'], opts.get('format'), opts.get('chunk_size') or 1000)
+        elif hasattr(settings, 'DISQUS_USER_API_KEY'):
+            self.api_url = opts.get('api_url') or API_URL
+            self.retries = opts.get('retries', 3)
+            self.timeout = opts.get('timeout') or self.timeout
+            self.checkpoint = Checkpoint(opts.get('checkpoint'))
+
+            self.forum_id = opts.get('forum') or self.checkpoint.forum_id or self.determine_forum()
+            if self.checkpoint.forum_id is None:
+                self.checkpoint.record_forum(self.forum_id)
+            elif unicode(self.checkpoint.forum_id) != unicode(self.forum_id):
+                raise CommandError('%s is the checkpoint of an import into forum %s, not %s' % (
+                    opts.get('checkpoint'), self.checkpoint.forum_id, self.forum_id))
+
+            self.import_comments(self.forum_id, opts.get('workers', 4))
         else:
             sys.exit('Please specify your DISQUS_USER_API_KEY in settings.py')
 
-    def get_value_from_api(self, url, args={}, method='GET'):
+    def get_value_from_api(self, url, args={}, method='GET', idempotent=True):
+        """
+        Calls the Disqus API, retrying failed calls.  Calls that aren't
+        ``idempotent`` are only retried when they can't have reached Disqus,
+        or when Disqus says to try again later.
+        """
+
         params = {
             'user_api_key': settings.DISQUS_USER_API_KEY,
             'api_version': '1.1',
@@ -44,17 +248,33 @@ class Command(NoArgsCommand):
             additional = '?%s' % data
             data = None
 
-        url = 'http://disqus.com/api/%s/%s' % (url, additional)
-        try:
-            handle = urllib2.urlopen(url, data)
-        except urllib2.HTTPError, err:
-            print 'Failed to %s %s with args %s' % (method, url, args)
-            return None
-        else:
-            json_obj = json.loads(handle.read())['message']
-            handle.close()
+        url = '%s%s/%s' % (self.api_url, url, additional)
+        for attempt in range(self.retries + 1):
+            try:
+                handle = urllib2.urlopen(url, data, self.timeout)
+                try:
+                    response = handle.read()
+                finally:
+                    handle.close()
+            except urllib2.HTTPError, err:
+                if err.code in (429, 503):
+                    pass
+                elif err.code < 500 or not idempotent:
+                    # the request itself is wrong, or might have worked
+                    break
+            except (urllib2.URLError, httplib.HTTPException, socket.error), err:
+                if not idempotent and not connection_refused(err):
+                    break
+            else:
+                try:
+                    return json.loads(response)['message']
+                except (ValueError, KeyError, TypeError):
+                    raise DisqusError('Unexpected answer to %s %s: %r' % (method, url, response[:200]))
 
-            return json_obj
+            if attempt < self.retries:
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+        raise DisqusError('Failed to %s %s with args %s: %s' % (method, url, args, err))
 
     def determine_forum(self):
         forums = self.get_value_from_api('get_forum_list')
@@ -85,39 +305,188 @@ class Command(NoArgsCommand):
             self._forum_api_key[self.forum_id] = self.get_value_from_api('get_forum_api_key', {'forum_id': self.forum_id})
         return self._forum_api_key[self.forum_id]
 
-    def import_comments(self, forum_id):
+    def import_comments(self, forum_id, workers=4):
         print 'Importing into forum %s' % self.forum_id
 
+        # group the comments by article, so each thread is looked up once
         article_ct = ContentType.objects.get_for_model(Article)
-        for comment in Comment.objects.filter(content_type=article_ct):
-            article = comment.content_object
-            thread_obj = self.get_value_from_api('thread_by_identifier', {'identifier': article.id, 'title': article.title, 'forum_api_key': self.forum_api_key}, method='POST')
-
-            thread = thread_obj['thread']
-            if thread_obj['created']:
-                # set the URL for this thread for good measure
-                self.get_value_from_api('update_thread', {
-                    'forum_api_key': self.forum_api_key,
-                    'thread_id': thread['id'],
-                    'title': article.title,
-                    'url': 'http://%s%s' % (Site.objects.get_current().domain, article.get_absolute_url()),
-                }, method='POST')
-                print 'Created new thread for %s' % article.title
-
-            # create the comment on disqus
-            comment_obj = self.get_value_from_api('create_post', {
+        comments = Comment.objects.filter(content_type=article_ct).order_by('submit_date', 'pk')
+        grouped = {}
+        for comment in comments:
+            if comment.pk not in self.checkpoint.posted:
+                grouped.setdefault(int(comment.object_pk), []).append(comment)
+
+        ids = sorted(grouped)
+        articles = {}
+        for i in range(0, len(ids), 500):
+            # some databases only take so many parameters in a query
+            articles.update(Article.objects.in_bulk(ids[i:i + 500]))
+
+        self.export_threads([(articles[pk], grouped[pk]) for pk in sorted(grouped) if pk in articles], workers)
+
+    def export_threads(self, threads, workers=4):
+        """
+        Posts ``(article, comments)`` pairs to Disqus, several articles at a
+        time.  The comments of each article are posted in order.
+        """
+
+        # look these up once, instead of once per comment
+        domain = Site.objects.get_current().domain
+        forum_api_key = self.forum_api_key
+        jobs = [{
+            'id': article.id,
+            'title': article.title,
+            'url': 'http://%s%s' % (domain, article.get_absolute_url()),
+            'comments': comments,
+            'forum_api_key': forum_api_key,
+        } for article, comments in threads]
+
+        pool = ThreadPool(workers)
+        failed = 0
+        try:
+            for job, posted, err in pool.imap_unordered(self.export_thread, jobs):
+                print 'Imported %s of %s comments for %s' % (len(posted), len(job['comments']), job['title'])
+                if err is not None:
+                    failed += 1
+                    print err
+        finally:
+            pool.close()
+            pool.join()
+
+        if failed:
+            print '%s articles had comments that failed to import; run the command again to retry them' % (failed,)
+
+    def export_thread(self, job):
+        """Creates the thread for an article and posts its comments"""
+
+        posted = []
+        try:
+            thread_id = self.checkpoint.threads.get(job['id'])
+            if thread_id is None:
+                thread_id = self.get_thread(job)
+                self.checkpoint.record_thread(job['id'], thread_id)
+
+            for comment in job['comments']:
+                if comment.pk in self.checkpoint.posted:
+                    continue
+
+                # create the comment on disqus
+                self.get_value_from_api('create_post', {
+                    'thread_id': thread_id,
+                    'message': comment.comment,
+                    'author_name': comment.user_name,
+                    'author_email': comment.user_email,
+                    'forum_api_key': job['forum_api_key'],
+                    'created_at': comment.submit_date.strftime('%Y-%m-%dT%H:%M'),
+                    'ip_address': comment.ip_address,
+                    'author_url': comment.user_url,
+                    'state': self.get_state(comment)
+                }, method='POST', idempotent=False)
+                self.checkpoint.record_post(comment.pk)
+                posted.append(comment.pk)
+        except Exception, err:
+            if not isinstance(err, DisqusError):
+                # anything else would stop the other articles too
+                err = DisqusError('Failed to import the comments for %s: %s' % (job['title'], err))
+            return job, posted, err
+
+        return job, posted, None
+
+    def get_thread(self, job):
+        """Finds or creates the Disqus thread for an article"""
+
+        thread_obj = self.get_value_from_api('thread_by_identifier', {'identifier': job['id'], 'title': job['title'], 'forum_api_key': job['forum_api_key']}, method='POST')
+
+        thread = thread_obj['thread']
+        if thread_obj['created']:
+            # set the URL for this thread for good measure
+            self.get_value_from_api('update_thread', {
+                'forum_api_key': job['forum_api_key'],
                 'thread_id': thread['id'],
-                'message': comment.comment,
-                'author_name': comment.user_name,
-                'author_email': comment.user_email,
-                'forum_api_key': self.forum_api_key,
-                'created_at': comment.submit_date.strftime('%Y-%m-%dT%H:%M'),
-                'ip_address': comment.ip_address,
-                'author_url': comment.user_url,
-                'state': self.get_state(comment)
+                'title': job['title'],
+                'url': job['url'],
             }, method='POST')
+            print 'Created new thread for %s' % job['title']
+
+        return thread['id']
+
+    def export_file(self, path, format=None, chunk_size=1000):
+        """Writes every comment on an article to a file Disqus can import"""
+
+        if format is None:
+            format = path.endswith('.jsonl') and 'jsonl' or 'wxr'
+        if format not in FORMATS:
+            raise CommandError('Unknown format "%s"; use one of %s' % (format, ', '.join(sorted(FORMATS))))
 
-            print 'Imported comment for %s by %s on %s' % (article, comment.user_name, comment.submit_date)
+        with open(path, 'w') as fp:
+            count = self.write_export(fp, format, self.iter_threads(chunk_size))
+
+        print 'Wrote %s comments to %s' % (count, path)
+
+    def iter_threads(self, chunk_size=1000):
+        """
+        Yields each commented article with its comments, loading about
+        ``chunk_size`` comments at a time so memory use stays flat
+        """
+
+        article_ct = ContentType.objects.get_for_model(Article)
+        comments = Comment.objects.filter(content_type=article_ct)
+        counts = comments.values_list('object_pk').annotate(Count('pk')).order_by('object_pk')
+
+        # group articles into chunks of about chunk_size comments
+        chunks, chunk, size = [], [], 0
+        for object_pk, count in counts:
+            if chunk and size + count > chunk_size:
+                chunks.append(chunk)
+                chunk, size = [], 0
+            chunk.append(object_pk)
+            size += count
+        if chunk:
+            chunks.append(chunk)
+
+        # only what the export needs, and what Article.__init__ looks at
+        fields = ('id', 'title', 'slug', 'publish_date', 'rendered_content', 'expiration_date', 'is_active')
+        for chunk in chunks:
+            articles = Article.objects.only(*fields).in_bulk([int(pk) for pk in chunk])
+            rows = comments.filter(object_pk__in=chunk).order_by('object_pk', 'submit_date', 'pk').iterator()
+            for object_pk, thread in groupby(rows, lambda c: c.object_pk):
+                article = articles.get(int(object_pk))
+                if article is not None:
+                    yield article, thread
+
+    def write_export(self, fp, format, threads):
+        """Writes ``(article, comments)`` pairs in ``format``, returning the number of comments"""
+
+        domain = Site.objects.get_current().domain
+        writer = FORMATS[format](fp)
+        self.exported = 0
+
+        def convert(comments):
+            for comment in comments:
+                self.exported += 1
+                yield {
+                    'id': comment.pk,
+                    'author_name': comment.user_name,
+                    'author_email': comment.user_email,
+                    'author_url': comment.user_url,
+                    'ip_address': comment.ip_address,
+                    'date': format_gmt(comment.submit_date),
+                    'message': comment.comment,
+                    'state': self.get_state(comment),
+                }
+
+        writer.start()
+        for article, comments in threads:
+            writer.write_thread({
+                'id': article.id,
+                'title': article.title,
+                'url': 'http://%s%s' % (domain, article.get_absolute_url()),
+                'content': article.rendered_content,
+                'date': format_gmt(article.publish_date),
+            }, convert(comments))
+        writer.end()
+
+        return self.exported
 
     def get_state(self, comment):
         """Determines a comment's state on Disqus based on its properties in Django"""
@@ -130,4 +499,3 @@ class Command(NoArgsCommand):
             return 'unapproved'
         else:
             return 'spam'
-
@@ -7,18 +7,19 @@ import htmlentitydefs
 from datetime import datetime
 
 from django.db import models
-from django.db.models import Q
+from django.db.models import Count, Q
 from django.contrib.auth.models import User
-from django.contrib.markup.templatetags import markup
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.conf import settings
 from django.template.defaultfilters import slugify, striptags
 from django.utils.translation import ugettext_lazy as _
 from django.utils.text import truncate_html_words
-from django.utils.timezone import now
+from django.utils.timezone import get_current_timezone, get_default_timezone, is_aware, make_aware, now, utc
 
 from articles.decorators import logtime, once_per_instance
+from articles.renderers import render, render_plain, RenderError, MARKUP_HTML, MARKUP_MARKDOWN, MARKUP_REST, MARKUP_TEXTILE
 
 USE_TAGGIT = 'taggit' in settings.INSTALLED_APPS
 if USE_TAGGIT:
@@ -31,10 +32,9 @@ AUTO_TAG = getattr(settings, 'ARTICLES_AUTO_TAG', True)
 DEFAULT_DB = getattr(settings, 'ARTICLES_DEFAULT_DB', 'default')
 LOOKUP_LINK_TITLE = getattr(settings, 'ARTICLES_LOOKUP_LINK_TITLE', True)
 
-MARKUP_HTML = 'h'
-MARKUP_MARKDOWN = 'm'
-MARKUP_REST = 'r'
-MARKUP_TEXTILE = 't'
+# whether live() only includes the articles assigned to the current site
+LIVE_ON_SITE_ONLY = getattr(settings, 'ARTICLES_LIVE_ON_SITE_ONLY', False)
+
 MARKUP_OPTIONS = getattr(settings, 'ARTICLE_MARKUP_OPTIONS', (
         (MARKUP_HTML, _('HTML/Plain Text')),
         (MARKUP_MARKDOWN, _('Markdown')),
@@ -202,6 +202,21 @@ class ArticleStatus(models.Model):
         else:
             return self.name
 
+    def save(self, *args, **kwargs):
+        """Keeps the articles' copy of ``is_live`` in step with this status"""
+
+        super(ArticleStatus, self).save(*args, **kwargs)
+
+        using = kwargs.get('using', DEFAULT_DB)
+        changed = list(self.article_set.using(using).exclude(is_live=self.is_live).values_list('pk', flat=True))
+        if changed:
+            self.article_set.using(using).filter(pk__in=changed).update(is_live=self.is_live)
+
+            # the listeners ran before the articles changed, and the update
+            # sends no signals, so purge what shows these articles now
+            from articles.listeners import articles_updated
+            articles_updated(Article.objects.using(using).filter(pk__in=changed))
+
 class ArticleManager(models.Manager):
 
     def active(self):
@@ -215,17 +230,63 @@ class ArticleManager(models.Manager):
                 publish_date__lte=now,
                 is_active=True)
 
-    def live(self, user=None):
-        """Retrieves all live articles"""
+    def live(self, user=None, site=None):
+        """
+        Retrieves all live articles.  With ``ARTICLES_LIVE_ON_SITE_ONLY``, or
+        when a site is given, only those assigned to that site are included.
+        """
 
         qs = self.active()
 
+        if site is None and LIVE_ON_SITE_ONLY:
+            site = settings.SITE_ID
+        if site is not None:
+            qs = qs.filter(sites=site)
+
         if user is not None and user.is_superuser:
             # superusers get to see all articles
             return qs
         else:
             # only show live articles to regular users
-            return qs.filter(status__is_live=True)
+            return qs.filter(is_live=True)
+
+def get_date_range(year, month=None):
+    """
+    Returns the ``[start, end)`` datetimes covering a year, or a month of it.
+    Filtering ``publish_date`` on a range can use an index, which the
+    ``__year`` and ``__month`` lookups can't.
+    """
+
+    if month is None:
+        start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    elif month == 12:
+        start, end = datetime(year, 12, 1), datetime(year + 1, 1, 1)
+    else:
+        start, end = datetime(year, month, 1), datetime(year, month + 1, 1)
+
+    if settings.USE_TZ:
+        tz = get_current_timezone()
+        start, end = make_aware(start, tz), make_aware(end, tz)
+
+    return start, end
+
+def get_publish_year(publish_date):
+    """
+    Returns the year an article published at ``publish_date`` is filed under.
+    With time zones in use, that's the year in UTC, so it's the same whether
+    the date came from a form, in local time, or from the database.
+    """
+
+    if settings.USE_TZ and not is_aware(publish_date):
+        publish_date = make_aware(publish_date, get_default_timezone())
+    if is_aware(publish_date):
+        publish_date = publish_date.astimezone(utc)
+
+    return publish_date.year
+
+# fields left out when only a summary of each article is needed (the teaser
+# falls back to the description, which is always filled in when saving)
+SUMMARY_DEFERRED_FIELDS = ('content', 'rendered_content', 'keywords')
 
 MARKUP_HELP = _("""Select the type of markup you are using in this article.
 <ul>
@@ -258,9 +319,13 @@ class Article(models.Model):
     related_articles = models.ManyToManyField('self', blank=True)
 
     publish_date = models.DateTimeField(default=now, help_text=_('The date and time this article shall appear online.'))
+    # copy of publish_date's year so (year, slug) lookups can use an index
+    publish_year = models.PositiveIntegerField(editable=False, default=0)
     expiration_date = models.DateTimeField(blank=True, null=True, help_text=_('Leave blank if the article does not expire.'))
 
     is_active = models.BooleanField(default=True, blank=True)
+    # copy of status.is_live so that live() doesn't need a join
+    is_live = models.BooleanField(default=False, editable=False)
     login_required = models.BooleanField(blank=True, help_text=_('Enable this if users must login before they can read this article.'))
 
     use_addthis_button = models.BooleanField(_('Show AddThis button'), blank=True, default=USE_ADDTHIS_BUTTON, help_text=_('Check this to show an AddThis bookmark button when viewing an article.'))
@@ -284,7 +349,9 @@ class Article(models.Model):
                 self.is_active = False
                 self.save()
 
-            if not self.rendered_content or not len(self.rendered_content.strip()):
+            # summaries defer the rendered content; don't fetch it just for this
+            loaded = 'rendered_content' in self.__dict__
+            if loaded and (not self.rendered_content or not len(self.rendered_content.strip())):
                 self.save()
 
     def __unicode__(self):
@@ -302,6 +369,8 @@ class Article(models.Model):
         self.do_render_markup()
         self.do_addthis_button()
         self.do_meta_description()
+        self.do_publish_year()
+        self.do_live_status()
         self.do_unique_slug(using)
 
         super(Article, self).save(*args, **kwargs)
@@ -319,14 +388,11 @@ class Article(models.Model):
         """Turns any markup into HTML"""
 
         original = self.rendered_content
-        if self.markup == MARKUP_MARKDOWN:
-            self.rendered_content = markup.markdown(self.content)
-        elif self.markup == MARKUP_REST:
-            self.rendered_content = markup.restructuredtext(self.content)
-        elif self.markup == MARKUP_TEXTILE:
-            self.rendered_content = markup.textile(self.content)
-        else:
-            self.rendered_content = self.content
+        try:
+            self.rendered_content = render(self.markup, self.content)
+        except RenderError, err:
+            log.error('Showing article "%s" (%s) as plain text: %s' % (self.title, self.pk, err))
+            self.rendered_content = render_plain(self.content)
 
         return (self.rendered_content != original)
 
@@ -341,6 +407,17 @@ class Article(models.Model):
 
         return False
 
+    def do_publish_year(self):
+        """Keeps the indexed copy of the publish date's year up to date"""
+
+        if isinstance(self.publish_date, datetime):
+            self.publish_year = get_publish_year(self.publish_date)
+
+    def do_live_status(self):
+        """Copies whether the article's status is a live one"""
+
+        self.is_live = self.status_id is not None and self.status.is_live
+
     def do_unique_slug(self, using=DEFAULT_DB):
         """
         Ensures that the slug is always unique for the year this article was
@@ -441,14 +518,14 @@ class Article(models.Model):
             return slug
 
         orig_slug = slug
-        year = self.publish_date.year
+        year = get_publish_year(self.publish_date)
         counter = 1
 
         while True:
             not_unique = Article.objects.all()
             if hasattr(not_unique, 'using'):
                 not_unique = not_unique.using(using)
-            not_unique = not_unique.filter(publish_date__year=year, slug=slug)
+            not_unique = not_unique.filter(publish_year=year, slug=slug)
 
             if len(not_unique) == 0:
                 return slug
@@ -521,7 +598,7 @@ class Article(models.Model):
 
     @models.permalink
     def get_absolute_url(self):
-        return ('articles_display_article', (self.publish_date.year, self.slug))
+        return ('articles_display_article', (get_publish_year(self.publish_date), self.slug))
 
     def _get_teaser(self):
         """
@@ -565,6 +642,31 @@ class Article(models.Model):
     class Meta:
         ordering = ('-publish_date', 'title')
         get_latest_by = 'publish_date'
+        unique_together = (('publish_year', 'slug'),)
+        # back the filters and date ranges of active() and live()
+        index_together = (('is_active', 'publish_date'),
+                          ('is_live', 'is_active', 'publish_date'))
+
+def annotate_tag_usage(tags, articles=None):
+    """
+    Annotates each tag in ``tags`` with ``count``, the number of articles
+    using it.  When an ``articles`` queryset is given, only those articles are
+    counted and tags that none of them use are left out.
+    """
+
+    if USE_TAGGIT:
+        related = 'taggit_taggeditem_items'
+        if articles is not None:
+            tags = tags.filter(**{
+                related + '__content_type': ContentType.objects.get_for_model(Article),
+                related + '__object_id__in': articles.values('pk'),
+            })
+    else:
+        related = 'article'
+        if articles is not None:
+            tags = tags.filter(article__in=articles.values('pk'))
+
+    return tags.annotate(count=Count(related))
 
 class Attachment(models.Model):
     upload_to = lambda inst, fn: 'attach/%s/%s/%s' % (now().year, inst.article.slug, fn)
@@ -594,3 +696,31 @@ class Attachment(models.Model):
 
         return content_type
 
+class MailboxState(models.Model):
+    """Remembers how far the articles-from-email command has read a mailbox"""
+
+    mailbox = models.CharField(max_length=255, unique=True)
+    uid_validity = models.BigIntegerField(null=True, blank=True)
+    last_uid = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s (UID %s)' % (self.mailbox, self.last_uid)
+
+class IngestedEmail(models.Model):
+    """
+    Remembers each email that was posted as an article, so that it isn't
+    posted again if the command stops before deleting it
+    """
+
+    message_id = models.CharField(max_length=255, blank=True, db_index=True)
+    digest = models.CharField(max_length=40, unique=True)
+    article = models.ForeignKey(Article, null=True, blank=True, on_delete=models.SET_NULL)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.message_id or self.digest
+
+# connected here rather than in the package so that importing articles.routers
+# while django.db is loading doesn't pull in the models
+import articles.listeners
@@ -0,0 +1,278 @@
+"""
+Turns the markup of articles into HTML.
+
+Each markup type is rendered by a ``Renderer``, looked up by the markup code
+stored in ``Article.markup``.  The defaults can be replaced, or new types
+added, with the ``ARTICLES_MARKUP_RENDERERS`` setting, mapping markup codes to
+the dotted path of a renderer class, or to a ``(path, options)`` pair::
+
+    ARTICLES_MARKUP_RENDERERS = {
+        'm': ('articles.renderers.MarkdownRenderer', {'extensions': ['extra']}),
+    }
+
+Renderers are only created, and their markup libraries imported, the first
+time an article using them is rendered, so processes that never render markup
+don't pay for them.  Each one is then kept for the life of the process.
+
+With ``ARTICLES_RENDER_TIMEOUT`` set, rendering happens in a pool of worker
+processes instead, so that a pathological document can be given up on
+without tying up the process saving the article.
+"""
+
+import logging
+import multiprocessing
+import threading
+
+from django.conf import settings
+from django.utils.encoding import force_bytes, force_text
+from django.utils.html import linebreaks
+from django.utils.importlib import import_module
+from django.utils.safestring import mark_safe
+
+MARKUP_HTML = 'h'
+MARKUP_MARKDOWN = 'm'
+MARKUP_REST = 'r'
+MARKUP_TEXTILE = 't'
+
+DEFAULT_RENDERERS = {
+    MARKUP_HTML: 'articles.renderers.Renderer',
+    MARKUP_MARKDOWN: 'articles.renderers.MarkdownRenderer',
+    MARKUP_REST: 'articles.renderers.RestRenderer',
+    MARKUP_TEXTILE: 'articles.renderers.TextileRenderer',
+}
+RENDERERS = dict(DEFAULT_RENDERERS, **getattr(settings, 'ARTICLES_MARKUP_RENDERERS', {}))
+
+# seconds a document may take to render; None renders in this process
+RENDER_TIMEOUT = getattr(settings, 'ARTICLES_RENDER_TIMEOUT', None)
+RENDER_WORKERS = getattr(settings, 'ARTICLES_RENDER_WORKERS', 2)
+# bytes of address space each worker may use; None leaves it unlimited
+RENDER_MEMORY_LIMIT = getattr(settings, 'ARTICLES_RENDER_MEMORY_LIMIT', None)
+# workers are replaced after this many documents, to bound any leaks
+RENDER_TASKS_PER_WORKER = getattr(settings, 'ARTICLES_RENDER_TASKS_PER_WORKER', 1000)
+
+_loaded = {}
+_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+# database connections a worker inherited, see _init_worker
+_inherited = []
+
+log = logging.getLogger('articles.renderers')
+
+class Renderer(object):
+    """Leaves the text as it is; subclasses render some kind of markup"""
+
+    def __init__(self, **options):
+        self.options = options
+
+    def render(self, text):
+        return text
+
+class MarkdownRenderer(Renderer):
+    """
+    Renders Markdown.  ``extensions`` and any other options are passed on to
+    ``markdown.Markdown``.
+    """
+
+    def __init__(self, extensions=(), **options):
+        import markdown
+
+        self.markdown = markdown
+        self.extensions = list(extensions)
+        self.options = options
+        self._local = threading.local()
+
+    def get_converter(self):
+        # setting up the extensions is the slow part, so keep one converter
+        # for each thread instead of one for each article
+        converter = getattr(self._local, 'converter', None)
+        if converter is None:
+            converter = self.markdown.Markdown(extensions=self.extensions, **self.options)
+            self._local.converter = converter
+
+        return converter
+
+    def render(self, text):
+        converter = self.get_converter()
+        try:
+            return mark_safe(converter.convert(force_text(text)))
+        finally:
+            converter.reset()
+
+class RestRenderer(Renderer):
+    """
+    Renders reStructuredText, with the ``sourcecode`` directive.  Options are
+    docutils settings, and default to ``RESTRUCTUREDTEXT_FILTER_SETTINGS``.
+    """
+
+    def __init__(self, **options):
+        from docutils.core import publish_parts
+        from articles import directives
+
+        directives.register()
+        self.publish_parts = publish_parts
+        self.options = options or getattr(settings, 'RESTRUCTUREDTEXT_FILTER_SETTINGS', {})
+
+    def render(self, text):
+        parts = self.publish_parts(source=force_bytes(text), writer_name='html4css1',
+                                   settings_overrides=self.options)
+        return mark_safe(force_text(parts['fragment']))
+
+class TextileRenderer(Renderer):
+    """Renders Textile.  Options are passed on to ``textile.Textile``."""
+
+    def __init__(self, **options):
+        import textile
+
+        self.textile = textile
+        self.options = options
+
+    def render(self, text):
+        # Textile keeps footnotes and link references around, so each text
+        # gets a parser of its own
+        parser = self.textile.Textile(**self.options)
+        return mark_safe(force_text(parser.textile(force_text(text))))
+
+def load_renderer(path):
+    """Creates the renderer described by a dotted path or (path, options)"""
+
+    options = {}
+    if isinstance(path, (list, tuple)):
+        path, options = path
+
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)(**options)
+
+def get_renderer(markup):
+    """Returns the renderer for ``markup``, creating it on first use"""
+
+    renderer = _loaded.get(markup)
+    if renderer is None:
+        with _lock:
+            renderer = _loaded.get(markup)
+            if renderer is None:
+                log.debug('Loading the renderer for markup "%s"' % (markup,))
+                try:
+                    renderer = load_renderer(RENDERERS.get(markup, DEFAULT_RENDERERS[MARKUP_HTML]))
+                except ImportError, err:
+                    # like django.contrib.markup, show the text as it is
+                    log.warn('Unable to load the renderer for markup "%s": %s' % (markup, err))
+                    renderer = Renderer()
+                _loaded[markup] = renderer
+
+    return renderer
+
+class RenderError(Exception):
+    """Raised when a worker fails to render a document, or takes too long"""
+
+def _init_worker(memory_limit):
+    # the worker was forked with the parent's database and cache connections;
+    # drop them so it never talks over the parent's sockets.  The database
+    # connections are kept alive rather than closed, since closing them would
+    # end the parent's sessions too
+    from django.core.cache import cache
+    from django.db import connections
+
+    for conn in connections.all():
+        if conn.connection is not None:
+            _inherited.append(conn.connection)
+            conn.connection = None
+    if hasattr(cache, 'close'):
+        # only some backends hold connections
+        cache.close()
+
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+def _render_in_worker(markup, text):
+    return force_text(get_renderer(markup).render(text))
+
+class RenderPool(object):
+    """A pool of rendering workers, and how many renders are using it"""
+
+    def __init__(self):
+        log.debug('Starting %s rendering workers' % (RENDER_WORKERS,))
+        self.pool = multiprocessing.Pool(RENDER_WORKERS, _init_worker, (RENDER_MEMORY_LIMIT,),
+                                         RENDER_TASKS_PER_WORKER)
+        self.pending = 0
+        self.retired = False
+
+def get_pool():
+    """Returns the pool of rendering workers, starting it if needed"""
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool()
+
+        return _pool
+
+def _checkout():
+    pool = get_pool()
+    with _pool_lock:
+        pool.pending += 1
+    return pool
+
+def _checkin(pool):
+    with _pool_lock:
+        pool.pending -= 1
+        finished = pool.retired and not pool.pending
+
+    if finished:
+        # every other render on it is done, so only the stuck worker is lost
+        pool.pool.terminate()
+
+def _retire(pool):
+    """Stops giving renders to ``pool``; it's stopped once they're all done"""
+
+    global _pool
+    with _pool_lock:
+        pool.retired = True
+        if _pool is pool:
+            _pool = None
+
+def close_pool():
+    """Stops the rendering workers; the next render starts new ones"""
+
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+
+    if pool is not None:
+        # a worker stuck on a document won't finish, so don't wait for it
+        pool.pool.terminate()
+
+def render_in_pool(markup, text, timeout=None):
+    """Renders ``text`` in a worker process, giving up after ``timeout`` seconds"""
+
+    timeout = timeout or RENDER_TIMEOUT
+    pool = _checkout()
+    try:
+        result = pool.pool.apply_async(_render_in_worker, (markup, text))
+        try:
+            return mark_safe(result.get(timeout))
+        except multiprocessing.TimeoutError:
+            # renders already running on the other workers are left to finish
+            # before the pool goes, and new ones get a fresh pool
+            _retire(pool)
+            raise RenderError('Rendering took more than %s seconds' % (timeout,))
+        except Exception, err:
+            # MemoryError when the worker hits its limit, or anything the
+            # renderer raised
+            raise RenderError('%s: %s' % (err.__class__.__name__, err))
+    finally:
+        _checkin(pool)
+
+def render(markup, text):
+    """Renders ``text`` as HTML using the renderer for ``markup``"""
+
+    if RENDER_TIMEOUT:
+        return render_in_pool(markup, text)
+
+    return get_renderer(markup).render(text)
+
+def render_plain(text):
+    """Escapes ``text``, for when its markup can't be rendered"""
+
+    return linebreaks(text, autoescape=True)
@@ -0,0 +1,94 @@
+"""
+Sends reads of the articles app to replica databases and writes to the
+primary one.  To use it, list the replicas in ``ARTICLES_READ_DBS`` and add
+the router and its middleware to your settings::
+
+    DATABASE_ROUTERS = ['articles.routers.ArticlesRouter']
+    MIDDLEWARE_CLASSES += ('articles.routers.PinPrimaryMiddleware',)
+
+Once a request writes anything, the rest of it reads from the primary.  The
+middleware also sets a short-lived cookie so the requests that follow, such
+as the redirect after saving an article in the admin, don't read from a
+replica that hasn't caught up yet.  Every request that writes sets the cookie
+again, so it always outlasts the latest write.
+"""
+
+import random
+import threading
+
+from django.conf import settings
+
+# this module is loaded along with django.db, so it can't import the models
+DEFAULT_DB = getattr(settings, 'ARTICLES_DEFAULT_DB', 'default')
+READ_DBS = getattr(settings, 'ARTICLES_READ_DBS', ())
+PIN_COOKIE = getattr(settings, 'ARTICLES_PIN_COOKIE', 'articles_pinned')
+PIN_SECONDS = getattr(settings, 'ARTICLES_PIN_SECONDS', 15)
+
+APP_LABELS = ('articles',)
+
+_state = threading.local()
+
+def pin_to_primary():
+    """Makes the current thread read from the primary database"""
+
+    _state.pinned = True
+
+def unpin():
+    _state.pinned = False
+    _state.wrote = False
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+def has_written():
+    """Tells whether the current thread wrote anything since it was unpinned"""
+
+    return getattr(_state, 'wrote', False)
+
+class ArticlesRouter(object):
+
+    def __init__(self, read_dbs=None):
+        if read_dbs is None:
+            read_dbs = READ_DBS
+        self.read_dbs = list(read_dbs)
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in APP_LABELS:
+            return None
+
+        if is_pinned() or not self.read_dbs:
+            return DEFAULT_DB
+
+        return random.choice(self.read_dbs)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in APP_LABELS:
+            return None
+
+        pin_to_primary()
+        _state.wrote = True
+        return DEFAULT_DB
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        databases = set([DEFAULT_DB] + self.read_dbs)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+
+        return None
+
+class PinPrimaryMiddleware(object):
+    """Scopes the write pinning of ArticlesRouter to each request"""
+
+    def process_request(self, request):
+        unpin()
+        if PIN_COOKIE in request.COOKIES:
+            pin_to_primary()
+
+    def process_response(self, request, response):
+        if has_written():
+            # restart the clock, even if an earlier write already pinned it
+            response.set_cookie(PIN_COOKIE, '1', max_age=PIN_SECONDS)
+
+        unpin()
+        return response
@@ -1,24 +1,61 @@
 import logging
 
 from django import template
+from django.conf import settings
 from django.core.cache import cache
 from django.core.urlresolvers import resolve, reverse, Resolver404
-from django.db.models import Count
-from articles.models import Article, Tag
-from datetime import datetime
+from django.template.loader import render_to_string
+from django.utils.translation import get_language
+from articles.caching import CACHE_TIMEOUT, article_version_name, get_version, make_key
+from articles.models import Article, Tag, SUMMARY_DEFERRED_FIELDS, annotate_tag_usage
+from datetime import date, datetime
 import math
 
 register = template.Library()
 
+# how many pages to link to on either side of the current page
+PAGINATION_WINDOW = getattr(settings, 'ARTICLE_PAGINATION_WINDOW', 3)
+
 class GetCategoriesNode(template.Node):
     """
-    Retrieves a list of live article tags and places it into the context
+    Retrieves a list of live article tags and places it into the context.
+    Each tag carries a ``count`` of the live articles using it.
+
+    Usage::
+
+        {% get_article_tags as varname %}
+
+        {% get_article_tags as varname count %}
+
+        {% get_article_tags 10 as varname %}
+
+    With a limit, only the most used tags are retrieved.  Tags are sorted by
+    name, or by how often they're used when ``count`` is given.
     """
-    def __init__(self, varname):
+    def __init__(self, varname, limit=None, order='name'):
         self.varname = varname
+        self.limit = limit
+        self.order = order
 
     def render(self, context):
-        tags = Tag.objects.all()
+        user = context.get('user', None)
+        is_superuser = bool(user is not None and user.is_superuser)
+
+        key = make_key('article_tags', self.limit, self.order, is_superuser,
+                       get_version('articles'), get_version('tags'))
+        tags = cache.get(key)
+        if tags is None:
+            tags = annotate_tag_usage(Tag.objects.all(), Article.objects.live(user=user))
+            if self.limit or self.order == 'count':
+                tags = list(tags.order_by('-count', 'name')[:self.limit])
+            else:
+                tags = list(tags.order_by('name'))
+
+            if self.limit and self.order == 'name':
+                tags.sort(key=lambda t: t.name.lower())
+
+            cache.set(key, tags, CACHE_TIMEOUT)
+
         context[self.varname] = tags
         return ''
 
@@ -30,11 +67,22 @@ def get_article_tags(parser, token):
     argc = len(args)
 
     try:
-        assert argc == 3 and args[1] == 'as'
-    except AssertionError:
-        raise template.TemplateSyntaxError('get_article_tags syntax: {% get_article_tags as varname %}')
+        a = args.index('as')
+        assert a in (1, 2) and argc - a in (2, 3)
+
+        limit = None
+        if a == 2:
+            limit = int(args[1])
+            assert limit > 0
 
-    return GetCategoriesNode(args[2])
+        order = 'name'
+        if argc - a == 3:
+            order = args[-1].lower()
+            assert order in ('name', 'count')
+    except (AssertionError, ValueError):
+        raise template.TemplateSyntaxError('get_article_tags syntax: {% get_article_tags [limit] as varname [name|count] %}')
+
+    return GetCategoriesNode(args[a + 1], limit, order)
 
 class GetArticlesNode(template.Node):
     """
@@ -49,14 +97,44 @@ class GetArticlesNode(template.Node):
         {% get_articles 1 to 5 as varname %}
 
         {% get_articles 1 to 5 as varname asc %}
+
+        {% get_articles 5 tagged tag as varname %}
+
+        {% get_articles 1 to 5 by author as varname asc %}
+
+    ``tagged`` accepts a Tag or a tag slug; ``by`` accepts a User or a
+    username.  Articles only carry the fields needed to list them; the
+    content is left out.
     """
-    def __init__(self, varname, count=None, start=None, end=None, order='desc'):
-        self.count = count
-        self.start = start
-        self.end = end
+    def __init__(self, varname, count=None, start=None, end=None, order='desc',
+                 filter_by=None, filter_value=None):
+        if count is not None:
+            self.offset, self.limit = 0, count
+        else:
+            self.offset, self.limit = start - 1, end
+
+        self.single = (count == 1)
         self.order = order
+        self.filter_by = filter_by
+        self.filter_value = filter_value and template.Variable(filter_value)
         self.varname = varname.strip()
 
+    def get_filter(self, context):
+        """Returns the lookup for the ``tagged``/``by`` filter, if any"""
+
+        if not self.filter_by:
+            return None
+
+        try:
+            value = self.filter_value.resolve(context)
+        except template.VariableDoesNotExist:
+            value = ''
+
+        if self.filter_by == 'tagged':
+            return ('tags__slug', getattr(value, 'slug', value))
+        else:
+            return ('author__username', getattr(value, 'username', value))
+
     def render(self, context):
         # determine the order to sort the articles
         if self.order and self.order.lower() == 'desc':
@@ -65,20 +143,26 @@ class GetArticlesNode(template.Node):
             order = 'publish_date'
 
         user = context.get('user', None)
-
-        # get the live articles in the appropriate order
-        articles = Article.objects.live(user=user).order_by(order).select_related()
-
-        if self.count:
-            # if we have a number of articles to retrieve, pull the first of them
-            articles = articles[:int(self.count)]
-        else:
-            # get a range of articles
-            articles = articles[(int(self.start) - 1):int(self.end)]
+        is_superuser = bool(user is not None and user.is_superuser)
+        lookup = self.get_filter(context)
+
+        key = make_key('get_articles', self.offset, self.limit, order,
+                       is_superuser, lookup and '%s=%s' % lookup or '',
+                       get_version('articles'))
+        articles = cache.get(key)
+        if articles is None:
+            # get the live articles in the appropriate order
+            articles = Article.objects.live(user=user).order_by(order)
+            if lookup:
+                articles = articles.filter(**dict([lookup]))
+
+            articles = articles.defer(*SUMMARY_DEFERRED_FIELDS).select_related('author')
+            articles = list(articles[self.offset:self.limit])
+            cache.set(key, articles, CACHE_TIMEOUT)
 
         # don't send back a list when we really don't need/want one
-        if len(articles) == 1 and not self.start and int(self.count) == 1:
-            articles = articles[0]
+        if self.single:
+            articles = articles and articles[0] or None
 
         # put the article(s) into the context
         context[self.varname] = articles
@@ -89,82 +173,97 @@ def get_articles(parser, token):
     Retrieves a list of Article objects for use in a template.
     """
     args = token.split_contents()
-    argc = len(args)
 
     try:
-        assert argc in (4,6) or (argc in (5,7) and args[-1].lower() in ('desc', 'asc'))
-    except AssertionError:
+        a = args.index('as')
+        bits, rest = args[1:a], args[a + 1:]
+        assert len(rest) == 1 or (len(rest) == 2 and rest[1].lower() in ('desc', 'asc'))
+
+        # determine what parameters to use
+        filter_by = filter_value = None
+        if len(bits) > 2 and bits[-2] in ('tagged', 'by'):
+            filter_by, filter_value = bits[-2:]
+            bits = bits[:-2]
+
+        count = start = end = None
+        if len(bits) == 1:
+            count = int(bits[0])
+            assert count > 0
+        else:
+            assert len(bits) == 3 and bits[1] == 'to'
+            start, end = int(bits[0]), int(bits[2])
+            assert 0 < start <= end
+    except (AssertionError, ValueError):
         raise template.TemplateSyntaxError('Invalid get_articles syntax.')
 
-    # determine what parameters to use
-    order = 'desc'
-    count = start = end = varname = None
-    if argc == 4: t, count, a, varname = args
-    elif argc == 5: t, count, a, varname, order = args
-    elif argc == 6: t, start, t, end, a, varname = args
-    elif argc == 7: t, start, t, end, a, varname, order = args
-
     return GetArticlesNode(count=count,
                            start=start,
                            end=end,
-                           order=order,
-                           varname=varname)
+                           order=len(rest) == 2 and rest[1] or 'desc',
+                           varname=rest[0],
+                           filter_by=filter_by,
+                           filter_value=filter_value)
 
-class GetArticleArchivesNode(template.Node):
+def get_archives(user=None):
     """
-    Retrieves a list of years and months in which articles have been posted.
+    Returns a list of ``(year, ((month, article_count), ...))`` tuples for
+    the years and months in which the live articles were posted, most recent
+    years first.
     """
-    def __init__(self, varname):
-        self.varname = varname
+    is_superuser = bool(user is not None and user.is_superuser)
+    cache_key = make_key('article_archive_list', is_superuser, get_version('publishing'))
+    dt_archives = cache.get(cache_key)
+    if dt_archives is None:
+        archives = {}
 
-    def render(self, context):
-        cache_key = 'article_archive_list'
-        dt_archives = cache.get(cache_key)
-        if dt_archives is None:
-            archives = {}
-            user = context.get('user', None)
+        # iterate over the publish dates of all live articles
+        for pub in Article.objects.live(user=user).values_list('publish_date', flat=True):
+            # see if we already have an article in this year
+            if not archives.has_key(pub.year):
+                # if not, initialize a dict for the year
+                archives[pub.year] = {}
 
-            # iterate over all live articles
-            for article in Article.objects.live(user=user).select_related():
-                pub = article.publish_date
+            # make sure we know that we have an article posted in this month/year
+            if pub.month in archives[pub.year]:
+                archives[pub.year][pub.month] += 1
+            else:
+                archives[pub.year][pub.month] = 1
 
-                # see if we already have an article in this year
-                if not archives.has_key(pub.year):
-                    # if not, initialize a dict for the year
-                    archives[pub.year] = {}
+        dt_archives = []
 
-                # make sure we know that we have an article posted in this month/year
-                if pub.month in archives[pub.year]:
-                    archives[pub.year][pub.month] += 1
-                else:
-                    archives[pub.year][pub.month] = 1
-                #archives[pub.year][pub.month] = True
+        # now sort the years, so they don't appear randomly on the page
+        years = list(int(k) for k in archives.keys())
+        years.sort()
 
-            dt_archives = []
+        # more recent years will appear first in the resulting collection
+        years.reverse()
 
-            # now sort the years, so they don't appear randomly on the page
-            years = list(int(k) for k in archives.keys())
-            years.sort()
+        # iterate over all years
+        for year in years:
+            # sort the months of this year in which articles were posted
+            m = list(int(k) for k in archives[year].keys())
+            m.sort()
 
-            # more recent years will appear first in the resulting collection
-            years.reverse()
+            # now create a list of datetime objects for each month/year
+            months = [(datetime(year, month, 1), archives[year][month]) for month in m]
 
-            # iterate over all years
-            for year in years:
-                # sort the months of this year in which articles were posted
-                m = list(int(k) for k in archives[year].keys())
-                m.sort()
+            # append this list to our final collection
+            dt_archives.append( ( year, tuple(months) ) )
 
-                # now create a list of datetime objects for each month/year
-                months = [(datetime(year, month, 1), archives[year][month]) for month in m]
+        cache.set(cache_key, dt_archives, CACHE_TIMEOUT)
 
-                # append this list to our final collection
-                dt_archives.append( ( year, tuple(months) ) )
+    return dt_archives
 
-            cache.set(cache_key, dt_archives)
+class GetArticleArchivesNode(template.Node):
+    """
+    Retrieves a list of years and months in which articles have been posted.
+    """
+    def __init__(self, varname):
+        self.varname = varname
 
+    def render(self, context):
         # put our collection into the context
-        context[self.varname] = dt_archives
+        context[self.varname] = get_archives(context.get('user', None))
         return ''
 
 def get_article_archives(parser, token):
@@ -181,6 +280,81 @@ def get_article_archives(parser, token):
 
     return GetArticleArchivesNode(args[2])
 
+class RenderArticleArchivesNode(template.Node):
+    """
+    Renders ``articles/_archives.html``, caching the resulting HTML until an
+    article is published, unpublished or rescheduled.
+    """
+    template_name = 'articles/_archives.html'
+
+    def render(self, context):
+        user = context.get('user', None)
+        is_superuser = bool(user is not None and user.is_superuser)
+
+        key = make_key('article_archive_html', is_superuser, get_language(),
+                       get_version('publishing'))
+        html = cache.get(key)
+        if html is None:
+            html = render_to_string(self.template_name, {'archives': get_archives(user)})
+            cache.set(key, html, CACHE_TIMEOUT)
+
+        return html
+
+def render_article_archives(parser, token):
+    """
+    Renders the list of years and months in which articles have been posted.
+    """
+    args = token.split_contents()
+
+    if len(args) != 1:
+        raise template.TemplateSyntaxError('render_article_archives syntax: {% render_article_archives %}')
+
+    return RenderArticleArchivesNode()
+
+class CacheArticleNode(template.Node):
+    """
+    Caches the HTML rendered for an article until the article, its tags,
+    attachments, related articles or neighbors change.
+    """
+    def __init__(self, nodelist, article, fragment):
+        self.nodelist = nodelist
+        self.article = template.Variable(article)
+        self.fragment = fragment
+
+    def render(self, context):
+        article = self.article.resolve(context)
+
+        # relative dates ("today", "yesterday") are part of the HTML
+        key = make_key('article_html', self.fragment, article.pk, get_language(),
+                       date.today().isoformat(),
+                       get_version(article_version_name(article.pk)))
+        html = cache.get(key)
+        if html is None:
+            html = self.nodelist.render(context)
+            cache.set(key, html, CACHE_TIMEOUT)
+
+        return html
+
+def cache_article(parser, token):
+    """
+    Caches the HTML rendered for an article.
+
+    Usage::
+
+        {% cache_article article "body" %}
+            ...
+        {% endcache_article %}
+    """
+    args = token.split_contents()
+
+    if len(args) != 3:
+        raise template.TemplateSyntaxError('cache_article syntax: {% cache_article article fragment_name %}')
+
+    nodelist = parser.parse(('endcache_article',))
+    parser.delete_first_token()
+
+    return CacheArticleNode(nodelist, args[1], args[2].strip('\'"'))
+
 class DivideObjectListByNode(template.Node):
     """
     Divides an object list by some number to determine now many objects will
@@ -219,6 +393,29 @@ def divide_object_list(parser, token):
 
     return DivideObjectListByNode(args[1], args[3], args[5])
 
+# stands in for the page number while reversing pagination URLs
+PAGE_PLACEHOLDER = '31415926535'
+
+def get_page_url_pattern(request):
+    """
+    Resolves the view for the current page once per request and returns its
+    URL with PAGE_PLACEHOLDER where the page number goes.
+    """
+    cached = getattr(request, '_articles_page_url', None)
+    if cached is None or cached[0] != request.path:
+        try:
+            # determine what view we are using based upon the path of this page
+            view, args, kwargs = resolve(request.path)
+        except Resolver404:
+            raise ValueError('Invalid pagination page.')
+
+        # set the page parameter for this view and get the new URL from Django
+        kwargs['page'] = PAGE_PLACEHOLDER
+        cached = (request.path, reverse(view, args=args, kwargs=kwargs))
+        request._articles_page_url = cached
+
+    return cached[1]
+
 class GetPageURLNode(template.Node):
     """
     Determines the URL of a pagination page link based on the page from which
@@ -229,22 +426,15 @@ class GetPageURLNode(template.Node):
         self.varname = varname
 
     def render(self, context):
-        url = None
-
         # get the page number we're linking to from the context
         page_num = self.page_num.resolve(context)
 
         try:
-            # determine what view we are using based upon the path of this page
-            view, args, kwargs = resolve(context['request'].path)
-        except (Resolver404, KeyError):
+            pattern = get_page_url_pattern(context['request'])
+        except KeyError:
             raise ValueError('Invalid pagination page.')
-        else:
-            # set the page parameter for this view
-            kwargs['page'] = page_num
 
-            # get the new URL from Django
-            url = reverse(view, args=args, kwargs=kwargs)
+        url = pattern.replace(PAGE_PLACEHOLDER, str(page_num))
 
         if self.varname:
             # if we have a varname, put the URL into the context and return nothing
@@ -272,20 +462,69 @@ def get_page_url(parser, token):
 
     return GetPageURLNode(args[1], varname)
 
+class GetPageWindowNode(template.Node):
+    """
+    Determines which page numbers to link to: the first and last pages and
+    the pages around the current one.  Gaps are marked with ``None``.
+    """
+    def __init__(self, page_obj, varname, size=None):
+        self.page_obj = template.Variable(page_obj)
+        self.size = size
+        self.varname = varname
+
+    def render(self, context):
+        page_obj = self.page_obj.resolve(context)
+        current = page_obj.number
+        last = page_obj.paginator.num_pages
+        size = self.size
+        if size is None:
+            size = PAGINATION_WINDOW
+
+        numbers = set((1, last))
+        numbers.update(range(max(1, current - size), min(last, current + size) + 1))
+
+        pages = []
+        for number in sorted(numbers):
+            if pages and number - pages[-1] > 1:
+                pages.append(None)
+            pages.append(number)
+
+        context[self.varname] = pages
+        return ''
+
+def get_page_window(parser, token):
+    """
+    Determines which page numbers to link to: the first and last pages and
+    the pages around the current one.  Gaps are marked with ``None``.
+    """
+    args = token.split_contents()
+    argc = len(args)
+
+    try:
+        assert argc in (4, 5) and args[-2] == 'as'
+        size = None
+        if argc == 5:
+            size = int(args[2])
+            assert size >= 0
+    except (AssertionError, ValueError):
+        raise template.TemplateSyntaxError('get_page_window syntax: {% get_page_window page_obj [size] as varname %}')
+
+    return GetPageWindowNode(args[1], args[-1], size)
+
 def tag_cloud():
     """Provides the tags with a "weight" attribute to build a tag cloud"""
 
-    cache_key = 'tag_cloud_tags'
+    cache_key = make_key('tag_cloud', get_version('articles'), get_version('tags'))
     tags = cache.get(cache_key)
     if tags is None:
         MAX_WEIGHT = 7
-        tags = Tag.objects.annotate(count=Count('article'))
+        tags = list(annotate_tag_usage(Tag.objects.all(), Article.objects.live()))
 
         if len(tags) == 0:
             # go no further
             return {}
 
-        min_count = max_count = Article.objects.filter(tags__slug__in=[tags[0]]).count()
+        min_count = max_count = tags[0].count
         for tag in tags:
             if tag.count < min_count:
                 min_count = tag.count
@@ -301,7 +540,7 @@ def tag_cloud():
         for tag in tags:
             tag.weight = int(MAX_WEIGHT * (tag.count - min_count) / _range)
 
-        cache.set(cache_key, tags)
+        cache.set(cache_key, tags, CACHE_TIMEOUT)
 
     return {'tags': tags}
 
@@ -309,6 +548,9 @@ def tag_cloud():
 register.tag(get_articles)
 register.tag(get_article_tags)
 register.tag(get_article_archives)
+register.tag(render_article_archives)
+register.tag(cache_article)
 register.tag(divide_object_list)
 register.tag(get_page_url)
+register.tag(get_page_window)
 register.inclusion_tag('articles/_tag_cloud.html')(tag_cloud)
@@ -1,13 +1,69 @@
 # -*- coding: utf-8 -*-
 
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from cStringIO import StringIO
 from datetime import datetime, timedelta
-
+from gzip import GzipFile
+import simplejson as json
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import imaplib
+import os
+import poplib
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urlparse import parse_qsl
+from xml.dom import minidom
+
+from django.conf import settings
+from django.contrib import admin
 from django.contrib.auth.models import User, Permission
+from django.contrib.comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.management.color import no_style
+from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
+from django.db import connections, router
+from django.forms.models import modelform_factory
+from django.http import HttpResponse
+from django.template import Context, Template, TemplateSyntaxError
 from django.test import TestCase
-from django.test.client import Client
-
-from articles.models import Article, ArticleStatus, Tag, get_name, MARKUP_HTML, MARKUP_MARKDOWN, MARKUP_REST, MARKUP_TEXTILE
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.tzinfo import FixedOffset
+
+from articles import directives, listeners, models, renderers, views
+from articles.admin import ArticleAdmin
+from articles.autocomplete import TagIndex
+from articles.caching import get_version, listing_version_name, make_key
+from articles.feeds import LatestEntries, TagFeed
+from articles.forms import ArticleAdminForm
+from articles.management.commands.convert_comments_to_disqus import Checkpoint, Command as DisqusCommand
+from articles.management.commands.check_for_articles_from_email import AttachmentTooLarge, Command as EmailCommand, MailboxHandler, MailboxPoller, decode_attachment, get_attachment, get_email_digest
+from articles.models import Article, ArticleStatus, IngestedEmail, MailboxState, Tag, get_date_range, get_name, MARKUP_HTML, MARKUP_MARKDOWN, MARKUP_REST, MARKUP_TEXTILE
+from articles.routers import ArticlesRouter, PinPrimaryMiddleware, PIN_COOKIE, is_pinned, unpin
+from articles.templatetags.article_tags import tag_cloud
+
+class SlowRenderer(renderers.Renderer):
+    """Takes its time over documents that ask for it"""
+
+    def render(self, text):
+        if text.startswith('sleep'):
+            time.sleep(5)
+        elif text.startswith('pause'):
+            time.sleep(2)
+
+        return text.upper()
 
 class ArticleUtilMixin(object):
 
@@ -68,6 +124,26 @@ class TagTestCase(TestCase):
         t = Tag.objects.create(name=name)
         self.assertEqual(t.get_absolute_url(), reverse('articles_display_tag', args=[Tag.clean_tag(name)]))
 
+    def test_autocomplete_index(self):
+        """Tag auto-completion ranks matches by usage"""
+
+        index = TagIndex(limit=2)
+        index.build([(u'django', 3), (u'Django-CMS', 7), (u'dance', 1), (u'Căutare', 0)])
+
+        self.assertEqual(index.search('DJ'), [u'Django-CMS', u'django'])
+        self.assertEqual(index.search('d'), [u'Django-CMS', u'django'])
+        self.assertEqual(index.search('cau'), [u'Căutare'])
+        self.assertEqual(index.search('xyz'), [])
+
+    def test_autocomplete_view(self):
+        """Tag auto-completion picks up new tags"""
+
+        url = reverse('articles_tag_autocomplete')
+        self.assertEqual(self.client.get(url, {'q': 'wasa'}).content, '')
+
+        Tag.objects.create(name='wasabi')
+        self.assertEqual(self.client.get(url, {'q': 'wasa'}).content, 'wasabi')
+
 class ArticleStatusTestCase(TestCase):
 
     def setUp(self):
@@ -94,6 +170,45 @@ class ArticleTestCase(TestCase, ArticleUtilMixin):
 
         self.assertNotEqual(a1.slug, a2.slug)
 
+    def test_unique_slug_per_year(self):
+        """Slugs only need to be unique within the year of publication"""
+
+        a1 = self.new_article('Same Slug', 'Some content', publish_date=datetime(2011, 12, 31, 23, 59))
+        a2 = self.new_article('Same Slug', 'Some more content', publish_date=datetime(2012, 1, 1))
+
+        self.assertEqual((a1.publish_year, a2.publish_year), (2011, 2012))
+        self.assertEqual(a1.slug, a2.slug)
+        self.assertEqual(Article.objects.get(publish_year=2012, slug=a1.slug), a2)
+
+    def test_publish_year_in_utc(self):
+        """The year in an article's URL doesn't depend on where its date came from"""
+
+        live = ArticleStatus.objects.filter(is_live=True)[0]
+        with override_settings(USE_TZ=True):
+            with timezone.override(FixedOffset(-360)):
+                # New Year's Eve in local time, but already 2012 in UTC
+                publish_date = timezone.make_aware(datetime(2011, 12, 31, 20, 0), timezone.get_current_timezone())
+                a = self.new_article('Late', 'Just before midnight', status=live, publish_date=publish_date)
+                loaded = Article.objects.get(pk=a.pk)
+
+                self.assertEqual(a.publish_year, 2012)
+                self.assertEqual(loaded.get_absolute_url(), a.get_absolute_url())
+                self.assertEqual(self.client.get(loaded.get_absolute_url()).status_code, 200)
+
+    def test_month_listing(self):
+        """Month pages list articles published within that month only"""
+
+        self.assertEqual(get_date_range(2011, 12), (datetime(2011, 12, 1), datetime(2012, 1, 1)))
+        self.assertEqual(get_date_range(2011), (datetime(2011, 1, 1), datetime(2012, 1, 1)))
+
+        live = ArticleStatus.objects.filter(is_live=True)[0]
+        a1 = self.new_article('First', 'First of December', status=live, publish_date=datetime(2011, 12, 1))
+        self.new_article('Next', 'First of January', status=live, publish_date=datetime(2012, 1, 1))
+        self.new_article('Previous', 'Last of November', status=live, publish_date=datetime(2011, 11, 30, 23, 59))
+
+        res = self.client.get(reverse('articles_in_month', args=[2011, 12]))
+        self.assertEqual(list(res.context['page_obj'].object_list), [a1])
+
     def test_active_articles(self):
         """Active articles"""
 
@@ -143,6 +258,44 @@ class ArticleTestCase(TestCase, ArticleUtilMixin):
         self.assertEquals(Article.objects.live().count(), 2)
         self.assertEquals(Article.objects.live(self.superuser).count(), 3)
 
+    def test_live_on_site(self):
+        """Articles can be limited to the ones assigned to a site"""
+
+        live_status = ArticleStatus.objects.filter(is_live=True)[0]
+        other = Site.objects.create(domain='other.example.com', name='Other')
+        a1 = self.new_article('Here', 'On the current site', status=live_status)
+        a2 = self.new_article('There', 'On another site', status=live_status)
+        a2.sites = [other]
+
+        self.assertEquals(Article.objects.live().count(), 2)
+        self.assertEquals(list(Article.objects.live(site=other)), [a2])
+        self.assertEquals(list(Article.objects.live(site=settings.SITE_ID)), [a1])
+
+    def test_live_status_change(self):
+        """Changing whether a status is live updates its articles"""
+
+        status = ArticleStatus.objects.filter(is_live=False)[0]
+        a1 = self.new_article('New Article', 'This is a new article', status=status)
+        self.assertFalse(a1.is_live)
+        self.assertEquals(Article.objects.live().count(), 0)
+
+        status.is_live = True
+        status.save()
+        self.assertTrue(Article.objects.get(pk=a1.pk).is_live)
+        self.assertEquals(Article.objects.live().count(), 1)
+
+    def test_benchmark_live(self):
+        """The live() benchmark runs against its own database"""
+
+        out = StringIO()
+        call_command('benchmark_live', rows=100, repeat=1, stdout=out)
+        output = out.getvalue()
+
+        self.assertTrue('Benchmarking against 100 articles' in output)
+        self.assertTrue('USING INDEX' in output)
+        self.assertEquals(Article.objects.count(), 0)
+        self.assertFalse(hasattr(connections._connections, 'articles_benchmark'))
+
     def test_auto_expire(self):
         """
         Makes sure that articles set to expire will actually be marked inactive
@@ -188,6 +341,89 @@ regular paragraph.''', markup=MARKUP_REST)
 
         print a.rendered_content
 
+    def test_markup_rest_sourcecode(self):
+        """Makes sure the sourcecode directive is available to reST articles"""
+
+        a = self.new_article('Demo', '''Some code:
+
+.. sourcecode:: python
+
+    print 'hello'
+''', markup=MARKUP_REST)
+
+        self.assertTrue('<div class="codeblock">' in a.rendered_content)
+
+    def test_highlight_cache(self):
+        """Highlighted code blocks are reused, with the same output"""
+
+        source = '''.. sourcecode:: python
+    :linenos:
+
+    print 'cached'
+'''
+        cache.clear()
+        a1 = self.new_article('Demo', source, markup=MARKUP_REST)
+        hits = directives.stats['hits']
+        a2 = self.new_article('Demo', source, markup=MARKUP_REST)
+
+        self.assertEqual(directives.stats['hits'], hits + 1)
+        self.assertEqual(a1.rendered_content, a2.rendered_content)
+        self.assertTrue('class="linenos"' in a2.rendered_content or 'linenodiv' in a2.rendered_content)
+
+    def test_renderer_registry(self):
+        """Markup codes map to configurable renderers that are reused"""
+
+        self.assertTrue(renderers.get_renderer(MARKUP_MARKDOWN) is renderers.get_renderer(MARKUP_MARKDOWN))
+        self.assertEqual(renderers.render('x', '<b>as is</b>'), '<b>as is</b>')
+
+        renderer = renderers.load_renderer(('articles.renderers.MarkdownRenderer', {'extensions': ['abbr']}))
+        for i in range(2):
+            self.assertTrue('<abbr title="Hyper Text">HTML</abbr>' in renderer.render('HTML\n\n*[HTML]: Hyper Text'))
+
+    def test_render_timeout(self):
+        """Documents that take too long to render are shown as plain text"""
+
+        renderers.RENDERERS['z'] = 'articles.tests.SlowRenderer'
+        renderers.RENDER_TIMEOUT = 1
+        renderers.close_pool()
+        try:
+            self.assertEqual(renderers.render('z', 'quick'), 'QUICK')
+
+            started = time.time()
+            a = self.new_article('Slow', 'sleep <b>now</b>', markup='z')
+            self.assertTrue(time.time() - started < 4)
+            self.assertEqual(a.rendered_content, '<p>sleep &lt;b&gt;now&lt;/b&gt;</p>')
+
+            # the stuck worker is replaced
+            self.assertEqual(renderers.render('z', 'quick'), 'QUICK')
+        finally:
+            renderers.RENDER_TIMEOUT = None
+            renderers.close_pool()
+            del renderers.RENDERERS['z']
+
+    def test_render_timeout_spares_others(self):
+        """A render that times out doesn't take others down with it"""
+
+        renderers.RENDERERS['z'] = 'articles.tests.SlowRenderer'
+        renderers.close_pool()
+        results = []
+        def render_later():
+            time.sleep(1.5)
+            try:
+                results.append(renderers.render_in_pool('z', 'pause', timeout=5))
+            except renderers.RenderError, err:
+                results.append(err)
+        other = threading.Thread(target=render_later)
+        other.start()
+        try:
+            # times out while the other render is still running
+            self.assertRaises(renderers.RenderError, renderers.render_in_pool, 'z', 'sleep', 2.5)
+            other.join()
+            self.assertEqual(results, ['PAUSE'])
+        finally:
+            renderers.close_pool()
+            del renderers.RENDERERS['z']
+
     def test_markup_textile(self):
         """Makes sure textile works"""
 
@@ -373,6 +609,368 @@ class FeedTestCase(TestCase, ArticleUtilMixin):
         res = self.client.get(reverse('articles_atom_feed_tag', args=['demox']))
         self.assertEqual(res.status_code, 404)
 
+    def test_tag_feed_live_only(self):
+        """Makes sure tag feeds only list the live articles of the current site"""
+
+        demo = Tag.objects.filter(slug='demo')
+        draft = ArticleStatus.objects.filter(is_live=False)[0]
+        status = ArticleStatus.objects.filter(is_live=True)[0]
+        self.new_article('Unfinished', 'Not yet', tags=demo, status=draft)
+        other = self.new_article('Elsewhere', 'On another site', tags=demo, status=status)
+        other.sites = [Site.objects.create(domain='other.example.com', name='Other')]
+
+        models.LIVE_ON_SITE_ONLY = True
+        try:
+            titles = [a.title for a in TagFeed().item_set(Tag.objects.get(slug='demo'))]
+        finally:
+            models.LIVE_ON_SITE_ONLY = False
+
+        self.assertEqual(titles, ['This is a test!'])
+
+    def test_gzipped_feed(self):
+        """Makes sure feeds are served compressed when the client accepts it"""
+
+        plain = self.client.get(reverse('articles_rss_feed_latest'))
+        self.assertFalse(plain.has_header('Content-Encoding'))
+
+        res = self.client.get(reverse('articles_rss_feed_latest'), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(res['Content-Encoding'], 'gzip')
+        self.assertEqual(GzipFile(fileobj=StringIO(res.content)).read(), plain.content)
+
+    def test_feed_rebuilt_on_change(self):
+        """Makes sure prebuilt feeds pick up new articles"""
+
+        res = self.client.get(reverse('articles_rss_feed_tag', args=['demo']))
+        self.assertFalse('Another test' in res.content)
+
+        status = ArticleStatus.objects.filter(is_live=True)[0]
+        self.new_article('Another test', 'More testing', tags=Tag.objects.all(), status=status)
+
+        res = self.client.get(reverse('articles_rss_feed_tag', args=['demo']))
+        self.assertTrue('Another test' in res.content)
+
+    def test_feed_rebuilt_on_tag_rename(self):
+        """Makes sure prebuilt tag feeds pick up a renamed tag"""
+
+        res = self.client.get(reverse('articles_rss_feed_tag', args=['demo']))
+        self.assertTrue("Tagged 'Demo'" in res.content)
+
+        tag = Tag.objects.get(slug='demo')
+        tag.name = 'DEMO'
+        tag.save()
+
+        res = self.client.get(reverse('articles_rss_feed_tag', args=['demo']))
+        self.assertTrue("Tagged 'DEMO'" in res.content)
+
+    def test_site_per_request(self):
+        """Makes sure a shared feed instance names the current site"""
+
+        feed = LatestEntries()
+        other = Site.objects.create(domain='other.example.com', name='Other site')
+        self.assertEqual(feed.site, Site.objects.get_current())
+        with override_settings(SITE_ID=other.pk):
+            self.assertEqual(feed.site, other)
+
+    def test_build_feeds(self):
+        """Makes sure the build_feeds command caches every feed"""
+
+        cache.clear()
+        call_command('build_feeds', workers=1, verbosity=0)
+
+        feed = TagFeed()
+        request = RequestFactory().get(reverse('articles_rss_feed_tag', args=['demo']))
+        body = cache.get(feed.body_key(request, feed.get_object(request, 'demo')))
+        self.assertTrue('This is a test!' in body['plain'])
+
+class TemplateTagTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['tags', 'users']
+
+    def setUp(self):
+        status = ArticleStatus.objects.filter(is_live=True)[0]
+        self.demo = Tag.objects.get(slug='demo')
+        for i in range(5):
+            self.new_article('Article %s' % (i,), 'Content for article %s' % (i,), status=status,
+                             publish_date=datetime(2011, 1, i + 1), tags=i % 2 and [self.demo] or [])
+
+    def render(self, source, **context):
+        return Template('{% load article_tags %}' + source).render(Context(context))
+
+    def test_get_articles(self):
+        """Makes sure get_articles honors counts, ranges, order and filters"""
+
+        self.assertEqual(self.render('{% get_articles 1 as a %}{{ a.title }}'), 'Article 4')
+        self.assertEqual(self.render('{% get_articles 2 as a asc %}{% for x in a %}{{ x.title }},{% endfor %}'), 'Article 0,Article 1,')
+        self.assertEqual(self.render('{% get_articles 2 to 3 as a %}{% for x in a %}{{ x.title }},{% endfor %}'), 'Article 3,Article 2,')
+        self.assertEqual(self.render('{% get_articles 5 tagged "demo" as a %}{% for x in a %}{{ x.title }},{% endfor %}'), 'Article 3,Article 1,')
+        self.assertEqual(self.render('{% get_articles 1 tagged tag as a %}{{ a.title }}', tag=self.demo), 'Article 3')
+        self.assertEqual(self.render('{% get_articles 1 to 5 by "jim" as a %}{{ a|length }}'), '0')
+
+    def test_get_articles_queries(self):
+        """Makes sure get_articles runs a single query and caches it"""
+
+        cache.clear()
+        source = '{% get_articles 3 as a %}{% for x in a %}{{ x.title }}{{ x.author.username }}{{ x.get_absolute_url }}{% endfor %}'
+        with self.assertNumQueries(1):
+            self.render(source)
+        with self.assertNumQueries(0):
+            self.render(source)
+
+    def test_get_articles_invalidation(self):
+        """Makes sure cached get_articles results are refreshed"""
+
+        self.assertEqual(self.render('{% get_articles 1 as a %}{{ a.title }}'), 'Article 4')
+        Article.objects.get(title='Article 4').delete()
+        self.assertEqual(self.render('{% get_articles 1 as a %}{{ a.title }}'), 'Article 3')
+
+    def test_get_article_tags(self):
+        """Makes sure get_article_tags only lists tags with live articles"""
+
+        source = '{% get_article_tags as tags %}{% for t in tags %}{{ t.slug }}:{{ t.count }},{% endfor %}'
+        self.assertEqual(self.render(source), 'demo:2,')
+
+        draft = ArticleStatus.objects.filter(is_live=False)[0]
+        self.new_article('Draft', 'Not yet', status=draft, tags=Tag.objects.all())
+        self.assertEqual(self.render(source), 'demo:2,')
+
+        status = ArticleStatus.objects.filter(is_live=True)[0]
+        self.new_article('Live', 'Here now', status=status, tags=Tag.objects.all())
+        tags = Tag.objects.order_by('name')
+        self.assertEqual(self.render(source), ''.join('%s:%s,' % (t.slug, t.slug == 'demo' and 3 or 1) for t in tags))
+        self.assertEqual(self.render('{% get_article_tags 1 as tags count %}{% for t in tags %}{{ t.slug }}{% endfor %}'), 'demo')
+
+    def test_tag_cloud(self):
+        """Makes sure the tag cloud only counts live articles"""
+
+        draft = ArticleStatus.objects.filter(is_live=False)[0]
+        self.new_article('Draft', 'Not yet', status=draft, tags=[self.demo])
+
+        tags = dict((t.slug, t.count) for t in tag_cloud()['tags'])
+        self.assertEqual(tags, {'demo': 2})
+
+    def test_render_article_archives(self):
+        """Makes sure the cached archive fragment follows publishing"""
+
+        source = '{% render_article_archives %}'
+        month_url = reverse('articles_in_month', args=[2011, 1])
+        self.assertTrue(month_url in self.render(source))
+
+        with self.assertNumQueries(0):
+            self.render(source)
+
+        draft = ArticleStatus.objects.filter(is_live=False)[0]
+        self.new_article('Draft', 'Not yet', status=draft, publish_date=datetime(2010, 5, 1))
+        draft_url = reverse('articles_in_month', args=[2010, 5])
+        self.assertFalse(draft_url in self.render(source))
+        self.assertTrue(draft_url in self.render(source, user=self.superuser))
+
+        article = Article.objects.get(title='Draft')
+        article.status = ArticleStatus.objects.filter(is_live=True)[0]
+        article.save()
+        self.assertTrue(draft_url in self.render(source))
+
+    def test_cache_article(self):
+        """Makes sure cached article HTML follows changes to the article"""
+
+        article = Article.objects.get(title='Article 2')
+        source = '{% cache_article article "test" %}{{ article.title }}:{% for t in article.tags.all %}{{ t.slug }}{% endfor %}:{% for ra in article.related_articles.live %}{{ ra.title }}{% endfor %}{% endcache_article %}'
+        self.assertEqual(self.render(source, article=article), 'Article 2::')
+
+        with self.assertNumQueries(0):
+            self.render(source, article=article)
+
+        article.tags.add(self.demo)
+        self.assertEqual(self.render(source, article=article), 'Article 2:demo:')
+
+        other = Article.objects.get(title='Article 0')
+        other.related_articles.add(article)
+        self.assertEqual(self.render(source, article=article), 'Article 2:demo:Article 0')
+
+        other.title = 'Renamed'
+        other.save()
+        self.assertEqual(self.render(source, article=article), 'Article 2:demo:Renamed')
+
+        res = self.client.get(article.get_absolute_url())
+        self.assertContains(res, 'Renamed')
+
+    def test_cache_article_tag_rename(self):
+        """Makes sure cached article HTML only follows the tags it shows"""
+
+        article = Article.objects.get(title='Article 1')
+        source = '{% cache_article article "test" %}{% for t in article.tags.all %}{{ t.name }}{% endfor %}{% endcache_article %}'
+        self.assertEqual(self.render(source, article=article), 'Demo')
+
+        # other articles being published leave this one alone
+        status = ArticleStatus.objects.filter(is_live=True)[0]
+        self.new_article('Unrelated', 'Nothing to see', status=status, publish_date=datetime(2012, 1, 1))
+        with self.assertNumQueries(0):
+            self.render(source, article=article)
+
+        self.demo.name = 'DEMO'
+        self.demo.save()
+        self.assertEqual(self.render(source, article=article), 'DEMO')
+
+    def test_cache_article_neighbors(self):
+        """Makes sure cached article HTML stops linking to articles that went away"""
+
+        source = '{% cache_article article "test" %}{{ article.get_previous_article.title }}|{{ article.get_next_article.title }}{% endcache_article %}'
+        render = lambda: self.render(source, article=Article.objects.get(title='Article 2'))
+        self.assertEqual(render(), 'Article 1|Article 3')
+
+        moved = Article.objects.get(title='Article 3')
+        moved.publish_date = datetime(2011, 2, 1)
+        moved.save()
+        self.assertEqual(render(), 'Article 1|Article 4')
+
+        Article.objects.get(title='Article 4').delete()
+        self.assertEqual(render(), 'Article 1|Article 3')
+
+        ArticleAdmin(Article, admin.site).mark_inactive(None, Article.objects.filter(title='Article 1'))
+        self.assertEqual(render(), 'Article 0|Article 3')
+
+    def test_get_page_url(self):
+        """Makes sure pagination links are built from a single resolve"""
+
+        request = RequestFactory().get(reverse('articles_display_tag_page', args=['demo', 2]))
+        source = '{% get_page_url 7 %} {% get_page_url page as url %}{{ url }}'
+        self.assertEqual(self.render(source, request=request, page=12),
+                         '%s %s' % (reverse('articles_display_tag_page', args=['demo', 7]),
+                                    reverse('articles_display_tag_page', args=['demo', 12])))
+
+        request = RequestFactory().get(reverse('articles_archive'))
+        self.assertEqual(self.render('{% get_page_url 3 %}', request=request), reverse('articles_archive_page', args=[3]))
+
+    def test_get_page_window(self):
+        """Makes sure only pages around the current one are linked to"""
+
+        paginator = Paginator(range(300), 1)
+        source = '{% get_page_window page_obj 2 as pages %}{% for p in pages %}{{ p|default:"-" }},{% endfor %}'
+        self.assertEqual(self.render(source, page_obj=paginator.page(1)), '1,2,3,-,300,')
+        self.assertEqual(self.render(source, page_obj=paginator.page(150)), '1,-,148,149,150,151,152,-,300,')
+        self.assertEqual(self.render(source, page_obj=paginator.page(4)), '1,2,3,4,5,6,-,300,')
+
+    def test_get_articles_syntax(self):
+        self.assertRaises(TemplateSyntaxError, self.render, '{% get_articles as a %}')
+        self.assertRaises(TemplateSyntaxError, self.render, '{% get_articles 5 to 1 as a %}')
+        self.assertRaises(TemplateSyntaxError, self.render, '{% get_articles 5 as a sideways %}')
+        self.assertRaises(TemplateSyntaxError, self.render, '{% get_article_tags 0 as tags %}')
+        self.assertRaises(TemplateSyntaxError, self.render, '{% get_article_tags as tags sideways %}')
+
+class ListingCacheTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['tags', 'users']
+
+    def setUp(self):
+        views.CACHE_LISTINGS = True
+        self.client = Client()
+        self.status = ArticleStatus.objects.filter(is_live=True)[0]
+        self.demo = Tag.objects.get(slug='demo')
+        self.article = self.new_article('Cached', 'Cached content', status=self.status,
+                                        publish_date=datetime(2011, 3, 1), tags=[self.demo])
+
+    def tearDown(self):
+        views.CACHE_LISTINGS = False
+
+    def test_cached_listing(self):
+        """Makes sure anonymous listings are served from the cache"""
+
+        url = reverse('articles_display_tag', args=['demo'])
+        self.assertContains(self.client.get(url), 'Cached')
+
+        # only the tag lookup is left
+        with self.assertNumQueries(1):
+            self.assertContains(self.client.get(url), 'Cached')
+
+    def test_purged_listings(self):
+        """Makes sure article changes only purge the listings showing it"""
+
+        urls = {
+            'tag': reverse('articles_display_tag', args=['demo']),
+            'other_tag': reverse('articles_display_tag', args=['this-is-a-test']),
+            'author': reverse('articles_by_author', args=['superuser']),
+            'month': reverse('articles_in_month', args=[2011, 3]),
+            'archive': reverse('articles_archive'),
+        }
+        for url in urls.values():
+            self.client.get(url)
+
+        self.article.title = 'Renamed'
+        self.article.save()
+
+        for name, url in urls.items():
+            self.assertEqual('Renamed' in self.client.get(url).content, name != 'other_tag')
+
+        # the old month must forget about the article too
+        self.article.publish_date = datetime(2011, 4, 1)
+        self.article.save()
+        res = self.client.get(urls['month'])
+        self.assertEqual(list(res.context['page_obj'].object_list), [])
+
+    def test_admin_save(self):
+        """Makes sure saving through the admin form keeps other listings cached"""
+
+        other_tag = Tag.objects.get(slug='this-is-a-test')
+        self.new_article('Other', 'Other content', status=self.status,
+                         publish_date=datetime(2010, 3, 1), tags=[other_tag])
+        url = reverse('articles_display_tag', args=[other_tag.slug])
+        self.assertContains(self.client.get(url), 'Other')
+
+        # the form clears the tags before applying them again
+        AdminForm = modelform_factory(Article, form=ArticleAdminForm,
+            fields=('title', 'slug', 'content', 'tags', 'markup', 'status', 'publish_date'))
+        form = AdminForm(instance=self.article, data={
+            'title': 'Renamed',
+            'slug': self.article.slug,
+            'content': self.article.content,
+            'tags': 'demo',
+            'markup': self.article.markup,
+            'status': self.status.pk,
+            'publish_date': '2011-03-01 00:00:00',
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+
+        # only the tag lookup is left
+        with self.assertNumQueries(1):
+            self.assertContains(self.client.get(url), 'Other')
+
+        self.assertContains(self.client.get(reverse('articles_display_tag', args=['demo'])), 'Renamed')
+
+    def test_authenticated_bypass(self):
+        """Makes sure logged in users never get cached pages"""
+
+        url = reverse('articles_archive')
+        self.client.get(url)
+
+        # an update sends no signals, so only fresh pages show it
+        Article.objects.filter(pk=self.article.pk).update(title='Renamed')
+        self.assertNotContains(self.client.get(url), 'Renamed')
+
+        User.objects.create_user('reader', 'reader@example.com', 'reader')
+        self.client.login(username='reader', password='reader')
+        self.assertContains(self.client.get(url), 'Renamed')
+
+    def test_status_change(self):
+        """Makes sure changing whether a status is live purges the listings"""
+
+        url = reverse('articles_in_month', args=[2011, 3])
+        self.assertContains(self.client.get(url), 'Cached')
+
+        self.status.is_live = False
+        self.status.save()
+        self.assertNotContains(self.client.get(url), 'Cached')
+
+        self.status.is_live = True
+        self.status.save()
+        self.assertContains(self.client.get(url), 'Cached')
+
+    def test_month_in_local_time(self):
+        """Makes sure the month purged is the one the article is listed in"""
+
+        with override_settings(USE_TZ=True):
+            with timezone.override(FixedOffset(-360)):
+                names = listeners.get_listing_names(1, datetime(2011, 4, 1, 3, 0, tzinfo=timezone.utc))
+
+        self.assertTrue(listing_version_name('month', '2011_3') in names)
+
 class FormTestCase(TestCase, ArticleUtilMixin):
     fixtures = ['users',]
 
@@ -408,6 +1006,842 @@ class ListenerTestCase(TestCase, ArticleUtilMixin):
         # make sure the tags were actually applied to our new article
         self.assertEqual(a.tags.count(), 3)
 
+class RouterTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def setUp(self):
+        # an empty replica, so reads that reach it find nothing
+        handle, self.replica_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.replica_path}
+        replica = connections['replica']
+        cursor = replica.cursor()
+        for model in (ArticleStatus, Article):
+            for sql in replica.creation.sql_create_model(model, no_style())[0]:
+                cursor.execute(sql)
+
+        # as replicated from the primary
+        for status in ArticleStatus.objects.using('default'):
+            status.save(using='replica')
+
+        self.router = ArticlesRouter(read_dbs=['replica'])
+        router.routers.insert(0, self.router)
+        unpin()
+
+    def tearDown(self):
+        router.routers.remove(self.router)
+        unpin()
+        connections['replica'].close()
+        del connections.databases['replica']
+        delattr(connections._connections, 'replica')
+        os.remove(self.replica_path)
+
+    def test_routing(self):
+        """Reads go to the replica until something is written"""
+
+        self.assertEqual(self.router.db_for_read(Article), 'replica')
+        self.assertEqual(self.router.db_for_read(User), None)
+        self.assertEqual(self.router.db_for_write(User), None)
+
+        self.new_article('Routed', 'Written to the primary')
+        self.assertTrue(is_pinned())
+        self.assertEqual(Article.objects.count(), 1)
+
+        unpin()
+        self.assertEqual(Article.objects.count(), 0)
+        self.assertEqual(Article.objects.using('default').count(), 1)
+
+    def test_middleware(self):
+        """Writing pins the following requests to the primary for a while"""
+
+        middleware = PinPrimaryMiddleware()
+        request = RequestFactory().post('/')
+        middleware.process_request(request)
+        self.new_article('Routed', 'Written to the primary')
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(is_pinned())
+        self.assertTrue(PIN_COOKIE in response.cookies)
+
+        request = RequestFactory().get('/')
+        request.COOKIES[PIN_COOKIE] = '1'
+        middleware.process_request(request)
+        self.assertEqual(Article.objects.count(), 1)
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(PIN_COOKIE in response.cookies)
+
+        # writing while pinned keeps the pin going
+        request = RequestFactory().post('/')
+        request.COOKIES[PIN_COOKIE] = '1'
+        middleware.process_request(request)
+        self.new_article('Again', 'Written while pinned')
+        response = middleware.process_response(request, HttpResponse())
+        self.assertTrue(PIN_COOKIE in response.cookies)
+
+        middleware.process_request(RequestFactory().get('/'))
+        self.assertEqual(Article.objects.count(), 0)
+
+class StubIMAP(object):
+    """Just enough of imaplib.IMAP4 to check a mailbox for articles"""
+
+    capabilities = ('IMAP4REV1',)
+    error, abort = imaplib.IMAP4.error, imaplib.IMAP4.abort
+
+    def __init__(self, host, port):
+        self.commands = []
+        self.deleted = []
+
+    def login(self, username, password):
+        pass
+
+    def select(self):
+        return 'OK', [str(len(self.mailbox))]
+
+    def response(self, code):
+        return code, [self.validity]
+
+    def uid(self, command, *args):
+        self.commands.append((command,) + args)
+        if command == 'SEARCH':
+            start = int(args[1].split()[1].split(':')[0])
+            uids = sorted(self.mailbox)
+            uids = [uid for uid in uids if uid >= start] or uids[-1:]
+            return 'OK', [' '.join(str(uid) for uid in uids)]
+        elif command == 'FETCH':
+            data = []
+            for uid in args[0].split(','):
+                message = self.mailbox[int(uid)]
+                if args[1] == '(UID RFC822.SIZE)':
+                    data.append('%s (UID %s RFC822.SIZE %s)' % (uid, uid, len(message)))
+                    continue
+                elif args[1].startswith('(UID BODY.PEEK[]<'):
+                    offset, length = map(int, args[1][17:-2].split('.'))
+                    piece = message[offset:offset + length]
+                    data.append(('%s (UID %s BODY[]<%s> {%s}' % (uid, uid, offset, len(piece)), piece))
+                    data.append(')')
+                    continue
+                data.append(('%s (UID %s RFC822 {%s}' % (uid, uid, len(message)), message))
+                data.append(')')
+            return 'OK', data
+        elif command == 'STORE':
+            self.deleted.extend(int(uid) for uid in args[0].split(','))
+            return 'OK', []
+
+    def expunge(self):
+        while self.deleted:
+            del self.mailbox[self.deleted.pop()]
+
+    def close(self):
+        pass
+
+    def logout(self):
+        pass
+
+class StubPOP3(object):
+    """Just enough of poplib.POP3 to read a mailbox"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.deleted = set()
+
+    def user(self, username):
+        pass
+
+    def pass_(self, password):
+        pass
+
+    def list(self):
+        return '+OK', ['%s %s' % (i + 1, len(m)) for i, m in enumerate(self.messages)]
+
+    def _putcmd(self, line):
+        command, num = line.split()
+        self.lines = iter(self.messages[int(num) - 1].split('\r\n') + ['.'])
+
+    def _getresp(self):
+        return '+OK'
+
+    def _getline(self):
+        line = self.lines.next()
+        return line, len(line)
+
+    def dele(self, num):
+        self.deleted.add(num - 1)
+
+    def quit(self):
+        # messages are only deleted when the session ends
+        self.messages[:] = [m for i, m in enumerate(self.messages) if i not in self.deleted]
+
+class ArticlesFromEmailTestCase(TestCase):
+    fixtures = ['users']
+
+    def setUp(self):
+        User.objects.filter(username='superuser').update(email='author@example.com')
+        StubIMAP.validity = '1'
+        StubIMAP.mailbox = {
+            1: self.message('author@example.com', 'From email'),
+            2: self.message('stranger@example.com', 'Not allowed'),
+        }
+        self.IMAP4, imaplib.IMAP4 = imaplib.IMAP4, StubIMAP
+
+    def tearDown(self):
+        imaplib.IMAP4 = self.IMAP4
+
+    def message(self, sender, subject):
+        return 'From: %s\r\nSubject: %s\r\nDate: Tue, 1 Mar 2011 10:00:00 -0000\r\n\r\nPosted by email\r\n' % (sender, subject)
+
+    def check(self):
+        with override_settings(ARTICLES_FROM_EMAIL={'batch_size': 1}):
+            call_command('check_for_articles_from_email', host='imap.example.com', username='articles', verbosity=0)
+
+    def test_incremental_fetch(self):
+        """Only messages that arrived since the last run are downloaded"""
+
+        self.check()
+        self.assertEqual(list(Article.objects.values_list('title', flat=True)), ['From email'])
+        # the stranger's message stays, but is not read again
+        self.assertEqual(sorted(StubIMAP.mailbox), [2])
+
+        StubIMAP.mailbox[3] = self.message('author@example.com', 'Another one')
+        self.check()
+        self.assertEqual(Article.objects.count(), 2)
+        self.assertEqual(MailboxState.objects.get().last_uid, 3)
+
+        # a renumbered mailbox is read from the start
+        StubIMAP.validity = '2'
+        StubIMAP.mailbox = {1: self.message('author@example.com', 'Renumbered')}
+        self.check()
+        self.assertEqual(Article.objects.count(), 3)
+        self.assertEqual(MailboxState.objects.get().last_uid, 1)
+
+    def test_unlabelled_fetch(self):
+        """A message the server sends back without its UID is not skipped for good"""
+
+        class UnlabelledIMAP(StubIMAP):
+            def uid(self, command, *args):
+                typ, data = super(UnlabelledIMAP, self).uid(command, *args)
+                if command == 'FETCH' and args[0] == '1':
+                    data[0] = ('1 (RFC822 {%s}' % (len(data[0][1]),), data[0][1])
+                return typ, data
+        imaplib.IMAP4 = UnlabelledIMAP
+
+        self.check()
+        self.assertEqual(Article.objects.count(), 0)
+        self.assertEqual(MailboxState.objects.get().last_uid, 0)
+
+        imaplib.IMAP4 = StubIMAP
+        self.check()
+        self.assertEqual(list(Article.objects.values_list('title', flat=True)), ['From email'])
+        self.assertEqual(MailboxState.objects.get().last_uid, 2)
+
+    def test_pop3_fetch(self):
+        """POP3 messages are read one at a time, under their own numbers"""
+
+        handler = MailboxHandler.get_handle('POP3', 'pop.example.com', None, 'articles', '', None, None, False)
+        handler._handle = StubPOP3([StubIMAP.mailbox[1], StubIMAP.mailbox[2]])
+        messages = handler.fetch()
+        self.assertFalse(isinstance(messages, dict))
+        self.assertEqual([(num, m['Subject']) for num, m in messages], [(1, 'From email'), (2, 'Not allowed')])
+
+    def test_fetch_in_pieces(self):
+        """A message bigger than a fetch is downloaded a piece at a time"""
+
+        handler = MailboxHandler.get_handle('IMAP4', 'imap.example.com', None, 'articles', '', None, None, False,
+                                            max_fetch_size=20)
+        messages = list(handler.fetch())
+        self.assertEqual([(uid, m['Subject']) for uid, m in messages], [('1', 'From email'), ('2', 'Not allowed')])
+        self.assertEqual(messages[0][1].get_payload(), 'Posted by email\r\n')
+        pieces = [c for c in handler.handle.commands if c[1] == '1' and c[2].startswith('(UID BODY.PEEK[]')]
+        self.assertEqual(len(pieces), (len(StubIMAP.mailbox[1]) + 19) / 20)
+
+    def test_pop3_deletes(self):
+        """Deleted POP3 messages are gone once each batch is done"""
+
+        mailbox = [StubIMAP.mailbox[1], StubIMAP.mailbox[2], self.message('author@example.com', 'Another one')]
+        sessions = []
+        def connect(host, port):
+            sessions.append(StubPOP3(mailbox))
+            return sessions[-1]
+        POP3, poplib.POP3 = poplib.POP3, connect
+        try:
+            with override_settings(ARTICLES_FROM_EMAIL={'batch_size': 1}):
+                call_command('check_for_articles_from_email', protocol='POP3', host='pop.example.com',
+                             username='articles', verbosity=0)
+        finally:
+            poplib.POP3 = POP3
+
+        self.assertEqual(sorted(Article.objects.values_list('title', flat=True)), ['Another one', 'From email'])
+        self.assertEqual(mailbox, [StubIMAP.mailbox[2]])
+        self.assertEqual(len(sessions), 2)
+
+    def test_pop3_deletes_in_batches(self):
+        """Only posted POP3 messages are deleted, whatever session they were read in"""
+
+        mailbox = [self.message('author@example.com', 'A'), self.message('stranger@example.com', 'S1'),
+                   self.message('author@example.com', 'B'), self.message('author@example.com', 'C'),
+                   self.message('stranger@example.com', 'S2'), self.message('stranger@example.com', 'S3')]
+        strangers = [mailbox[1], mailbox[4], mailbox[5]]
+        def connect(host, port):
+            return StubPOP3(mailbox)
+        POP3, poplib.POP3 = poplib.POP3, connect
+        try:
+            with override_settings(ARTICLES_FROM_EMAIL={'batch_size': 2}):
+                call_command('check_for_articles_from_email', protocol='POP3', host='pop.example.com',
+                             username='articles', verbosity=0)
+        finally:
+            poplib.POP3 = POP3
+
+        self.assertEqual(sorted(Article.objects.values_list('title', flat=True)), ['A', 'B', 'C'])
+        self.assertEqual(mailbox, strangers)
+
+    def test_batched_fetch(self):
+        """Messages are fetched and deleted by UID, in batches"""
+
+        commands = []
+        class RecordingIMAP(StubIMAP):
+            def __init__(self, host, port):
+                super(RecordingIMAP, self).__init__(host, port)
+                self.commands = commands
+        imaplib.IMAP4 = RecordingIMAP
+
+        self.check()
+        # consumed messages are deleted while the next ones are fetched
+        self.assertEqual(commands[1:], [
+            ('FETCH', '1', '(UID RFC822.SIZE)'),
+            ('FETCH', '1', '(UID RFC822)'),
+            ('STORE', '1', '+FLAGS', '(\\Deleted)'),
+            ('FETCH', '2', '(UID RFC822.SIZE)'),
+            ('FETCH', '2', '(UID RFC822)'),
+        ])
+
+    def test_fetch_size_limit(self):
+        """A batch of messages is downloaded a few megabytes at a time"""
+
+        StubIMAP.mailbox[3] = self.message('author@example.com', 'Another one')
+        handler = MailboxHandler.get_handle('IMAP4', 'imap.example.com', None, 'articles', '', None, None, False,
+                                            max_fetch_size=len(StubIMAP.mailbox[1]) + len(StubIMAP.mailbox[2]))
+        self.assertEqual([uid for uid, message in handler.fetch()], ['1', '2', '3'])
+        self.assertEqual([c[1] for c in handler.handle.commands if c[-1] == '(UID RFC822)'], ['1,2', '3'])
+
+    def test_multiple_mailboxes(self):
+        """Each configured mailbox is checked, and keeps its own place"""
+
+        config = {'batch_size': 1, 'mailboxes': [{'host': 'one.example.com'}, {'host': 'two.example.com', 'autopost': True}]}
+        with override_settings(ARTICLES_FROM_EMAIL=config):
+            call_command('check_for_articles_from_email', username='articles', verbosity=0)
+
+        self.assertEqual(sorted(MailboxState.objects.values_list('mailbox', flat=True)),
+                         ['articles@one.example.com:143/INBOX', 'articles@two.example.com:143/INBOX'])
+        self.assertEqual(Article.objects.count(), 1)
+
+    def test_poller_backoff(self):
+        """A mailbox that can't be reached is retried less and less often"""
+
+        class BrokenIMAP(StubIMAP):
+            def login(self, username, password):
+                raise socket.error('Connection refused')
+        imaplib.IMAP4 = BrokenIMAP
+
+        command = EmailCommand()
+        command.config, command.verbosity = {}, 0
+        config = command.get_mailboxes({'protocol': None, 'host': 'imap.example.com', 'port': None, 'keyfile': None,
+                                        'certfile': None, 'username': 'articles', 'password': None, 'ssl': False})[0]
+        poller = MailboxPoller(command, dict(config, max_backoff=30))
+
+        delays = []
+        for i in range(5):
+            self.assertFalse(poller.poll())
+            delays.append(poller.backoff())
+        self.assertEqual(delays, [5, 10, 20, 30, 30])
+        self.assertEqual(poller.stats['failures'], 5)
+        self.assertEqual(cache.get(make_key('mailbox_stats', poller.name))['checks'], 5)
+
+        imaplib.IMAP4 = StubIMAP
+        self.assertTrue(poller.poll())
+        self.assertEqual(poller.failures, 0)
+        self.assertEqual(poller.stats['created'], 1)
+        # IMAP connections are kept open between checks
+        self.assertTrue(poller.handle is not None)
+        self.assertFalse(poller.handle.idle(1))
+        poller.disconnect()
+
+    def get_poller(self, **config):
+        command = EmailCommand()
+        command.config, command.verbosity = {}, 0
+        default = command.get_mailboxes({'protocol': None, 'host': 'imap.example.com', 'port': None, 'keyfile': None,
+                                         'certfile': None, 'username': 'articles', 'password': None, 'ssl': False})[0]
+        return MailboxPoller(command, dict(default, **config))
+
+    def test_poller_survives_errors(self):
+        """An unexpected error is counted as a failure instead of ending the thread"""
+
+        class BuggyIMAP(StubIMAP):
+            def login(self, username, password):
+                raise ValueError('Unexpected')
+        imaplib.IMAP4 = BuggyIMAP
+
+        # the thread can't see the test database, so keep it away from there
+        Site.objects.get_current()
+        poller = self.get_poller()
+        poller.start()
+        for i in range(50):
+            if poller.stats['failures']:
+                break
+            time.sleep(0.1)
+
+        self.assertTrue(poller.is_alive())
+        self.assertEqual(poller.failures, 1)
+        poller.stop()
+        poller.join(5)
+        self.assertFalse(poller.is_alive())
+
+    def test_stop_while_idle(self):
+        """Stopping a poller wakes it up from IMAP IDLE"""
+
+        class IdleIMAP(StubIMAP):
+            capabilities = ('IMAP4REV1', 'IDLE')
+
+            def __init__(self, host, port):
+                super(IdleIMAP, self).__init__(host, port)
+                listener = socket.socket()
+                listener.bind(('127.0.0.1', 0))
+                listener.listen(1)
+                self.sock = socket.create_connection(listener.getsockname())
+                self.server, address = listener.accept()
+                listener.close()
+                self.file = self.sock.makefile('rb')
+                self.idling = threading.Event()
+
+            def _new_tag(self):
+                return 'A001'
+
+            def send(self, data):
+                self.sock.sendall(data)
+                if data.endswith('IDLE\r\n'):
+                    self.server.sendall('+ idling\r\n')
+                    self.idling.set()
+
+            def readline(self):
+                return self.file.readline()
+        imaplib.IMAP4 = IdleIMAP
+
+        poller = self.get_poller(idle_timeout=30)
+        self.assertTrue(poller.poll())
+        M = poller.handle._handle
+        waiter = threading.Thread(target=poller.wait)
+        waiter.start()
+        self.assertTrue(M.idling.wait(5))
+
+        started = time.time()
+        poller.stop()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue(poller.handle is None)
+
+    def test_no_duplicates(self):
+        """A message posted before isn't posted again, and is then deleted"""
+
+        class CrashingIMAP(StubIMAP):
+            def expunge(self):
+                raise socket.error('Connection reset')
+        imaplib.IMAP4 = CrashingIMAP
+
+        self.check()
+        self.assertEqual(Article.objects.count(), 1)
+        self.assertEqual(sorted(StubIMAP.mailbox), [1, 2])
+
+        # the same message again, under another UID
+        StubIMAP.mailbox[3] = StubIMAP.mailbox[1]
+        MailboxState.objects.update(last_uid=0)
+        imaplib.IMAP4 = StubIMAP
+        self.check()
+        self.assertEqual(Article.objects.count(), 1)
+        self.assertEqual(sorted(StubIMAP.mailbox), [2])
+        self.assertEqual(IngestedEmail.objects.get().article, Article.objects.get())
+
+    def test_posted_meanwhile(self):
+        """A message another run posts at the same time counts as posted"""
+
+        saved = []
+        class RacingCommand(EmailCommand):
+            def posted_digests(self, digests):
+                seen = super(RacingCommand, self).posted_digests(digests)
+                # the other run records the message right after the lookup
+                for digest in digests:
+                    IngestedEmail.objects.create(digest=digest)
+                return seen
+
+            def save_attachments(self, article, email, config):
+                saved.append(article)
+
+        command = RacingCommand()
+        command.verbosity = 0
+        handler = MailboxHandler.get_handle('IMAP4', 'imap.example.com', None, 'articles', '', None, None, False)
+        emails = [(1, handler.parse_email(StubIMAP.mailbox[1]))]
+        self.assertEqual(list(command.create_articles(emails, {})), [1])
+        self.assertEqual(saved, [])
+        self.assertEqual(IngestedEmail.objects.count(), 1)
+
+    def test_batch_queries(self):
+        """Posted messages are looked up once per batch, not once per message"""
+
+        handler = MailboxHandler.get_handle('IMAP4', 'imap.example.com', None, 'articles', '', None, None, False)
+        emails = [(i, handler.parse_email(self.message('stranger@example.com', 'Message %s' % (i,))))
+                  for i in range(1, 5)]
+
+        lookups = []
+        class CountingCommand(EmailCommand):
+            def posted_digests(self, digests):
+                lookups.append(len(digests))
+                return super(CountingCommand, self).posted_digests(digests)
+
+        command = CountingCommand()
+        command.verbosity = 0
+        self.assertEqual(list(command.create_articles(emails, {'batch_size': 3})), [])
+        self.assertEqual(lookups, [3, 1])
+
+    def test_batch_spools_attachments(self):
+        """Attachments of messages waiting for their batch are kept on disk"""
+
+        message = MIMEMultipart()
+        message['From'] = 'author@example.com'
+        message.attach(MIMEText('Posted by email'))
+        attachment = MIMEApplication('small enough to stay in memory')
+        attachment.add_header('Content-Disposition', 'attachment', filename='data.bin')
+        message.attach(attachment)
+
+        handler = MailboxHandler.get_handle('IMAP4', 'imap.example.com', None, 'articles', '', None, None, False)
+        email = handler.parse_email(message.as_string())
+        part = email.get_payload()[1]
+        self.assertFalse(part.decoded.file._rolled)
+
+        spooled = []
+        class InspectingCommand(EmailCommand):
+            def create_batch(self, batch, config):
+                spooled.extend(p.decoded.file._rolled for num, e in batch for p in e.walk() if hasattr(p, 'decoded'))
+                return []
+
+        command = InspectingCommand()
+        command.verbosity = 0
+        list(command.create_articles([(1, email)], {'batch_size': 2}))
+        self.assertEqual(spooled, [True])
+
+    def test_attachment_decoding(self):
+        """Attachments are decoded a piece at a time, within the size limit"""
+
+        data = os.urandom(300000)
+        message = MIMEMultipart()
+        message.attach(MIMEText('Posted by email'))
+        attachment = MIMEApplication(data)
+        attachment.add_header('Content-Disposition', 'attachment', filename='data.bin')
+        message.attach(attachment)
+        part = message.get_payload()[1]
+
+        content = decode_attachment(part, spool_size=1024)
+        self.assertEqual(content.size, len(data))
+        self.assertEqual(''.join(content.chunks()), data)
+        # too big to stay in memory
+        self.assertTrue(content.file._rolled)
+        content.close()
+
+        self.assertRaises(AttachmentTooLarge, decode_attachment, part, 1000)
+        self.assertRaises(AttachmentTooLarge, decode_attachment, part, len(data) - 1)
+        decode_attachment(part, len(data)).close()
+
+    def test_message_parser(self):
+        """Messages are parsed as they stream, decoding attachments on the way"""
+
+        data = os.urandom(300000)
+        message = MIMEMultipart()
+        message['Subject'] = 'Attached'
+        message.attach(MIMEText('Posted by email'))
+        attachment = MIMEApplication(data)
+        attachment.add_header('Content-Disposition', 'attachment', filename='data.bin')
+        message.attach(attachment)
+        printed = MIMEText('=E9t=E9\n', 'plain')
+        del printed['Content-Transfer-Encoding']
+        printed['Content-Transfer-Encoding'] = 'quoted-printable'
+        printed.add_header('Content-Disposition', 'attachment', filename='notes.txt')
+        message.attach(printed)
+
+        handler = MailboxHandler.get_handle('IMAP4', 'imap.example.com', None, 'articles', '', None, None, False,
+                                            attachment_spool_size=1024)
+        parsed = handler.parse_email(message.as_string())
+        self.assertEqual(parsed['Subject'], 'Attached')
+        self.assertEqual([p.get_content_type() for p in parsed.get_payload()],
+                         ['text/plain', 'application/octet-stream', 'text/plain'])
+        command = EmailCommand()
+        command.verbosity = 0
+        self.assertEqual(command.get_email_content(parsed), 'Posted by email')
+
+        content = get_attachment(parsed.get_payload()[1])
+        self.assertEqual(''.join(content.chunks()), data)
+        self.assertTrue(content.file._rolled)
+        content.close()
+        self.assertEqual(get_attachment(parsed.get_payload()[2]).read(), '\xe9t\xe9\n')
+
+        handler.max_attachment_size = 1000
+        parsed = handler.parse_email(message.as_string())
+        self.assertRaises(AttachmentTooLarge, get_attachment, parsed.get_payload()[1])
+
+    def test_streaming_memory(self):
+        """A big attachment is decoded without the message ever being in memory"""
+
+        script = '''
+import resource, tempfile
+from articles.management.commands.check_for_articles_from_email import MessageParser
+raw = tempfile.TemporaryFile()
+raw.write('From: author@example.com\\r\\nSubject: Big\\r\\n'
+          'Content-Type: multipart/mixed; boundary="b"\\r\\n\\r\\n'
+          '--b\\r\\nContent-Type: text/plain\\r\\n\\r\\nPosted by email\\r\\n'
+          '--b\\r\\nContent-Type: application/octet-stream\\r\\nContent-Transfer-Encoding: base64\\r\\n'
+          'Content-Disposition: attachment; filename="big.bin"\\r\\n\\r\\n')
+for i in range(5000):
+    raw.write(('A' * 76 + '\\r\\n') * 100)
+raw.write('--b--\\r\\n')
+raw.seek(0)
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+message = MessageParser().parse(raw)
+print message.get_payload()[1].decoded.size, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+'''
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, env=env).communicate()[0]
+        size, growth = map(int, output.split())
+        self.assertEqual(size, 500000 * 57)
+        # about 39MB encoded and 28MB decoded; ru_maxrss is in kilobytes
+        self.assertTrue(growth < 8 * 1024, growth)
+
+class StubDisqusHandler(BaseHTTPRequestHandler):
+    """Answers like the Disqus API, failing the requests it's told to"""
+
+    def do_GET(self):
+        self.respond(self.path.split('?', 1)[1] if '?' in self.path else '')
+
+    def do_POST(self):
+        self.respond(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def respond(self, data):
+        server = self.server
+        method = self.path.split('?')[0].strip('/').split('/')[-1]
+        params = dict(parse_qsl(data))
+        server.calls.append((method, params))
+
+        failures = server.failures.get(method)
+        if failures:
+            server.failures[method] = failures - 1
+            self.send_response(server.failure_status)
+            self.end_headers()
+            return
+        elif method in server.garbled:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write('<html>Down for maintenance</html>')
+            return
+
+        if method == 'get_forum_api_key':
+            message = 'forum-key'
+        elif method == 'thread_by_identifier':
+            message = {'thread': {'id': 'thread-%s' % params['identifier']}, 'created': True}
+        else:
+            message = {}
+
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(json.dumps({'succeeded': True, 'message': message}))
+
+    def log_message(self, *args):
+        pass
+
+@override_settings(DISQUS_USER_API_KEY='user-key')
+class DisqusTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    @classmethod
+    def setUpClass(cls):
+        super(DisqusTestCase, cls).setUpClass()
+        # django.contrib.comments isn't installed for the tests.  Creating a
+        # table commits, so it's done before there's any test data.
+        db = connections['default']
+        cursor = db.cursor()
+        for sql in db.creation.sql_create_model(Comment, no_style())[0]:
+            cursor.execute(sql)
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubDisqusHandler)
+        self.server.calls = []
+        self.server.failures = {}
+        self.server.failure_status = 503
+        self.server.garbled = set()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        handle, self.checkpoint = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        os.remove(self.checkpoint)
+
+        self.article = self.new_article('Commented', 'Content')
+        self.comments = [Comment(pk=i, comment='Comment %s' % i, user_name='Someone', user_email='someone@example.com',
+                                 submit_date=datetime(2011, 3, 1), ip_address='127.0.0.1', user_url='',
+                                 is_public=True, is_removed=False) for i in (1, 2)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        DisqusCommand._forum_api_key.clear()
+
+    def export(self, retries=0):
+        command = DisqusCommand()
+        command.api_url = 'http://127.0.0.1:%s/api/' % (self.server.server_port,)
+        command.retries = retries
+        command.retry_delay = 0
+        command.checkpoint = Checkpoint(self.checkpoint)
+        command.forum_id = 'forum'
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            command.export_threads([(self.article, self.comments)], workers=2)
+        finally:
+            sys.stdout = stdout
+
+    def posts(self):
+        return [params['message'] for method, params in self.server.calls if method == 'create_post']
+
+    def test_retry(self):
+        """Failed API calls are tried again"""
+
+        self.server.failures['create_post'] = 2
+        self.export(retries=2)
+        self.assertEqual(self.posts(), ['Comment 1', 'Comment 1', 'Comment 1', 'Comment 2'])
+        # the thread is looked up once for the whole article
+        self.assertEqual([m for m, p in self.server.calls].count('thread_by_identifier'), 1)
+
+    def test_resume(self):
+        """An interrupted import carries on from the checkpoint"""
+
+        posts = self.posts
+        class FailSecondPost(dict):
+            def get(self, method):
+                return method == 'create_post' and len(posts()) > 1
+        self.server.failures = FailSecondPost()
+        self.export()
+        self.assertEqual(Checkpoint(self.checkpoint).posted, set([1]))
+
+        self.server.failures = {}
+        self.server.calls = []
+        self.export()
+        self.assertEqual(self.posts(), ['Comment 2'])
+        self.assertFalse('thread_by_identifier' in [m for m, p in self.server.calls])
+
+        self.server.calls = []
+        self.export()
+        self.assertEqual(self.posts(), [])
+
+    def test_post_not_repeated(self):
+        """A comment isn't posted again after an error that it may have got through"""
+
+        self.server.failures['create_post'] = 1
+        self.server.failure_status = 500
+        self.export(retries=2)
+        self.assertEqual(self.posts(), ['Comment 1'])
+        self.assertEqual(Checkpoint(self.checkpoint).posted, set())
+
+    def test_unexpected_answer(self):
+        """An answer that isn't JSON fails the article, not the whole import"""
+
+        self.server.garbled.add('create_post')
+        self.export(retries=2)
+        self.assertEqual(self.posts(), ['Comment 1'])
+        self.assertEqual(Checkpoint(self.checkpoint).threads, {self.article.id: 'thread-%s' % self.article.id})
+
+    def test_checkpoint_log(self):
+        """Progress is appended to the checkpoint, which belongs to one forum"""
+
+        checkpoint = Checkpoint(self.checkpoint)
+        checkpoint.record_forum('forum')
+        checkpoint.record_thread(self.article.id, 'thread')
+        checkpoint.record_post(1)
+        with open(self.checkpoint, 'a') as fp:
+            # interrupted in the middle of a line
+            fp.write('{"posted": ')
+
+        checkpoint = Checkpoint(self.checkpoint)
+        self.assertEqual((checkpoint.forum_id, checkpoint.threads, checkpoint.posted),
+                         ('forum', {self.article.id: 'thread'}, set([1])))
+        checkpoint.record_post(2)
+        self.assertEqual(Checkpoint(self.checkpoint).posted, set([1, 2]))
+
+        command = DisqusCommand()
+        self.assertRaises(CommandError, command.handle_noargs, forum='other', checkpoint=self.checkpoint)
+
+    def test_export_in_chunks(self):
+        """Saved comments are exported a few articles at a time, to a file"""
+
+        articles = [self.article, self.new_article('Second', 'Content'), self.new_article('Third', 'Content')]
+        content_type = ContentType.objects.get_for_model(Article)
+        site = Site.objects.get_current()
+        for i, article in enumerate(articles * 2):
+            Comment.objects.create(content_type=content_type, object_pk=str(article.pk), site=site,
+                                   comment='Comment %s' % i, user_name='Someone', user_email='someone@example.com',
+                                   submit_date=datetime(2011, 3, 1 + i), ip_address='127.0.0.1', user_url='',
+                                   is_public=True, is_removed=False)
+
+        command = DisqusCommand()
+        # two comments per article, so each chunk of three holds one article:
+        # a query for the counts, then two for each chunk
+        with self.assertNumQueries(7):
+            threads = [(a, [c.comment for c in comments]) for a, comments in command.iter_threads(chunk_size=3)]
+        self.assertEqual([(a.pk, comments) for a, comments in threads], [
+            (articles[0].pk, ['Comment 0', 'Comment 3']),
+            (articles[1].pk, ['Comment 1', 'Comment 4']),
+            (articles[2].pk, ['Comment 2', 'Comment 5']),
+        ])
+        # the articles come without their content
+        self.assertTrue(all(a._deferred and 'content' not in a.__dict__ for a, comments in threads))
+
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            command.export_file(path, chunk_size=3)
+            with open(path) as fp:
+                lines = [json.loads(line) for line in fp]
+
+            os.rename(path, path[:-len('.jsonl')] + '.xml')
+            path = path[:-len('.jsonl')] + '.xml'
+            command.export_file(path, chunk_size=3)
+            document = minidom.parse(path)
+        finally:
+            sys.stdout = stdout
+            os.remove(path)
+
+        self.assertEqual([(l['thread_identifier'], l['message']) for l in lines[:2]],
+                         [(articles[0].pk, 'Comment 0'), (articles[0].pk, 'Comment 3')])
+        self.assertEqual(len(lines), 6)
+        self.assertEqual([item.getElementsByTagName('title')[0].firstChild.data for item in document.getElementsByTagName('item')],
+                         ['Commented', 'Second', 'Third'])
+
+    def test_export_file(self):
+        """Comments can be written to a WXR or JSON lines file instead"""
+
+        self.comments[1].is_public = False
+        command = DisqusCommand()
+
+        out = StringIO()
+        self.assertEqual(command.write_export(out, 'wxr', [(self.article, iter(self.comments))]), 2)
+        document = minidom.parseString(out.getvalue())
+        item, = document.getElementsByTagName('item')
+        self.assertEqual(item.getElementsByTagName('dsq:thread_identifier')[0].firstChild.data, str(self.article.id))
+        self.assertEqual([c.firstChild.data for c in item.getElementsByTagName('wp:comment_content')], ['Comment 1', 'Comment 2'])
+        self.assertEqual([c.firstChild.data for c in item.getElementsByTagName('wp:comment_approved')], ['1', '0'])
+
+        out = StringIO()
+        command.write_export(out, 'jsonl', [(self.article, iter(self.comments))])
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(l['thread_identifier'], l['message'], l['state']) for l in lines],
+                         [(self.article.id, 'Comment 1', 'approved'), (self.article.id, 'Comment 2', 'unapproved')])
+
 class MiscTestCase(TestCase):
     fixtures = ['users',]
 
@@ -420,3 +1854,44 @@ class MiscTestCase(TestCase):
 
         self.assertEqual(u1.get_name(), 'superuser')
         self.assertEqual(u2.get_name(), 'Jim Bob')
+
+    def test_convert_categories_to_tags(self):
+        """Categories from old versions become tags in a few statements"""
+
+        cursor = connections['default'].cursor()
+        cursor.execute('CREATE TABLE articles_category (id integer PRIMARY KEY, slug varchar(64))')
+        cursor.execute('CREATE TABLE articles_article_categories (id integer PRIMARY KEY, article_id integer, category_id integer)')
+        cursor.executemany('INSERT INTO articles_category (id, slug) VALUES (%s, %s)', [(1, 'django'), (2, 'python'), (3, 'Python')])
+
+        author = User.objects.get(pk=1)
+        articles = [Article.objects.create(title='Article %s' % i, content='Content', author=author) for i in range(3)]
+        Tag.objects.create(name='Django')
+        articles[0].tags.add(Tag.objects.get(name='Django'))
+        cursor.executemany('INSERT INTO articles_article_categories (article_id, category_id) VALUES (%s, %s)',
+                           [(articles[0].pk, 1), (articles[0].pk, 2), (articles[1].pk, 2), (articles[1].pk, 3),
+                            (articles[2].pk, 1)])
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command('convert_categories_to_tags', dry_run=True)
+            self.assertEqual(Tag.objects.count(), 1)
+            self.assertTrue('Would create 1 tags and apply 3 tags' in sys.stdout.getvalue())
+
+            call_command('convert_categories_to_tags')
+            call_command('convert_categories_to_tags')
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(sorted(Tag.objects.values_list('name', flat=True)), ['Django', 'Python'])
+        self.assertEqual([sorted(a.tags.values_list('slug', flat=True)) for a in articles],
+                         [['django', 'python'], ['python'], ['django']])
+
+    def test_cache_keys_per_site(self):
+        """Cached content is kept apart per site, version stamps are shared"""
+
+        key = make_key('listing')
+        version = get_version('articles')
+        with override_settings(SITE_ID=2):
+            self.assertNotEqual(make_key('listing'), key)
+            self.assertEqual(get_version('articles'), version)
+
@@ -8,11 +8,17 @@ from django.core.urlresolvers import reverse
 from django.http import HttpResponsePermanentRedirect, Http404, HttpResponseRedirect, HttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
-from articles.models import Article, Tag
+from django.utils.translation import get_language
+from articles.autocomplete import tag_index
+from articles.caching import CACHE_TIMEOUT, get_version, listing_version_name, make_key
+from articles.models import Article, Tag, get_date_range
 from datetime import datetime
 
 ARTICLE_PAGINATION = getattr(settings, 'ARTICLE_PAGINATION', 20)
 
+# whether to cache whole listing pages for anonymous visitors
+CACHE_LISTINGS = getattr(settings, 'ARTICLES_CACHE_LISTINGS', False)
+
 log = logging.getLogger('articles.views')
 
 def display_blog_page(request, tag=None, username=None, year=None, month=None, page=1):
@@ -33,6 +39,7 @@ def display_blog_page(request, tag=None, username=None, year=None, month=None, p
         articles = Article.objects.live(user=request.user).filter(tags__slug__in=[tag.slug]).distinct().select_related()
         template = 'articles/display_tag.html'
         context['tag'] = tag
+        listing = ('tag', tag.pk)
 
     elif username:
         # listing articles by a particular author
@@ -40,19 +47,36 @@ def display_blog_page(request, tag=None, username=None, year=None, month=None, p
         articles = user.article_set.live(user=request.user)
         template = 'articles/by_author.html'
         context['author'] = user
+        listing = ('author', user.pk)
 
     elif year and month:
         # listing articles in a given month and year
         year = int(year)
         month = int(month)
-        articles = Article.objects.live(user=request.user).select_related().filter(publish_date__year=year, publish_date__month=month)
+        start, end = get_date_range(year, month)
+        articles = Article.objects.live(user=request.user).select_related().filter(publish_date__gte=start, publish_date__lt=end)
         template = 'articles/in_month.html'
         context['month'] = datetime(year, month, 1)
+        listing = ('month', '%s_%s' % (year, month))
 
     else:
         # listing articles with no particular filtering
         articles = Article.objects.live(user=request.user)
         template = 'articles/article_list.html'
+        listing = ('archive', '')
+
+    # anonymous visitors all see the same page, so serve it from the cache;
+    # the listeners purge the listings an article shows up in, while the
+    # sidebar (recent articles, archives and tags) may lag behind by up to
+    # ARTICLES_CACHE_TIMEOUT
+    cache_key = None
+    if CACHE_LISTINGS and not request.user.is_authenticated():
+        cache_key = make_key('listing', get_language(), page,
+                             get_version(listing_version_name(*listing)), *listing)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
 
     # paginate the articles
     paginator = Paginator(articles, ARTICLE_PAGINATION,
@@ -67,13 +91,17 @@ def display_blog_page(request, tag=None, username=None, year=None, month=None, p
     variables = RequestContext(request, context)
     response = render_to_response(template, variables)
 
+    # keep pages that list protected articles out of the cache
+    if cache_key and not any(a.login_required for a in page.object_list):
+        cache.set(cache_key, (response.content, response['Content-Type']), CACHE_TIMEOUT)
+
     return response
 
 def display_article(request, year, slug, template='articles/article_detail.html'):
     """Displays a single article."""
 
     try:
-        article = Article.objects.live(user=request.user).get(publish_date__year=year, slug=slug)
+        article = Article.objects.live(user=request.user).get(publish_year=year, slug=slug)
     except Article.DoesNotExist:
         raise Http404
 
@@ -91,25 +119,14 @@ def display_article(request, year, slug, template='articles/article_detail.html'
 
 def redirect_to_article(request, year, month, day, slug):
     # this is a little snippet to handle URLs that are formatted the old way.
-    article = get_object_or_404(Article, publish_date__year=year, slug=slug)
+    article = get_object_or_404(Article, publish_year=year, slug=slug)
     return HttpResponsePermanentRedirect(article.get_absolute_url())
 
 def ajax_tag_autocomplete(request):
     """Offers a list of existing tags that match the specified query"""
 
     if 'q' in request.GET:
-        q = request.GET['q']
-        key = 'ajax_tag_auto_%s' % q
-        response = cache.get(key)
-
-        if response is not None:
-            return response
-
-        tags = list(Tag.objects.filter(name__istartswith=q)[:10])
-        response = HttpResponse(u'\n'.join(tag.name for tag in tags))
-        cache.set(key, response, 300)
-
-        return response
+        tags = tag_index.search(request.GET['q'])
+        return HttpResponse(u'\n'.join(tags))
 
     return HttpResponse()
-